@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+"""
+Automatic gain tuning for the PID-Controller, used by "pidcontroller.py autotune".
+
+1. A relay feedback experiment switches the output between +h and -h whenever the error
+   changes sign. The resulting limit cycle gives the ultimate gain Ku = 4h / (pi a) and the
+   ultimate period Tu, from which the Ziegler-Nichols rules derive initial gains.
+2. The recorded response is used to identify the plant gain and the disturbance. A pattern
+   search then refines the gains in the offline simulator against this recorded plant.
+3. The refined gains are run on the plant to measure the loop performance.
+
+The plant is accessed through two functions: read() returns the position and
+apply(position, u) moves the position by u.
+"""
+import numpy as np
+from pidengine import VectorPID
+from pidcontroller import DELTA_I_COEFFICIENT, deltaI
+from simulation import simulate
+
+
+def relayExperiment(read, apply, niveau: float, amplitude: float, loop, cycles: int = 10, maxSteps: int = 5000, hysteresis: float = 0.0) -> dict:
+    times = []
+    positions = []
+    outputs = []
+    switches = []
+    u = amplitude
+    loop.start()
+    for k in range(maxSteps):
+        pos = read()
+        error = niveau - pos
+        if error > hysteresis:
+            relay = amplitude
+        elif error < -hysteresis:
+            relay = -amplitude
+        else:
+            relay = u
+        if relay != u:
+            switches.append(k)
+            u = relay
+        apply(pos, u)
+
+        times.append(loop.elapsed())
+        positions.append(pos)
+        outputs.append(u)
+        # two switches per oscillation, the first ones are the transient
+        if len(switches) >= 2 * cycles + 2:
+            break
+        loop.wait()
+    return {'time': np.array(times), 'position': np.array(positions), 'output': np.array(outputs), 'switches': np.array(switches, dtype=int)}
+
+
+def analyzeRelay(record: dict, amplitude: float, skip: int = 2):
+    """
+    Returns the ultimate gain Ku and the ultimate period Tu of the relay experiment.
+    """
+    switches = record['switches'][skip:]
+    if len(switches) < 3:
+        raise RuntimeError('the relay experiment didn\'t produce a sustained oscillation')
+    switchTimes = record['time'][switches]
+    period = 2 * np.mean(np.diff(switchTimes))
+    cycle = record['position'][switches[0]:switches[-1] + 1]
+    a = (np.max(cycle) - np.min(cycle)) / 2
+    if a <= 0:
+        raise RuntimeError('the relay experiment didn\'t move the plant')
+    return 4 * amplitude / (np.pi * a), period
+
+
+def zieglerNichols(ku: float, tu: float) -> tuple:
+    # classic PID rule: Kp = 0.6 Ku, Ti = Tu / 2, Td = Tu / 8
+    kp = 0.6 * ku
+    return kp, 2 * kp / tu, kp * tu / 8
+
+
+def identifyPlant(record: dict):
+    """
+    Fits position[k + 1] - position[k] = gain * output[k] + disturbance[k].
+    Returns the gain, the disturbance sequence and the mean step time.
+    """
+    dx = np.diff(record['position'])
+    u = record['output'][:-1]
+    gain = np.dot(dx, u) / np.dot(u, u)
+    disturbance = dx - gain * u
+    dt = np.mean(np.diff(record['time']))
+    return gain, disturbance, dt
+
+
+def refineGains(initial, disturbance: np.ndarray, dt: float, plantGain: float, niveau: float, start: float, outputLimits=(None, None),
+                steps: int = 2000, iterations: int = 50, tolerance: float = 1e-3, metric: str = 'rms', verbose: int = 0) -> tuple:
+    """
+    Pattern search around the initial gains. Every iteration simulates all 27 combinations
+    of (-step, 0, +step) for Kp, Ki and Kd at once and moves to the one with the lowest
+    metric. The default rms is the error the controller measures before its correction,
+    the same as the rms error of measurePerformance.
+    The step shrinks when the center is the best candidate.
+    Returns the gains and their simulated metrics.
+    """
+    noise = np.resize(disturbance, steps)
+    plantCoefficient = DELTA_I_COEFFICIENT / plantGain
+    center = np.array(initial, dtype=float)
+    step = 0.5 * np.maximum(np.abs(center), 0.05)
+    offsets = np.array(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij')).reshape(3, -1).T
+    centerIndex = 13 # offset (0, 0, 0)
+
+    best = None
+    for iteration in range(iterations):
+        candidates = np.maximum(center + offsets * step, 0)
+        results = simulate(candidates[:, 0], candidates[:, 1], candidates[:, 2], noise, dt, niveau=niveau, start=start,
+                           outputLimits=outputLimits, plantCoefficient=plantCoefficient)
+        cost = np.where(np.isfinite(results[metric]), results[metric], np.inf)
+        index = int(np.argmin(cost))
+        if cost[index] >= cost[centerIndex]:
+            index = centerIndex
+        best = results[index]
+        if verbose >= 2:
+            print('iteration ' + str(iteration) + ': Kp: ' + str(candidates[index][0]) + ', Ki: ' + str(candidates[index][1]) + ', Kd: ' + str(candidates[index][2]) + ', ' + metric + ': ' + str(cost[index]))
+        if index == centerIndex:
+            step = step / 2
+            if np.all(step < tolerance * np.maximum(np.abs(center), 1)):
+                break
+        else:
+            center = candidates[index]
+    return tuple(center), best
+
+
+def measurePerformance(read, apply, gains, niveau: float, loop, steps: int = 200, outputLimits=(None, None)) -> dict:
+    """
+    Runs the gains on the plant and returns IAE, ISE, actuator effort (in A) and the error statistics.
+    """
+    pid = VectorPID(gains[0], gains[1], gains[2], setpoint=niveau, outputLimits=outputLimits)
+    errors = np.empty(steps)
+    effort = 0.0
+    loop.start()
+    for k in range(steps):
+        pos = read()
+        u = pid(pos)
+        apply(pos, u)
+        errors[k] = niveau - pos
+        effort = effort + abs(deltaI(u))
+        loop.wait()
+    dt = loop.elapsed() / steps
+    return {'iae': float(np.sum(np.abs(errors)) * dt), 'ise': float(np.sum(errors ** 2) * dt), 'effort': effort,
+            'mean error': float(np.mean(errors)), 'rms error': float(np.sqrt(np.mean(errors ** 2))), 'rate': 1 / dt}
@@ -0,0 +1,425 @@
+#!/usr/bin/python3
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter_ns, sleep, time
+import numpy as np
+
+ver = "1.0.0"
+author = "Valentin Reichenbach"
+description = """
+Benchmarks the hot paths of the controller and the noise generator:
+    pid             per step cost of the PID update, one and 64 channels, and of every input filter
+    debug           debugEnv.txt and shared memory round trip of both scripts
+    noise           legacy randomNoise.generateNoise and the noise engine per noise type
+    logging         rows per second of the csv and binary telemetry logger
+    plot            cost of publishing a sample and of drawing a frame (Agg)
+    startup         time until the entry points are ready (--help) and which heavy modules they load
+    loop            achieved loop rate of pidcontroller.py against randomNoise.py in debug mode,
+                    and in normal mode against a local softIoc serving testioc.db if it is installed
+The results are written as json, --compare checks them against the results of an earlier run.
+"""
+epilog = """
+Author: Valentin Reichenbach
+Version: 1.0.0
+License: GPLv3+
+"""
+
+HERE = Path(__file__).resolve().parent
+GROUPS = ['pid', 'debug', 'noise', 'logging', 'plot', 'startup', 'loop']
+# entry points and the modules that must not be loaded before they are needed
+ENTRY_POINTS = ['pidcontroller', 'randomNoise', 'simulation', 'plotnoise', 'runtime', 'control']
+HEAVY_MODULES = ['matplotlib', 'epics', 'http.server', 'multiprocessing', 'concurrent.futures.process']
+
+
+def timeCall(func, number: int, repeat: int = 5) -> dict:
+    """
+    Runs func number times per repeat. Returns the time per call in us, the best repeat
+    is the value, the median and worst are kept to see the noise of the measurement.
+    """
+    runs = []
+    for _ in range(repeat):
+        start = perf_counter_ns()
+        for _ in range(number):
+            func()
+        runs.append((perf_counter_ns() - start) / number / 1e3)
+    runs.sort()
+    return {'value': runs[0], 'median': runs[len(runs) // 2], 'max': runs[-1], 'unit': 'us', 'better': 'lower'}
+
+
+def rate(value: float, unit: str) -> dict:
+    return {'value': value, 'unit': unit, 'better': 'higher'}
+
+
+def benchPid(args) -> dict:
+    from pidengine import VectorPID
+
+    pid = VectorPID(0.5, 0.3, 0.1, setpoint=1, outputLimits=(-3, 3))
+    results = {'pid.step': timeCall(lambda: pid(0.9, 0.01), args.number)}
+    pid = VectorPID(np.full(64, 0.5), 0.3, 0.1, setpoint=1, outputLimits=(-3, 3))
+    measurement = np.full(64, 0.9)
+    results['pid.step64'] = timeCall(lambda: pid.step(measurement, 0.01), args.number)
+
+    # the input filters run once per step in front of the PID controller
+    import filters
+    for spec in ('ema:0.2', 'median:5', 'hampel:7', 'lowpass:5', 'notch:50'):
+        chain = filters.create([spec], rate=1000)
+        results['pid.filter.' + spec.partition(':')[0]] = timeCall(lambda: chain(0.9), args.number)
+    return results
+
+
+def benchDebug(args, directory: Path) -> dict:
+    import pidcontroller
+    import randomNoise
+    import debugchannel
+
+    debugFile = str(directory / 'benchEnv.txt')
+    options = argparse.Namespace(mode='debug', verbose=0)
+    randomNoise.writeToDebugFile(debugFile, 1.0, options)
+
+    def controller():
+        value = pidcontroller.getCurrentVal(options, debugFile)
+        pidcontroller.writeDebugVal(debugFile, value + 1e-3)
+
+    def environment():
+        value = float(randomNoise.getFromDebugFile(debugFile, 1.0, options))
+        randomNoise.writeToDebugFile(debugFile, value - 1e-3, options)
+
+    results = {'debug.file.controller': timeCall(controller, args.number),
+               'debug.file.environment': timeCall(environment, args.number)}
+    os.remove(debugFile)
+
+    environmentChannel = debugchannel.createChannel(debugFile)
+    # a second view of the same segment, attachChannel would unregister it from this process
+    controllerChannel = debugchannel.DebugChannel(environmentChannel.shm, role=debugchannel.CONTROLLER, owner=False)
+
+    def controllerShm():
+        value = pidcontroller.getCurrentVal(options, debugFile, controllerChannel)
+        pidcontroller.writeDebugVal(debugFile, value + 1e-3, controllerChannel)
+
+    def environmentShm():
+        value = randomNoise.getFromDebugFile(debugFile, 1.0, options, environmentChannel)
+        randomNoise.writeToDebugFile(debugFile, value - 1e-3, options, environmentChannel)
+
+    results['debug.shm.controller'] = timeCall(controllerShm, args.number)
+    results['debug.shm.environment'] = timeCall(environmentShm, args.number)
+    controllerChannel.buf = None
+    environmentChannel.close()
+    return results
+
+
+def benchNoise(args) -> dict:
+    import randomNoise
+    import noiseengine
+
+    results = {}
+    table = list(np.sin(np.linspace(0, 2 * np.pi, 100, endpoint=False)))
+    for noiseType in ('normal', 'sin', 'mix'):
+        state = [0]
+
+        def legacy():
+            _, state[0] = randomNoise.generateNoise(state[0], table, len(table), no_delete=False, file='', noise_type=noiseType,
+                                                    noise_strength=0.1, drift=0, period=10, fileVal=1.0, verbose=0)
+
+        results['noise.generateNoise.' + noiseType] = timeCall(legacy, args.number)
+
+    parser = argparse.ArgumentParser()
+    noiseengine.addNoiseArguments(parser)
+    for noiseType in noiseengine.NOISE_TYPES:
+        options = parser.parse_args(['--noise-type', noiseType, '--seed', '1'])
+        engine = noiseengine.fromArgs(options, 0.1)
+        results['noise.engine.' + noiseType] = timeCall(engine.next, args.number)
+    return results
+
+
+def benchLogging(args, directory: Path) -> dict:
+    import telemetry
+    from pidcontroller import NORMAL_COLUMNS
+
+    results = {}
+    row = (0.1, 1.0, 1.1, 0.01, 2.5, 2.49)
+    rows = args.number * 10
+    for fmt in ('csv', 'bin'):
+        path = directory / ('bench.' + fmt)
+        logger = telemetry.TelemetryLogger(path, NORMAL_COLUMNS, header='benchmark\n', fmt=fmt)
+        start = perf_counter_ns()
+        for _ in range(rows):
+            logger.log(*row)
+        logged = perf_counter_ns()
+        # includes writing everything to the file
+        logger.close()
+        done = perf_counter_ns()
+        results['logging.' + fmt + '.call'] = {'value': (logged - start) / rows / 1e3, 'unit': 'us', 'better': 'lower'}
+        results['logging.' + fmt + '.throughput'] = rate(rows / ((done - start) / 1e9), 'rows/s')
+        os.remove(path)
+    return results
+
+
+def benchPlot(args) -> dict:
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return {'plot': {'skipped': 'matplotlib is not installed'}}
+    import renderer
+    from ringbuffer import RingBuffer
+
+    results = {}
+    # the loop side, the drawing happens in another process
+    os.environ['MPLBACKEND'] = 'Agg'
+    plot = renderer.LivePlot('benchmark', ['a', 'b'], fps=10)
+    counter = [0]
+
+    def publish():
+        counter[0] = counter[0] + 1
+        plot.publish(counter[0], (1.0, 2.0))
+
+    results['plot.publish'] = timeCall(publish, min(args.number, renderer.QUEUE_LEN // 5), repeat=5)
+    plot.close()
+
+    # the renderer side, one frame with 1000 points per line
+    fig, ax = plt.subplots()
+    lines = [ax.plot([], [], animated=True)[0] for _ in range(2)]
+    history = RingBuffer(1000, 3)
+    for k in range(1000):
+        history.append((k, np.sin(k / 50), np.cos(k / 50)))
+    ax.set_xlim(0, 1000)
+    ax.set_ylim(-1.5, 1.5)
+    fig.canvas.draw()
+    background = fig.canvas.copy_from_bbox(fig.bbox)
+
+    def frame():
+        history.append((history.view()[-1, 0] + 1, 0.0, 0.0))
+        data = history.decimated(2000)
+        for i, line in enumerate(lines):
+            line.set_data(data[:, 0], data[:, i + 1])
+        fig.canvas.restore_region(background)
+        for line in lines:
+            ax.draw_artist(line)
+        fig.canvas.blit(fig.bbox)
+
+    results['plot.frame.blit'] = timeCall(frame, 50, repeat=3)
+    results['plot.frame.full'] = timeCall(fig.canvas.draw, 10, repeat=3)
+    plt.close(fig)
+    return results
+
+
+def benchStartup(args) -> dict:
+    results = {}
+    env = dict(os.environ, PYTHONPATH=str(HERE))
+    # the interpreter alone, the baseline of every entry point
+    runs = []
+    for _ in range(args.startup_runs):
+        start = perf_counter_ns()
+        subprocess.run([sys.executable, '-c', 'pass'], env=env, check=True)
+        runs.append((perf_counter_ns() - start) / 1e6)
+    runs.sort()
+    results['startup.python'] = {'value': runs[0], 'median': runs[len(runs) // 2], 'unit': 'ms', 'better': 'lower'}
+
+    for name in ENTRY_POINTS:
+        runs = []
+        for _ in range(args.startup_runs):
+            start = perf_counter_ns()
+            process = subprocess.run([sys.executable, str(HERE / (name + '.py')), '--help'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            runs.append((perf_counter_ns() - start) / 1e6)
+        if process.returncode != 0:
+            results['startup.' + name] = {'skipped': process.stderr.strip()[-200:]}
+            continue
+        runs.sort()
+        # heavy modules loaded by the import alone
+        check = 'import sys, ' + name + '; print(",".join(m for m in ' + repr(HEAVY_MODULES) + ' if m in sys.modules))'
+        loaded = subprocess.run([sys.executable, '-c', check], env=env, capture_output=True, text=True).stdout.strip()
+        results['startup.' + name] = {'value': runs[0], 'median': runs[len(runs) // 2], 'unit': 'ms', 'better': 'lower',
+                                      'heavy': [m for m in loaded.split(',') if m != '']}
+    return results
+
+
+def runFor(command, duration: float, directory: Path, env=None) -> str:
+    """
+    Runs a script for duration seconds, stops it like Ctrl-C and returns its output.
+    """
+    process = subprocess.Popen(command, cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+    sleep(duration)
+    process.send_signal(signal.SIGINT)
+    try:
+        output, _ = process.communicate(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        output, _ = process.communicate()
+    return output
+
+
+def loopRate(output: str) -> float:
+    # the scheduler summary printed on exit
+    match = re.search(r'cycles: \d+, rate: ([0-9.]+) Hz', output)
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+def benchLoop(args, directory: Path) -> dict:
+    results = {}
+    env = dict(os.environ, PYTHONPATH=str(HERE))
+    for channel in ('file', 'shm'):
+        environment = subprocess.Popen([sys.executable, str(HERE / 'randomNoise.py'), 'debug', '-f', 'benchEnv.txt', '--channel', channel, '--delay', '0'],
+                                       cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+        sleep(1)
+        output = runFor([sys.executable, str(HERE / 'pidcontroller.py'), 'debug', '-f', 'benchEnv.txt', '--channel', channel, '-D', '0'], args.duration, directory, env)
+        environment.send_signal(signal.SIGINT)
+        environment.wait(timeout=10)
+        achieved = loopRate(output)
+        if achieved is None:
+            results['loop.debug.' + channel] = {'skipped': 'no loop summary: ' + output.strip()[-200:]}
+        else:
+            results['loop.debug.' + channel] = rate(achieved, 'Hz')
+
+    results.update(benchNormal(args, directory, env))
+    return results
+
+
+def benchNormal(args, directory: Path, env: dict) -> dict:
+    if shutil.which('softIoc') is None:
+        return {'loop.normal': {'skipped': 'softIoc is not installed'}}
+    try:
+        import pvio
+    except ImportError:
+        return {'loop.normal': {'skipped': 'pyepics is not installed'}}
+
+    # keep channel access on this host
+    os.environ['EPICS_CA_ADDR_LIST'] = 'localhost'
+    os.environ['EPICS_CA_AUTO_ADDR_LIST'] = 'NO'
+    env = dict(env, EPICS_CA_ADDR_LIST='localhost', EPICS_CA_AUTO_ADDR_LIST='NO')
+    # stdin stays open, softIoc exits at the end of its input
+    ioc = subprocess.Popen(['softIoc', '-m', 'P=BENCH', '-d', str(HERE / 'testioc.db')], cwd=directory, stdin=subprocess.PIPE,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+    results = {}
+    try:
+        sleep(1)
+        name = 'BENCH' + pvio.OUT_CUR
+        group = pvio.PVGroup([name])
+        if len(group.connect()) > 0:
+            return {'loop.normal': {'skipped': 'could not connect to the softIoc'}}
+        latencies = np.array(pvio.measureLatency(group, name, min(args.number, 1000))) * 1e6
+        results['loop.normal.ca_roundtrip'] = {'value': float(np.median(latencies)), 'p99': float(np.percentile(latencies, 99)),
+                                               'unit': 'us', 'better': 'lower'}
+        group.close()
+
+        with open(directory / 'position.txt', 'w') as f:
+            f.write('1.0')
+        output = runFor([sys.executable, str(HERE / 'pidcontroller.py'), 'normal', '--pv', 'BENCH', '-D', '0'], args.duration, directory, env)
+        achieved = loopRate(output)
+        if achieved is None:
+            results['loop.normal'] = {'skipped': 'no loop summary: ' + output.strip()[-200:]}
+        else:
+            results['loop.normal'] = rate(achieved, 'Hz')
+    finally:
+        ioc.stdin.close()
+        ioc.terminate()
+        ioc.wait(timeout=10)
+    return results
+
+
+def gitCommit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def metadata() -> dict:
+    return {'version': ver, 'commit': gitCommit(), 'time': time(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def compareResults(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Returns the names of the benchmarks that got worse than the baseline by more than threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None or 'value' not in result or 'value' not in old or old['value'] == 0:
+            continue
+        ratio = result['value'] / old['value']
+        if result['better'] == 'lower':
+            worse = ratio > 1 + threshold
+        else:
+            worse = ratio < 1 - threshold
+        print(name + ': ' + str(round(ratio, 3)) + 'x of the baseline' + (' REGRESSION' if worse else ''))
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('groups', type=str, nargs='*', default=[], help='the benchmarks to run (' + ', '.join(GROUPS) + '), all by default')
+    parser.add_argument('-n', '--number', type=int, default=10000, help='calls per measurement of the micro benchmarks. The default is 10000')
+    parser.add_argument('--startup-runs', type=int, default=10, help='starts of every entry point, the fastest counts. The default is 10')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds each loop benchmark runs. The default is 3')
+    parser.add_argument('-o', '--output', type=str, default=None, help='writes the results to this json file')
+    parser.add_argument('--compare', type=str, default=None, help='json results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change that counts as a regression. The default is 0.2')
+    parser.add_argument('--version', action='version', version=ver)
+    args = parser.parse_args()
+
+    groups = args.groups or GROUPS
+    for group in groups:
+        if group not in GROUPS:
+            print('Unknown benchmark ' + group + ', choose from ' + ', '.join(GROUPS) + '\nExiting...')
+            exit(1)
+    sys.path.insert(0, str(HERE))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        for group in groups:
+            print('Running ' + group + ' benchmarks...')
+            if group == 'pid':
+                found = benchPid(args)
+            elif group == 'debug':
+                found = benchDebug(args, directory)
+            elif group == 'noise':
+                found = benchNoise(args)
+            elif group == 'logging':
+                found = benchLogging(args, directory)
+            elif group == 'plot':
+                found = benchPlot(args)
+            elif group == 'startup':
+                found = benchStartup(args)
+            else:
+                found = benchLoop(args, directory)
+            for name, result in found.items():
+                if 'skipped' in result:
+                    print('    ' + name + ': skipped, ' + result['skipped'])
+                else:
+                    print('    ' + name + ': ' + str(round(result['value'], 3)) + ' ' + result['unit']
+                          + (', loads ' + ', '.join(result['heavy']) if result.get('heavy') else ''))
+            results.update(found)
+
+    report = {'meta': metadata(), 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print('Results written to ' + args.output)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compareResults(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            print(str(len(regressions)) + ' regressions: ' + ', '.join(regressions))
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
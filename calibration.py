@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+"""
+Calibration of the position response to the steerer currents.
+
+The measurement (randomNoise.py measure) records the steerer currents and the averaged
+BPM positions at a number of operating points. fitResponse solves
+    positions = R currents + offset + drift * time
+for all BPMs at once with one least squares fit, R is the response matrix in position
+units per ampere. The result is stored in a versioned json file, which pidcontroller.py
+loads with --calibration and which can be used directly as the response matrix of the
+mimo mode:
+    {"version": 1, "created": ..., "bpms": [{"name": ..., "source": ...}], "steerers": [...],
+     "matrix": [[...]], "offset": [...], "drift": [...], "residual": [...], "points": ...}
+
+MockPlant stands in for the steerers and BPMs, so the measurement can be tested
+without the accelerator.
+"""
+import json
+from time import monotonic, time
+import numpy as np
+
+VERSION = 1
+
+
+def fitResponse(currents: np.ndarray, positions: np.ndarray, times: np.ndarray = None):
+    """
+    currents is (points x steerers), positions (points x BPMs). Returns (matrix, offset,
+    drift, residual), drift is zero without times and residual is the rms per BPM.
+    """
+    currents = np.asarray(currents, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    columns = [currents, np.ones((len(currents), 1))]
+    if times is not None:
+        columns.append(np.asarray(times, dtype=float).reshape(-1, 1) - times[0])
+    design = np.hstack(columns)
+    if len(design) < design.shape[1]:
+        raise ValueError('at least ' + str(design.shape[1]) + ' operating points are needed, got ' + str(len(design)))
+    solution, _, rank, _ = np.linalg.lstsq(design, positions, rcond=None)
+    if rank < design.shape[1]:
+        raise ValueError('the operating points do not determine the response, every steerer has to be changed on its own')
+    steerers = currents.shape[1]
+    matrix = solution[:steerers].T
+    offset = solution[steerers]
+    drift = solution[steerers + 1] if times is not None else np.zeros(positions.shape[1])
+    residual = np.sqrt(np.mean((design @ solution - positions) ** 2, axis=0))
+    return matrix, offset, drift, residual
+
+
+def saveCalibration(path, bpms, steerers, matrix, offset, drift, residual, **extra):
+    calibration = {'version': VERSION, 'created': time(), 'bpms': bpms, 'steerers': steerers,
+                   'matrix': np.asarray(matrix).tolist(), 'offset': np.asarray(offset).tolist(),
+                   'drift': np.asarray(drift).tolist(), 'residual': np.asarray(residual).tolist()}
+    calibration.update(extra)
+    with open(path, 'w') as f:
+        json.dump(calibration, f, indent=4)
+
+
+def loadCalibration(path) -> dict:
+    with open(path, 'r') as f:
+        calibration = json.load(f)
+    version = calibration.get('version')
+    if not isinstance(version, int) or version > VERSION:
+        raise ValueError('unsupported calibration version ' + str(version) + ', this version reads up to ' + str(VERSION))
+    return calibration
+
+
+def coefficient(calibration: dict, steerer: str, source: str) -> float:
+    """
+    The deltaI coefficient of pidcontroller.py (current change per position change,
+    applied with the opposite sign) of one steerer for the BPM read from source.
+    """
+    steerers = calibration['steerers']
+    if steerer not in steerers:
+        raise ValueError('the calibration has no steerer ' + str(steerer) + ', only ' + ', '.join(steerers))
+    sources = [bpm['source'] for bpm in calibration['bpms']]
+    if source not in sources:
+        raise ValueError('the calibration has no BPM read from ' + str(source) + ', only ' + ', '.join(sources))
+    response = calibration['matrix'][sources.index(source)][steerers.index(steerer)]
+    if response == 0:
+        raise ValueError('the position from ' + source + ' doesn\'t respond to ' + steerer)
+    return -1 / response
+
+
+class MockPlant:
+    """
+    Steerers and BPMs of a simulated machine: positions = base + R (currents - start) + noise.
+    Provides the parts of pvio.PVGroup and positionsource.PositionSource the measurement uses.
+    """
+    def __init__(self, matrix, steerers, start: float = 0.0, noise: float = 0.0, drift: float = 0.0, seed: int = None):
+        self.matrix = np.asarray(matrix, dtype=float)
+        self.steerers = list(steerers)
+        self.start = np.full(len(self.steerers), float(start))
+        self.currents = self.start.copy()
+        self.noise = noise
+        self.drift = drift
+        self.rng = np.random.default_rng(seed)
+        self.startTime = monotonic()
+        self.sequence = 0
+
+    def index(self, name: str) -> int:
+        return self.steerers.index(name.split(':')[0])
+
+    def connect(self, timeout: float = None) -> list:
+        return []
+
+    def get(self, name: str) -> float:
+        return float(self.currents[self.index(name)])
+
+    def getMany(self, names) -> list:
+        return [self.get(name) for name in names]
+
+    def put(self, name: str, value, flush: bool = True):
+        self.currents[self.index(name)] = value
+
+    def putMany(self, values: dict):
+        for name, value in values.items():
+            self.put(name, value)
+
+    def positions(self) -> np.ndarray:
+        self.sequence = self.sequence + 1
+        drift = self.drift * (monotonic() - self.startTime)
+        return self.matrix @ (self.currents - self.start) + drift + self.noise * self.rng.normal(size=len(self.matrix))
+
+    def sources(self) -> list:
+        return [MockSource(self, i) for i in range(len(self.matrix))]
+
+    def close(self):
+        pass
+
+
+class MockSource:
+    """
+    One BPM of a MockPlant, every wait() returns a new measurement.
+    """
+    def __init__(self, plant: MockPlant, index: int):
+        self.plant = plant
+        self.index = index
+        self.sample = None
+
+    def wait(self, timeout: float):
+        self.sample = (float(self.plant.positions()[self.index]), self.plant.sequence, time())
+        return self.sample
+
+    poll = wait
+
+    def value(self) -> float:
+        return self.sample[0]
+
+    def stale(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+
+def mockMatrix(bpms: int, steerers: int, scale: float) -> np.ndarray:
+    # every steerer acts most on its own BPM and less on the others
+    rows = np.arange(bpms).reshape(-1, 1)
+    cols = np.arange(steerers).reshape(1, -1)
+    return scale * 0.5 ** np.abs(rows - cols)
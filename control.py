@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+"""
+Live parameter changes for a running control loop.
+
+The loop polls its control sources once per cycle, between two steps, and applies new
+gains, niveau and delay without resetting the PID controller. The integrator keeps its
+state, so a retune doesn't cause a jump of the output. A new delay redesigns the input
+filters and the derivative filter for the new loop rate. Every change is written to the log.
+
+Two sources are supported:
+- a watched json file, e.g. {"kp": 0.4, "ki": 0.2, "niveau": 1.1}. Its contents are applied
+  whenever it is modified after the loop started.
+- a UNIX socket that takes one json command per line, like runtime.py:
+    {"cmd": "status"}
+    {"cmd": "gains", "kp": 0.4, "ki": 0.2, "kd": 0, "niveau": 1.1, "delay": 0.05}
+
+Run as a script it is a small client for these sockets.
+"""
+import argparse
+import json
+import os
+import socket
+from pathlib import Path
+import filters
+
+PARAMETERS = ('kp', 'ki', 'kd', 'niveau', 'delay')
+# the names used on the command line of pidcontroller.py
+ARGUMENTS = {'kp': 'proportional', 'ki': 'integral', 'kd': 'derivative', 'niveau': 'niveau', 'delay': 'delay'}
+
+
+def parseChanges(request: dict) -> dict:
+    changes = {}
+    for key, value in request.items():
+        if key in ('cmd', 'loop'):
+            continue
+        if key not in PARAMETERS:
+            raise ValueError('unknown parameter ' + str(key))
+        if value is None:
+            continue
+        changes[key] = float(value)
+    if changes.get('delay', 0) < 0:
+        raise ValueError('the delay can\'t be negative')
+    return changes
+
+
+class ControlFile:
+    def __init__(self, path):
+        self.path = Path(path)
+        # only modifications made after the start are applied
+        self.stamp = self.modified()
+
+    def modified(self):
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self) -> list:
+        stamp = self.modified()
+        if stamp is None or stamp == self.stamp:
+            return []
+        self.stamp = stamp
+        try:
+            with open(self.path, 'r') as f:
+                request = json.load(f)
+        except (OSError, ValueError) as e:
+            # most likely caught in the middle of a write, the next modification is read again
+            print('Could not read the control file ' + str(self.path) + ': ' + str(e))
+            return []
+        if not isinstance(request, dict):
+            print('The control file ' + str(self.path) + ' has to contain a json object')
+            return []
+        request['cmd'] = 'gains'
+        return [(request, None)]
+
+    def reply(self, client, reply: dict):
+        if 'error' in reply:
+            print('Control file ' + str(self.path) + ': ' + reply['error'])
+
+    def close(self):
+        pass
+
+
+class ControlSocket:
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.exists(path):
+            # left over from a previous run
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        self.server.setblocking(False)
+        # client socket -> bytes received after the last complete line
+        self.clients = {}
+
+    def poll(self) -> list:
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except BlockingIOError:
+                break
+            client.setblocking(False)
+            self.clients[client] = b''
+
+        requests = []
+        for client in list(self.clients):
+            try:
+                data = client.recv(4096)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                self.drop(client)
+                continue
+            *lines, self.clients[client] = (self.clients[client] + data).split(b'\n')
+            for line in lines:
+                if line.strip() == b'':
+                    continue
+                try:
+                    requests.append((json.loads(line), client))
+                except ValueError as e:
+                    self.reply(client, {'error': str(e)})
+        return requests
+
+    def reply(self, client, reply: dict):
+        try:
+            client.sendall(json.dumps(reply).encode() + b'\n')
+        except OSError:
+            self.drop(client)
+
+    def drop(self, client):
+        self.clients.pop(client, None)
+        client.close()
+
+    def close(self):
+        for client in list(self.clients):
+            self.drop(client)
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ControlInterface:
+    def __init__(self, pid, loop, args, logger=None, sources=None, inputFilter=None, verbose: int = 0):
+        """
+        pid is the VectorPID of the loop, loop its LoopScheduler and inputFilter its
+        filters.FilterChain. The values in args are kept up to date, so the rest of the
+        loop (e.g. the plot) sees the new niveau.
+        """
+        self.pid = pid
+        self.loop = loop
+        self.inputFilter = inputFilter
+        self.args = args
+        self.logger = logger
+        self.sources = list(sources or [])
+        self.verbose = verbose
+        self.changes = 0
+
+    def poll(self):
+        for source in self.sources:
+            for request, client in source.poll():
+                source.reply(client, self.command(request))
+
+    def command(self, request: dict) -> dict:
+        cmd = request.get('cmd')
+        if cmd == 'status':
+            return self.status()
+        elif cmd == 'gains':
+            try:
+                changes = parseChanges(request)
+                self.apply(changes)
+            except (TypeError, ValueError) as e:
+                return {'error': str(e)}
+            return {'ok': True}
+        return {'error': 'unknown command ' + str(cmd)}
+
+    def apply(self, changes: dict):
+        if len(changes) == 0:
+            return
+        if 'delay' in changes:
+            # first, a filter that can't run at the new rate rejects the whole change
+            self.retime(changes['delay'])
+            self.loop.setPeriod(changes['delay'])
+        self.pid.setGains(changes.get('kp'), changes.get('ki'), changes.get('kd'))
+        if 'niveau' in changes:
+            self.pid.setpoint[:] = changes['niveau']
+        for key, value in changes.items():
+            setattr(self.args, ARGUMENTS[key], value)
+        self.changes = self.changes + 1
+
+        # the time since the start of the loop, like the time column of the log
+        text = 'time: ' + str(self.loop.elapsed()) + ', cycle: ' + str(self.loop.cycles) + ', set ' + ', '.join(key + ': ' + str(value) for key, value in changes.items())
+        if self.logger is not None:
+            self.logger.note(text)
+        if self.verbose >= 1:
+            print(text)
+
+    def retime(self, period: float):
+        # the filters were designed for the old delay, they keep their cutoffs at the new one
+        if self.inputFilter is not None and self.args.filter_rate is None and period > 0:
+            self.inputFilter.setRate(1 / period)
+        if self.pid.derivativeFilter is not None and self.args.delay > 0 and period > 0:
+            self.pid.derivativeFilter = filters.rescaleAlpha(self.pid.derivativeFilter, self.args.delay, period)
+
+    def status(self) -> dict:
+        status = {key: getattr(self.args, ARGUMENTS[key]) for key in PARAMETERS}
+        status['cycles'] = self.loop.cycles
+        status['overruns'] = self.loop.overruns
+        status['changes'] = self.changes
+        return status
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+
+
+def addControlArguments(parser):
+    group = parser.add_argument_group('live control options')
+    group.add_argument('--control-file', type=str, default=None, help='json file with new parameters (kp, ki, kd, niveau, delay) that are applied whenever the file is modified')
+    group.add_argument('--control-socket', type=str, default=None, help='UNIX socket that accepts status and gains commands, see control.py')
+    return group
+
+
+def fromArgs(args, pid, loop, logger=None, inputFilter=None) -> ControlInterface:
+    """
+    Returns None if neither --control-file nor --control-socket is used.
+    """
+    sources = []
+    if args.control_file is not None:
+        sources.append(ControlFile(args.control_file))
+    if args.control_socket is not None:
+        sources.append(ControlSocket(args.control_socket))
+    if len(sources) == 0:
+        return None
+    return ControlInterface(pid, loop, args, logger=logger, sources=sources, inputFilter=inputFilter, verbose=args.verbose)
+
+
+def send(path: str, request: dict, timeout: float = 5.0) -> dict:
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    client.connect(path)
+    client.sendall(json.dumps(request).encode() + b'\n')
+    reply = b''
+    while not reply.endswith(b'\n'):
+        data = client.recv(4096)
+        if not data:
+            break
+        reply = reply + data
+    client.close()
+    return json.loads(reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sends a command to the control socket of pidcontroller.py or runtime.py')
+    parser.add_argument('socket', type=str, help='path of the control socket')
+    parser.add_argument('cmd', type=str, choices=['status', 'gains', 'start', 'stop'], help='start and stop are only understood by runtime.py')
+    parser.add_argument('--loop', type=str, default=None, help='the loop of runtime.py the command is meant for')
+    parser.add_argument('-p', '--kp', type=float, default=None, help='new proportional coefficient')
+    parser.add_argument('-i', '--ki', type=float, default=None, help='new integral coefficient')
+    parser.add_argument('-d', '--kd', type=float, default=None, help='new derivative coefficient')
+    parser.add_argument('-n', '--niveau', type=float, default=None, help='new niveau')
+    parser.add_argument('-D', '--delay', type=float, default=None, help='new period of the loop in seconds')
+    args = parser.parse_args()
+
+    request = {'cmd': args.cmd}
+    if args.loop is not None:
+        request['loop'] = args.loop
+    if args.cmd == 'gains':
+        for key in PARAMETERS:
+            if getattr(args, key) is not None:
+                request[key] = getattr(args, key)
+    try:
+        reply = send(args.socket, request)
+    except OSError as e:
+        print('Could not reach ' + args.socket + ': ' + str(e))
+        exit()
+    print(json.dumps(reply, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+"""
+Shared memory transport for the debug enviroment.
+
+Replaces the debugEnv.txt handshake between randomNoise.py and pidcontroller.py.
+The segment holds one slot per writer (noise environment and controller). Every slot
+is a seqlock: the writer makes the sequence number odd, writes value and timestamp
+and makes it even again. A reader retries until it sees the same even sequence number
+before and after copying the data, so it never sees a torn or empty value.
+Reading the channel returns the most recently written slot, which gives the same
+"last writer wins" behaviour as the text file.
+"""
+from pathlib import Path
+import struct
+import time
+
+# writer roles, each role owns exactly one slot
+ENVIRONMENT = 0
+CONTROLLER = 1
+
+SLOT_COUNT = 2
+SLOT_SIZE = 32 # seq (uint64), value (double), timestamp (double), padding
+
+_seqFormat = struct.Struct('<Q')
+_dataFormat = struct.Struct('<dd')
+
+
+def channelName(debugFile: str) -> str:
+    # derive the shared memory name from the debug file so both scripts agree on it
+    return 'pid-' + Path(debugFile).stem
+
+
+class DebugChannel:
+    def __init__(self, shm, role: int, owner: bool):
+        self.shm = shm
+        self.buf = shm.buf
+        self.role = role
+        self.owner = owner
+        self.offset = role * SLOT_SIZE
+        self.seq = _seqFormat.unpack_from(self.buf, self.offset)[0]
+
+    def write(self, value: float):
+        off = self.offset
+        seq = self.seq + 1
+        if seq % 2 == 0:
+            seq = seq + 1
+        # odd sequence number marks the slot as being written
+        _seqFormat.pack_into(self.buf, off, seq)
+        _dataFormat.pack_into(self.buf, off + 8, float(value), time.monotonic())
+        _seqFormat.pack_into(self.buf, off, seq + 1)
+        self.seq = seq + 1
+
+    def readSlot(self, slot: int):
+        off = slot * SLOT_SIZE
+        buf = self.buf
+        while True:
+            seq1 = _seqFormat.unpack_from(buf, off)[0]
+            if seq1 % 2 == 1:
+                continue
+            value, timestamp = _dataFormat.unpack_from(buf, off + 8)
+            seq2 = _seqFormat.unpack_from(buf, off)[0]
+            if seq1 == seq2:
+                return value, seq1 // 2, timestamp
+
+    def read(self):
+        """
+        Returns (value, sequence, timestamp) of the latest write of any writer.
+        The sequence number counts all writes to the channel.
+        Returns None if the channel was never written.
+        """
+        best = None
+        sequence = 0
+        for slot in range(SLOT_COUNT):
+            value, seq, timestamp = self.readSlot(slot)
+            sequence = sequence + seq
+            if seq > 0 and (best is None or timestamp >= best[1]):
+                best = (value, timestamp)
+        if best is None:
+            return None
+        return best[0], sequence, best[1]
+
+    def readValue(self) -> float:
+        return self.read()[0]
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def createChannel(debugFile: str, initial: float = 1.0, role: int = ENVIRONMENT) -> DebugChannel:
+    # multiprocessing is only imported when the shared memory transport is used
+    from multiprocessing import shared_memory
+    name = channelName(debugFile)
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=SLOT_COUNT * SLOT_SIZE)
+    except FileExistsError:
+        # left over from a crashed run
+        old = shared_memory.SharedMemory(name=name)
+        old.close()
+        old.unlink()
+        shm = shared_memory.SharedMemory(name=name, create=True, size=SLOT_COUNT * SLOT_SIZE)
+    shm.buf[:SLOT_COUNT * SLOT_SIZE] = bytes(SLOT_COUNT * SLOT_SIZE)
+    channel = DebugChannel(shm, role=role, owner=True)
+    channel.write(initial)
+    return channel
+
+
+def attachChannel(debugFile: str, role: int = CONTROLLER) -> DebugChannel:
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=channelName(debugFile))
+    try:
+        # only the creator may unlink the segment. Before python 3.13 the resource
+        # tracker would otherwise remove it when the attaching process exits
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    channel = DebugChannel(shm, role=role, owner=False)
+    if channel.read() is None:
+        channel.close()
+        raise FileNotFoundError('the debug channel ' + channelName(debugFile) + ' was never written')
+    return channel
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+"""
+Feed-forward compensation of periodic disturbances.
+
+The PID controller only reacts to a periodic disturbance (e.g. the sine noise of
+randomNoise.py or 50 Hz mains) after it moved the position. The feed-forward stage
+learns the periodic part online and removes it before it shows up.
+
+Every correction moves the position by the commanded shift, so the disturbance is
+observed as the position minus the sum of all shifts applied so far. Its change between
+two cycles is fitted, not its level, which keeps random walk noise from biasing the
+estimate. Two estimators are available, both with one state per channel:
+    HarmonicEstimator   normalized LMS on sin/cos of the fundamental and its harmonics,
+                        locks to the phase and amplitude of a known period
+    PhaseTable          repetitive control, one learned disturbance rate per phase bin
+                        of the period, also follows non sinusoidal shapes
+Each cycle the predicted disturbance change until the next cycle is subtracted from the
+PID output.
+If the write can be limited, confirm() feeds back the shift that was actually applied.
+While the actuator is moved by something else, pause() keeps the moves out of the estimate.
+"""
+import numpy as np
+
+KINDS = ['none', 'harmonic', 'table']
+
+
+class HarmonicEstimator:
+    def __init__(self, period: float, harmonics: int = 1, gain: float = 0.05, channels: int = 1):
+        self.omega = 2 * np.pi / period * np.arange(1, harmonics + 1)
+        # a constant rate as well, so a drift doesn't leak into the harmonics
+        self.weights = np.zeros((channels, 2 * harmonics + 1))
+        self.gain = gain
+
+    def regressors(self, t: float, h: float) -> np.ndarray:
+        # change of every basis function between t and t + h
+        start = self.omega * t
+        end = self.omega * (t + h)
+        return np.concatenate(([h], np.sin(end) - np.sin(start), np.cos(end) - np.cos(start)))
+
+    def update(self, t: float, h: float, change: np.ndarray):
+        """
+        change is the observed disturbance change between t and t + h of every channel.
+        """
+        phi = self.regressors(t, h)
+        error = change - self.weights @ phi
+        self.weights += np.outer(error, phi * (self.gain / (phi @ phi + 1e-12)))
+
+    def predict(self, t: float, h: float) -> np.ndarray:
+        return self.weights @ self.regressors(t, h)
+
+    def amplitude(self) -> np.ndarray:
+        # amplitude of every harmonic (channels x harmonics)
+        n = len(self.omega)
+        return np.hypot(self.weights[:, 1:n + 1], self.weights[:, n + 1:])
+
+
+class PhaseTable:
+    def __init__(self, period: float, bins: int = 50, gain: float = 0.1, channels: int = 1):
+        self.period = period
+        self.bins = bins
+        self.gain = gain
+        # disturbance change per second in every bin
+        self.rates = np.zeros((channels, bins))
+
+    def bin(self, t: float) -> int:
+        return int((t % self.period) / self.period * self.bins) % self.bins
+
+    def update(self, t: float, h: float, change: np.ndarray):
+        # the interval is assigned to the bin of its middle
+        b = self.bin(t + h / 2)
+        self.rates[:, b] += self.gain * (change / h - self.rates[:, b])
+
+    def predict(self, t: float, h: float) -> np.ndarray:
+        return self.rates[:, self.bin(t + h / 2)] * h
+
+
+class FeedForward:
+    def __init__(self, estimator, channels: int = 1, outputLimits=(None, None)):
+        self.estimator = estimator
+        self.applied = np.zeros(channels)
+        self.lower = -np.inf if outputLimits[0] is None else outputLimits[0]
+        self.upper = np.inf if outputLimits[1] is None else outputLimits[1]
+        self.lastTime = None
+        self.lastDisturbance = np.zeros(channels)
+        self.interval = None
+        self.output = np.zeros(channels)
+
+    def step(self, t: float, position, u) -> np.ndarray:
+        """
+        Takes the measured position and the PID output at time t (seconds) and returns
+        the shift that is applied, the PID output minus the predicted disturbance change.
+        The returned array is reused by the next step.
+        """
+        disturbance = position - self.applied
+        if self.lastTime is not None and t > self.lastTime:
+            h = t - self.lastTime
+            self.estimator.update(self.lastTime, h, disturbance - self.lastDisturbance)
+            # the next cycle is expected to take as long as the last one
+            self.interval = h
+        self.lastTime = t
+        self.lastDisturbance[:] = disturbance
+
+        self.output[:] = u
+        if self.interval is not None:
+            self.output -= self.estimator.predict(t, self.interval)
+        np.clip(self.output, self.lower, self.upper, out=self.output)
+        self.applied += self.output
+        return self.output
+
+    def confirm(self, shift):
+        """
+        Replaces the shift of the last step by the one that actually reached the actuator,
+        e.g. after the watchdog limited the write. Otherwise the learned disturbance drifts.
+        """
+        self.applied += shift - self.output
+        self.output[:] = shift
+
+    def pause(self):
+        """
+        Called while the actuator is moved by something else, e.g. the watchdog holding or
+        ramping the current. The next step starts a new interval instead of learning the
+        position change of those moves as disturbance.
+        """
+        self.lastTime = None
+        self.interval = None
+
+    def __call__(self, t: float, position, u):
+        # scalar convenience for single channel loops
+        out = self.step(t, position, u)
+        if np.ndim(position) == 0 and len(out) == 1:
+            return float(out[0])
+        return out
+
+
+def create(kind: str, period: float, harmonics: int = 1, gain: float = 0.05, bins: int = 50, channels: int = 1, outputLimits=(None, None)) -> FeedForward:
+    if kind == 'none':
+        return None
+    if kind == 'harmonic':
+        estimator = HarmonicEstimator(period, harmonics=harmonics, gain=gain, channels=channels)
+    elif kind == 'table':
+        estimator = PhaseTable(period, bins=bins, gain=gain, channels=channels)
+    else:
+        raise ValueError('unknown feed-forward ' + kind + ', use ' + ', '.join(KINDS))
+    return FeedForward(estimator, channels=channels, outputLimits=outputLimits)
+
+
+def addFeedForwardArguments(parser):
+    group = parser.add_argument_group('feed-forward options')
+    group.add_argument('--feedforward', type=str, choices=KINDS, default='none', help='learns a periodic disturbance and compensates it before the PID controller sees it. "harmonic" fits sine waves, "table" learns one value per phase. The default is "none"')
+    group.add_argument('--ff-period', type=float, default=10, help='period of the disturbance in seconds, 0.02 for 50 Hz. The default is 10 like the sine noise of randomNoise.py')
+    group.add_argument('--ff-harmonics', type=int, default=1, help='number of harmonics fitted by "harmonic". The default is 1')
+    group.add_argument('--ff-bins', type=int, default=50, help='number of phase bins of "table". The default is 50')
+    group.add_argument('--ff-gain', type=float, default=0.05, help='adaption gain of the estimator, between 0 and 1. The default is 0.05')
+    return group
+
+
+def settingsFromArgs(args) -> dict:
+    return {'kind': args.feedforward, 'period': args.ff_period, 'harmonics': args.ff_harmonics, 'gain': args.ff_gain, 'bins': args.ff_bins}
+
+
+def fromArgs(args, channels: int = 1) -> FeedForward:
+    return create(channels=channels, outputLimits=(args.min, args.max), **settingsFromArgs(args))
@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+"""
+Input filters for the measured position.
+
+Every filter keeps its state in preallocated NumPy arrays with one entry per channel,
+so a sample costs the same however long the loop runs. Filters are chained in the
+order they are given with --filter:
+    ema:ALPHA               exponential moving average, y += alpha (x - y)
+    median:N                median of the last N samples
+    hampel:N[:K]            replaces samples further than K (default 3) scaled median
+                            absolute deviations from the median of the last N samples
+    lowpass:F[:Q]           RBJ biquad low-pass at F Hz, Q defaults to 0.707 (Butterworth)
+    notch:F[:Q]             RBJ biquad notch at F Hz, e.g. notch:50 for sinenoise.py, Q defaults to 10
+The biquads need the sample rate, which is the loop rate (1 / --delay) or --filter-rate.
+When the delay is changed while the loop runs, the biquads are redesigned for the new loop
+rate and the EMAs keep their time constant.
+"""
+import numpy as np
+
+KINDS = ['ema', 'median', 'hampel', 'lowpass', 'notch']
+
+# scales the median absolute deviation to the standard deviation of a normal distribution
+MAD_SCALE = 1.4826
+
+
+def rescaleAlpha(alpha: float, period: float, newPeriod: float) -> float:
+    # the alpha of an EMA with the same time constant at the new sample period
+    return 1 - (1 - alpha) ** (newPeriod / period)
+
+
+class EMA:
+    def __init__(self, alpha: float, channels: int = 1, rate: float = None):
+        if not 0 < alpha <= 1:
+            raise ValueError('the ema alpha has to be in (0, 1], not ' + str(alpha))
+        self.alpha = alpha
+        self.rate = rate
+        self.value = np.zeros(channels)
+        self.first = True
+
+    def setRate(self, rate: float):
+        # alpha belongs to the rate it was given for, the time constant is kept
+        if self.rate is not None:
+            self.alpha = rescaleAlpha(self.alpha, 1 / self.rate, 1 / rate)
+        self.rate = rate
+
+    def step(self, x) -> np.ndarray:
+        if self.first:
+            self.value[:] = x
+            self.first = False
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+class Median:
+    def __init__(self, window: int, channels: int = 1):
+        if window < 1:
+            raise ValueError('the window needs at least one sample')
+        self.window = np.zeros((channels, window))
+        # sorted copy of the window, np.median is several times slower for short windows
+        self.sorted = np.zeros((channels, window))
+        self.low = (window - 1) // 2
+        self.high = window // 2
+        self.index = 0
+        self.first = True
+        self.value = np.zeros(channels)
+
+    def push(self, x):
+        if self.first:
+            # a full window of the first sample, so the start has no transient
+            self.window[:] = np.reshape(x, (-1, 1))
+            self.first = False
+        else:
+            self.window[:, self.index] = x
+        self.index = (self.index + 1) % self.window.shape[1]
+
+    def median(self, values: np.ndarray) -> np.ndarray:
+        self.sorted[:] = values
+        self.sorted.sort(axis=1)
+        return (self.sorted[:, self.low] + self.sorted[:, self.high]) / 2
+
+    def step(self, x) -> np.ndarray:
+        self.push(x)
+        self.value[:] = self.median(self.window)
+        return self.value
+
+
+class Hampel(Median):
+    def __init__(self, window: int, threshold: float = 3.0, channels: int = 1):
+        super().__init__(window, channels)
+        self.threshold = threshold
+        self.rejected = 0
+        self.deviation = np.zeros((channels, window))
+
+    def step(self, x) -> np.ndarray:
+        self.push(x)
+        median = self.median(self.window)
+        np.subtract(self.window, median[:, None], out=self.deviation)
+        np.abs(self.deviation, out=self.deviation)
+        deviation = MAD_SCALE * self.median(self.deviation)
+        outlier = np.abs(x - median) > self.threshold * deviation
+        self.rejected = self.rejected + int(np.count_nonzero(outlier))
+        self.value[:] = np.where(outlier, median, x)
+        return self.value
+
+
+class Biquad:
+    """
+    Second order section in transposed direct form II, coefficients from the RBJ audio EQ cookbook.
+    """
+    def __init__(self, kind: str, frequency: float, rate: float, q: float = None, channels: int = 1):
+        if kind not in ('lowpass', 'notch'):
+            raise ValueError('unknown biquad ' + kind)
+        if q is None:
+            q = 0.7071 if kind == 'lowpass' else 10.0
+        self.kind = kind
+        self.frequency = frequency
+        self.q = q
+        self.setRate(rate)
+        self.z1 = np.zeros(channels)
+        self.z2 = np.zeros(channels)
+        self.value = np.zeros(channels)
+        self.first = True
+
+    def checkRate(self, rate: float):
+        if not 0 < self.frequency < rate / 2:
+            raise ValueError('the ' + self.kind + ' frequency has to be between 0 and half the sample rate (' + str(rate / 2) + ' Hz), not ' + str(self.frequency))
+
+    def setRate(self, rate: float):
+        # the state is kept, only the coefficients are designed for the new rate
+        self.checkRate(rate)
+        self.rate = rate
+        w0 = 2 * np.pi * self.frequency / rate
+        alpha = np.sin(w0) / (2 * self.q)
+        cos = np.cos(w0)
+        if self.kind == 'lowpass':
+            b = [(1 - cos) / 2, 1 - cos, (1 - cos) / 2]
+        else:
+            b = [1.0, -2 * cos, 1.0]
+        a0 = 1 + alpha
+        self.b0, self.b1, self.b2 = (c / a0 for c in b)
+        self.a1 = -2 * cos / a0
+        self.a2 = (1 - alpha) / a0
+
+    def step(self, x) -> np.ndarray:
+        if self.first:
+            # steady state of a constant input, both filters pass DC unchanged
+            self.z2[:] = (self.b2 - self.a2) * x
+            self.z1[:] = (1 - self.b0) * x
+            self.first = False
+        y = self.value
+        y[:] = self.b0 * x + self.z1
+        self.z1[:] = self.b1 * x - self.a1 * y + self.z2
+        self.z2[:] = self.b2 * x - self.a2 * y
+        return y
+
+
+class FilterChain:
+    def __init__(self, filters):
+        self.filters = list(filters)
+
+    def step(self, x) -> np.ndarray:
+        for f in self.filters:
+            x = f.step(x)
+        return x
+
+    def setRate(self, rate: float):
+        """
+        Redesigns the filters for a new sample rate, e.g. after the delay of the loop changed.
+        Raises a ValueError without changing anything if a biquad can't run at the rate.
+        """
+        for f in self.filters:
+            if isinstance(f, Biquad):
+                f.checkRate(rate)
+        for f in self.filters:
+            if hasattr(f, 'setRate'):
+                f.setRate(rate)
+
+    def __call__(self, x):
+        # scalar convenience for single channel loops
+        out = self.step(x)
+        if np.ndim(x) == 0 and len(out) == 1:
+            return float(out[0])
+        return out
+
+
+def parseSpec(spec: str, rate: float = None, channels: int = 1):
+    kind, _, rest = spec.partition(':')
+    values = [float(v) for v in rest.split(':') if v != '']
+    if kind not in KINDS:
+        raise ValueError('unknown filter ' + kind + ', use ' + ', '.join(KINDS))
+    if len(values) == 0:
+        raise ValueError(kind + ' needs a parameter, e.g. ' + kind + ':' + ('0.2' if kind == 'ema' else '5'))
+    if kind == 'ema':
+        return EMA(values[0], channels, rate)
+    if kind == 'median':
+        return Median(int(values[0]), channels)
+    if kind == 'hampel':
+        return Hampel(int(values[0]), *values[1:2], channels=channels)
+    if rate is None:
+        raise ValueError(kind + ' needs the sample rate, use --filter-rate with a free running loop')
+    return Biquad(kind, values[0], rate, *values[1:2], channels=channels)
+
+
+def create(specs, rate: float = None, channels: int = 1) -> FilterChain:
+    if len(specs) == 0:
+        return None
+    return FilterChain([parseSpec(spec, rate, channels) for spec in specs])
+
+
+def addFilterArguments(parser):
+    group = parser.add_argument_group('filter options')
+    group.add_argument('--filter', type=str, action='append', default=[], help='filters the measured position before the PID controller: ema:ALPHA, median:N, hampel:N[:K], lowpass:F[:Q] or notch:F[:Q]. Can be used multiple times, the filters are applied in order')
+    group.add_argument('--filter-rate', type=float, default=None, help='sample rate in Hz the biquads are designed for. The default is the loop rate 1 / --delay')
+    return group
+
+
+def fromArgs(args, period: float, channels: int = 1) -> FilterChain:
+    rate = args.filter_rate
+    if rate is None and period > 0:
+        rate = 1 / period
+    try:
+        return create(args.filter, rate, channels)
+    except ValueError as e:
+        print('Invalid filter: ' + str(e) + '\nExiting...')
+        exit()
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+"""
+Per cycle timing probes and loop statistics.
+
+The loop marks the end of each stage (e.g. read, pid, put, log) and the time since the
+previous mark is recorded with perf_counter_ns into a log-linear histogram per stage,
+in the style of HdrHistogram: below 2^SUB_BITS ns every value has its own bucket, above
+that each power of two is split into 2^(SUB_BITS - 1) buckets. Recording is a handful of
+integer operations, percentiles are accurate to 1/2^(SUB_BITS - 1) of the value.
+
+The statistics are printed as a summary line every --metrics-interval seconds and served
+in the Prometheus text format on http://127.0.0.1:<--metrics-port>/metrics.
+"""
+import math
+import threading
+from time import monotonic, perf_counter_ns
+
+SUB_BITS = 7
+SUB_COUNT = 1 << SUB_BITS
+HALF_COUNT = SUB_COUNT >> 1
+# up to 2^40 ns, about 18 minutes. Larger values end up in the last bucket
+BUCKETS = SUB_COUNT + (40 - SUB_BITS + 1) * HALF_COUNT
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucketIndex(value: int) -> int:
+    if value < SUB_COUNT:
+        return max(value, 0)
+    shift = value.bit_length() - SUB_BITS
+    index = SUB_COUNT + (shift - 1) * HALF_COUNT + (value >> shift) - HALF_COUNT
+    return min(index, BUCKETS - 1)
+
+
+def bucketValue(index: int) -> int:
+    """
+    The largest value that falls into the bucket.
+    """
+    if index < SUB_COUNT:
+        return index
+    shift = (index - SUB_COUNT) // HALF_COUNT + 1
+    top = (index - SUB_COUNT) % HALF_COUNT + HALF_COUNT
+    return ((top + 1) << shift) - 1
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value: int):
+        self.counts[bucketIndex(value)] += 1
+        self.count = self.count + 1
+        self.total = self.total + value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> int:
+        if self.count == 0:
+            return 0
+        target = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen = seen + count
+            if seen >= target:
+                return min(bucketValue(index), self.max)
+        return self.max
+
+    def mean(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+
+class ErrorStats:
+    """
+    Running mean, rms and maximum of the control error (Welford).
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sumSquares = 0.0
+        self.maxAbs = 0.0
+
+    def record(self, error: float):
+        self.count = self.count + 1
+        delta = error - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (error - self.mean)
+        self.sumSquares = self.sumSquares + error * error
+        if abs(error) > self.maxAbs:
+            self.maxAbs = abs(error)
+
+    def std(self) -> float:
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def rms(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return math.sqrt(self.sumSquares / self.count)
+
+
+class LoopMetrics:
+    def __init__(self, name: str, stages, loop=None, interval: float = None):
+        """
+        stages are the names of the marks in the order of the loop. loop is the
+        LoopScheduler, its overruns and skipped cycles are exported as well.
+        """
+        self.name = name
+        self.stages = list(stages)
+        self.loop = loop
+        self.interval = interval
+        # 'cycle' is the work of one cycle, 'period' the time between two cycle starts
+        self.histograms = {stage: Histogram() for stage in self.stages + ['cycle', 'period', 'jitter']}
+        self.errors = ErrorStats()
+        self.cycleStart = None
+        self.last = None
+        self.started = None
+        self.cycles = 0
+        self.lastReport = monotonic()
+
+    def begin(self):
+        now = perf_counter_ns()
+        if self.cycleStart is not None:
+            self.histograms['period'].record(now - self.cycleStart)
+        else:
+            self.started = now
+        self.cycleStart = now
+        self.last = now
+
+    def mark(self, stage: str):
+        now = perf_counter_ns()
+        self.histograms[stage].record(now - self.last)
+        self.last = now
+
+    def end(self, late: float = None):
+        """
+        Called after the scheduler wait with the jitter it returned.
+        """
+        self.histograms['cycle'].record(self.last - self.cycleStart)
+        self.cycles = self.cycles + 1
+        if late is not None:
+            self.histograms['jitter'].record(int(late * 1e9))
+        if self.interval is not None and monotonic() - self.lastReport >= self.interval:
+            self.lastReport = monotonic()
+            print(self.summary())
+
+    def error(self, value: float):
+        self.errors.record(value)
+
+    def rate(self) -> float:
+        if self.started is None or self.cycleStart == self.started:
+            return 0.0
+        return (self.cycles - 1) / ((self.cycleStart - self.started) / 1e9)
+
+    def summary(self) -> str:
+        parts = [self.name + ': rate: ' + str(round(self.rate(), 2)) + ' Hz']
+        for stage in self.stages + ['cycle']:
+            histogram = self.histograms[stage]
+            parts.append(stage + ' p50/p99/max: ' + str(round(histogram.percentile(0.5) / 1e3, 1)) + '/'
+                         + str(round(histogram.percentile(0.99) / 1e3, 1)) + '/' + str(round(histogram.max / 1e3, 1)) + ' us')
+        if self.errors.count > 0:
+            parts.append('error rms: ' + str(round(self.errors.rms(), 6)) + ', max: ' + str(round(self.errors.maxAbs, 6)))
+        return ', '.join(parts)
+
+    def render(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format, times in seconds.
+        """
+        label = 'loop="' + self.name + '"'
+        lines = ['# TYPE pid_stage_seconds summary']
+        for stage, histogram in self.histograms.items():
+            stageLabel = label + ',stage="' + stage + '"'
+            for q in QUANTILES:
+                lines.append('pid_stage_seconds{' + stageLabel + ',quantile="' + str(q) + '"} ' + repr(histogram.percentile(q) / 1e9))
+            lines.append('pid_stage_seconds_sum{' + stageLabel + '} ' + repr(histogram.total / 1e9))
+            lines.append('pid_stage_seconds_count{' + stageLabel + '} ' + str(histogram.count))
+        lines.append('# TYPE pid_stage_max_seconds gauge')
+        for stage, histogram in self.histograms.items():
+            lines.append('pid_stage_max_seconds{' + label + ',stage="' + stage + '"} ' + repr(histogram.max / 1e9))
+
+        lines.append('# TYPE pid_loop_rate_hz gauge')
+        lines.append('pid_loop_rate_hz{' + label + '} ' + repr(self.rate()))
+        lines.append('# TYPE pid_loop_cycles_total counter')
+        lines.append('pid_loop_cycles_total{' + label + '} ' + str(self.cycles))
+        if self.loop is not None:
+            lines.append('# TYPE pid_loop_overruns_total counter')
+            lines.append('pid_loop_overruns_total{' + label + '} ' + str(self.loop.overruns))
+            lines.append('# TYPE pid_loop_skipped_total counter')
+            lines.append('pid_loop_skipped_total{' + label + '} ' + str(self.loop.skipped))
+            lines.append('# TYPE pid_loop_period_seconds gauge')
+            lines.append('pid_loop_period_seconds{' + label + '} ' + repr(float(self.loop.period)))
+
+        if self.errors.count > 0:
+            lines.append('# TYPE pid_error gauge')
+            lines.append('pid_error{' + label + ',stat="mean"} ' + repr(self.errors.mean))
+            lines.append('pid_error{' + label + ',stat="std"} ' + repr(self.errors.std()))
+            lines.append('pid_error{' + label + ',stat="rms"} ' + repr(self.errors.rms()))
+            lines.append('pid_error{' + label + ',stat="max_abs"} ' + repr(self.errors.maxAbs))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    Serves /metrics from a daemon thread, the loop itself is never blocked by a scrape.
+    """
+    def __init__(self, metrics: LoopMetrics, port: int, host: str = '127.0.0.1'):
+        # only loaded with --metrics-port, it is slow to import
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def addMetricsArguments(parser):
+    group = parser.add_argument_group('metrics options')
+    group.add_argument('--metrics-port', type=int, default=None, help='serves the loop timing and error statistics on http://127.0.0.1:PORT/metrics')
+    group.add_argument('--metrics-interval', type=float, default=None, help='prints a summary of the loop timing every METRICS_INTERVAL seconds')
+    return group
+
+
+def fromArgs(args, name: str, stages, loop=None):
+    """
+    Returns the metrics and the server, which is None without --metrics-port.
+    """
+    metrics = LoopMetrics(name, stages, loop=loop, interval=args.metrics_interval)
+    server = None
+    if args.metrics_port is not None:
+        try:
+            server = MetricsServer(metrics, args.metrics_port)
+        except OSError as e:
+            print('Could not serve the metrics on port ' + str(args.metrics_port) + ': ' + str(e))
+    return metrics, server
@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+"""
+Orbit correction with several BPMs and steerers.
+
+The response matrix R (BPMs x steerers) holds the measured position change per ampere,
+dx = R dI. Its singular value decomposition R = U S V^T splits the orbit into
+independent modes. Each cycle the orbit error is projected onto the kept modes, every
+mode has its own PID controller (one channel of a VectorPID) and the mode outputs are
+mapped back to steerer currents:
+    modal = U_k^T x                 (k x BPMs)
+    u = pid.step(modal)             desired position change per mode
+    dI = V_k diag(f) u              (steerers x k)
+with the Tikhonov filter factors f = s / (s^2 + alpha^2), which equal 1/s for alpha = 0.
+Both matrices are computed once and cached next to the response matrix, a cycle costs
+two small matrix-vector products.
+
+The response matrix is a json file:
+    {"bpms": [{"name": "BPM1", "source": "epics:BPM1:X"}, ...], "steerers": ["I1SV02", ...],
+     "matrix": [[...], ...], "niveau": [0.0, ...]}
+"niveau" is optional, the BPM sources use the syntax of positionsource.py. A calibration
+file of randomNoise.py measure has the same fields and can be used as it is.
+"""
+import hashlib
+import json
+from pathlib import Path
+import numpy as np
+
+
+def loadResponse(path) -> dict:
+    with open(path, 'r') as f:
+        response = json.load(f)
+    if 'version' in response:
+        # written by randomNoise.py measure
+        import calibration
+        if not isinstance(response['version'], int) or response['version'] > calibration.VERSION:
+            raise ValueError('unsupported calibration version ' + str(response['version']))
+    matrix = np.array(response['matrix'], dtype=float)
+    bpms = response['bpms']
+    steerers = response['steerers']
+    if matrix.shape != (len(bpms), len(steerers)):
+        raise ValueError('the matrix has to be ' + str(len(bpms)) + ' x ' + str(len(steerers)) + ' (BPMs x steerers), not '
+                         + ' x '.join(str(n) for n in matrix.shape))
+    response['matrix'] = matrix
+    return response
+
+
+class ResponseInverse:
+    def __init__(self, matrix: np.ndarray, modes: int = None, alpha: float = 0.0, cutoff: float = 1e-3):
+        """
+        Keeps at most modes singular values, and only those larger than cutoff times the largest.
+        """
+        self.matrix = np.asarray(matrix, dtype=float)
+        self.modes = modes
+        self.alpha = alpha
+        self.cutoff = cutoff
+        u, s, vt = np.linalg.svd(self.matrix, full_matrices=False)
+        self.singular = s
+        keep = int(np.sum(s > cutoff * s[0]))
+        if modes is not None:
+            keep = min(keep, modes)
+        if keep == 0:
+            raise ValueError('the response matrix has no usable singular values')
+        factors = s[:keep] / (s[:keep] ** 2 + alpha ** 2)
+        # contiguous copies, the hot path only does matrix-vector products with them
+        self.projection = np.ascontiguousarray(u[:, :keep].T)
+        self.correction = np.ascontiguousarray(vt[:keep].T * factors)
+
+    @property
+    def kept(self) -> int:
+        return self.projection.shape[0]
+
+    def pseudoInverse(self) -> np.ndarray:
+        return self.correction @ self.projection
+
+    def key(self) -> str:
+        digest = hashlib.sha256(self.matrix.tobytes())
+        digest.update(json.dumps([self.matrix.shape, self.modes, self.alpha, self.cutoff]).encode())
+        return digest.hexdigest()
+
+
+def cachePath(path) -> Path:
+    path = Path(path)
+    return path.with_name(path.stem + '.inverse.npz')
+
+
+def cachedInverse(path, matrix: np.ndarray, modes: int = None, alpha: float = 0.0, cutoff: float = 1e-3, verbose: int = 0) -> ResponseInverse:
+    """
+    Returns the inverse of the response matrix stored at path, from the cache file if
+    it was computed for the same matrix and parameters before.
+    """
+    inverse = ResponseInverse.__new__(ResponseInverse)
+    inverse.matrix = np.asarray(matrix, dtype=float)
+    inverse.modes = modes
+    inverse.alpha = alpha
+    inverse.cutoff = cutoff
+    cache = cachePath(path)
+    try:
+        with np.load(cache) as data:
+            if str(data['key']) == inverse.key():
+                inverse.singular = data['singular']
+                inverse.projection = data['projection']
+                inverse.correction = data['correction']
+                if verbose >= 1:
+                    print('Loaded the inverse response matrix from ' + str(cache))
+                return inverse
+    except (OSError, KeyError, ValueError):
+        pass
+
+    inverse = ResponseInverse(matrix, modes=modes, alpha=alpha, cutoff=cutoff)
+    try:
+        np.savez(cache, key=inverse.key(), singular=inverse.singular, projection=inverse.projection, correction=inverse.correction)
+        if verbose >= 1:
+            print('Cached the inverse response matrix in ' + str(cache))
+    except OSError as e:
+        print('Could not cache the inverse response matrix: ' + str(e))
+    return inverse
+
+
+class MimoController:
+    def __init__(self, inverse: ResponseInverse, pid, niveau, maxStep: float = None):
+        """
+        pid is a VectorPID with one channel per kept mode. niveau is the target orbit,
+        one value per BPM. maxStep limits the largest current change of a cycle, the
+        whole correction is scaled so its direction is kept.
+        """
+        self.inverse = inverse
+        self.pid = pid
+        self.maxStep = maxStep
+        self.modal = np.zeros(inverse.kept)
+        self.delta = np.zeros(inverse.correction.shape[0])
+        self.setNiveau(niveau)
+
+    def setNiveau(self, niveau):
+        # the PID controllers work on modes, so the target orbit is projected as well
+        bpms = self.inverse.projection.shape[1]
+        self.pid.setpoint[:] = self.inverse.projection @ np.broadcast_to(np.asarray(niveau, dtype=float), (bpms,))
+
+    def step(self, positions, dt=None) -> np.ndarray:
+        """
+        Returns the current change of every steerer. The returned array is reused by the next step.
+        """
+        np.dot(self.inverse.projection, positions, out=self.modal)
+        u = self.pid.step(self.modal, dt)
+        np.dot(self.inverse.correction, u, out=self.delta)
+        if self.maxStep is not None:
+            largest = np.max(np.abs(self.delta))
+            if largest > self.maxStep:
+                self.delta *= self.maxStep / largest
+        return self.delta
+
+
+def simulate(controller: MimoController, matrix: np.ndarray, noise: np.ndarray, start=None, dt: float = 1.0) -> np.ndarray:
+    """
+    Runs the controller against the plant x += noise[k] + R dI. Returns the orbit of every step.
+    """
+    steps, bpms = noise.shape
+    orbit = np.zeros(bpms) if start is None else np.array(start, dtype=float)
+    history = np.empty((steps, bpms))
+    for k in range(steps):
+        orbit += noise[k]
+        orbit += matrix @ controller.step(orbit, dt)
+        history[k] = orbit
+    return history
@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+import argparse
+import os
+import numpy as np
+import feedforward
+import filters
+import noiseengine
+import simulation
+from pidcontroller import DELTA_I_COEFFICIENT, gainSet
+
+ver = "1.0.0"
+author = "Valentin Reichenbach"
+description = """
+Monte Carlo robustness analysis of PID gain sets.
+Every trial runs the closed loop of simulation.py with its own noise realization and its own
+noise strength, drift, sine amplitude, sine period and plant coefficient, drawn uniformly around
+the given values. All gain sets see the same trials. The trials are split into chunks that run
+across a process pool, the workers write their results into one shared memory array.
+The report shows percentiles of the loop metrics and the stability margins of the linear loop
+(output limits, filters and feed-forward are left out of the margins).
+"""
+epilog = """
+Author: Valentin Reichenbach
+Version: 1.0.0
+License: GPLv3+
+"""
+
+# parameters drawn for every trial, the results follow them in the same record
+PARAMETER_DTYPE = [('trial', 'i8'), ('noise_strength', 'f8'), ('drift', 'f8'), ('amplitude', 'f8'), ('period', 'f8'),
+                   ('plant_coefficient', 'f8'), ('radius', 'f8')]
+TRIAL_DTYPE = np.dtype(PARAMETER_DTYPE + simulation.RESULT_DTYPE.descr)
+
+REPORTED = ('rms', 'iae', 'overshoot', 'settling', 'effort')
+
+# loop gain factors the margins are searched in
+MARGIN_RANGE = (1e-3, 1e3)
+
+
+def drawParameters(args, trials: int, seed) -> dict:
+    """
+    Draws the varied parameters of every trial. Relative spreads scale the given value by
+    a factor in [1 - spread, 1 + spread], the drift spread is absolute.
+    """
+    rng = np.random.default_rng([seed, 0])
+
+    def scaled(value, spread):
+        return value * rng.uniform(1 - spread, 1 + spread, trials)
+
+    return {'noise_strength': scaled(args.noise_strength, args.strength_spread),
+            'drift': args.drift + rng.uniform(-args.drift_spread, args.drift_spread, trials),
+            'amplitude': scaled(args.amplitude, args.amplitude_spread),
+            'period': scaled(args.period, args.period_spread),
+            'plant_coefficient': scaled(args.plant_coefficient, args.plant_spread)}
+
+
+def trialNoise(settings: dict, rows: np.ndarray, steps: int, dt: float, seed) -> np.ndarray:
+    """
+    Generates the noise increments of the given trials, one column per trial.
+    """
+    noiseType = settings['noise_type']
+    components = []
+    if noiseType in ('normal', 'mix'):
+        components.append(noiseengine.GaussianNoise(rows['noise_strength']))
+    if noiseType in ('sin', 'mix'):
+        components.append(noiseengine.SineNoise(rows['amplitude'], 1 / rows['period'], settings['phase']))
+    if noiseType == 'pink':
+        components.append(noiseengine.PinkNoise(rows['noise_strength']))
+    if settings['pink_strength'] > 0:
+        components.append(noiseengine.PinkNoise(settings['pink_strength']))
+    components.append(noiseengine.Drift(rows['drift']))
+    if len(settings['step']) > 0:
+        components.append(noiseengine.StepDisturbance(settings['step']))
+    return noiseengine.NoiseEngine(components, dt, seed=seed, channels=len(rows)).block(steps)
+
+
+def _runChunk(job):
+    name, shape, first, last, gains, steps, dt, controlEvery, seed, settings, options = job
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        table = np.ndarray(shape, dtype=TRIAL_DTYPE, buffer=shm.buf)
+        rows = table[first:last]
+        trials = last - first
+        count = len(gains)
+        # every gain set of a trial sees the same noise realization
+        noise = np.repeat(trialNoise(settings, rows[:, 0], steps, dt, [seed, 1, first]), count, axis=1)
+        results = simulation.simulate(np.tile(gains[:, 0], trials), np.tile(gains[:, 1], trials), np.tile(gains[:, 2], trials), noise, dt,
+                                      controlEvery=controlEvery, **dict(options, plantCoefficient=rows['plant_coefficient'].ravel()))
+        for field in simulation.RESULT_DTYPE.names:
+            rows[field] = results[field].reshape(trials, count)
+        # the views have to be gone before the segment can be closed
+        del rows, table
+    finally:
+        shm.close()
+    return last - first
+
+
+def characteristic(kp, ki, kd, period: float, loopGain) -> np.ndarray:
+    """
+    Coefficients a2, a1, a0 of the closed loop polynomial z^3 + a2 z^2 + a1 z + a0.
+    The plant moves the position by loopGain * u every controller step, an integrator
+    g / (z - 1). The controller is the discrete PID of VectorPID,
+    kp + ki T z / (z - 1) + kd (z - 1) / (T z).
+    Without an integral term the (z - 1) of the controller cancels, those loops get
+    z (z^2 + (g (kp + kd / T) - 1) z - g kd / T) instead, the extra pole at 0 is harmless.
+    """
+    kp, ki, kd, loopGain = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (kp, ki, kd, loopGain)))
+    integral = ki != 0
+    a2 = np.where(integral, -2 + loopGain * (kp + ki * period + kd / period), -1 + loopGain * (kp + kd / period))
+    a1 = np.where(integral, 1 - loopGain * (kp + 2 * kd / period), -loopGain * kd / period)
+    a0 = np.where(integral, loopGain * kd / period, 0.0)
+    return np.stack((a2, a1, a0), axis=-1)
+
+
+def spectralRadius(kp, ki, kd, period: float, loopGain) -> np.ndarray:
+    """
+    Largest magnitude of the closed loop poles, the loop is stable below 1.
+    """
+    coefficients = characteristic(kp, ki, kd, period, loopGain)
+    companion = np.zeros(coefficients.shape[:-1] + (3, 3))
+    companion[..., 0, :] = -coefficients
+    companion[..., 1, 0] = 1
+    companion[..., 2, 1] = 1
+    return np.max(np.abs(np.linalg.eigvals(companion)), axis=-1)
+
+
+def marginEdge(stable, inside: float, outside: float, iterations: int = 40) -> float:
+    # bisection on a log scale between a stable and an unstable loop gain factor
+    for _ in range(iterations):
+        middle = np.sqrt(inside * outside)
+        if stable(middle):
+            inside = middle
+        else:
+            outside = middle
+    return inside
+
+
+def gainMargins(kp: float, ki: float, kd: float, period: float, loopGain: float) -> tuple:
+    """
+    Returns the smallest and largest factor of the loop gain that keep the loop stable,
+    0 and inf if there is no limit within MARGIN_RANGE. Both are nan for an unstable loop.
+    """
+    def stable(factor):
+        return spectralRadius(kp, ki, kd, period, loopGain * factor) < 1
+
+    if not stable(1.0):
+        return float('nan'), float('nan')
+    factors = np.geomspace(MARGIN_RANGE[0], MARGIN_RANGE[1], 601)
+    ok = spectralRadius(kp, ki, kd, period, loopGain * factors) < 1
+    above = np.nonzero(~ok & (factors > 1))[0]
+    below = np.nonzero(~ok & (factors < 1))[0]
+    upper = float('inf')
+    if len(above) > 0:
+        upper = marginEdge(stable, 1.0, factors[above[0]])
+    lower = 0.0
+    if len(below) > 0:
+        lower = marginEdge(stable, 1.0, factors[below[-1]])
+    return lower, upper
+
+
+def phaseMargin(kp: float, ki: float, kd: float, period: float, loopGain: float, points: int = 20000) -> float:
+    """
+    Smallest distance of the open loop phase to -180 degrees where its gain crosses 1,
+    inf if it never does and nan for an unstable loop.
+    """
+    if spectralRadius(kp, ki, kd, period, loopGain) >= 1:
+        return float('nan')
+    z = np.exp(1j * np.linspace(1e-4, np.pi, points))
+    controller = kp + ki * period * z / (z - 1) + kd * (z - 1) / (period * z)
+    openLoop = loopGain * controller / (z - 1)
+    crossings = np.nonzero(np.diff(np.sign(np.abs(openLoop) - 1)) != 0)[0]
+    if len(crossings) == 0:
+        return float('inf')
+    margins = (180 + np.degrees(np.angle(openLoop[crossings])) + 180) % 360 - 180
+    return float(np.min(margins))
+
+
+def run(args, gains: np.ndarray, seed) -> np.ndarray:
+    """
+    Runs all trials and returns them as a (trials, gain sets) TRIAL_DTYPE array.
+    """
+    from multiprocessing import shared_memory
+    dt = simulation.noiseDt(args)
+    controlEvery = max(1, int(round(args.delay / dt)))
+    period = dt * controlEvery
+    shape = (args.trials, len(gains))
+    settings = {name: getattr(args, name) for name in ('noise_type', 'phase', 'pink_strength', 'step')}
+    options = simulation.simulationOptions(args)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, TRIAL_DTYPE.itemsize * shape[0] * shape[1]))
+    try:
+        table = np.ndarray(shape, dtype=TRIAL_DTYPE, buffer=shm.buf)
+        table[:] = np.zeros((), dtype=TRIAL_DTYPE)
+        table['trial'] = np.arange(args.trials)[:, None]
+        for field, values in drawParameters(args, args.trials, seed).items():
+            table[field] = values[:, None]
+        table['kp'] = gains[:, 0]
+        table['ki'] = gains[:, 1]
+        table['kd'] = gains[:, 2]
+        table['radius'] = spectralRadius(table['kp'], table['ki'], table['kd'], period, DELTA_I_COEFFICIENT / table['plant_coefficient'])
+
+        jobs = []
+        for first in range(0, args.trials, args.chunk):
+            last = min(first + args.chunk, args.trials)
+            jobs.append((shm.name, shape, first, last, gains, args.steps, dt, controlEvery, seed, settings, options))
+        if args.workers > 1 and len(jobs) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=args.workers) as pool:
+                done = 0
+                for count in pool.map(_runChunk, jobs):
+                    done = done + count
+                    if args.verbose >= 2:
+                        print(str(done) + ' / ' + str(args.trials) + ' trials')
+        else:
+            for job in jobs:
+                _runChunk(job)
+        results = table.copy()
+        del table
+    finally:
+        shm.close()
+        shm.unlink()
+    return results
+
+
+def percentile(values: np.ndarray, percentiles) -> np.ndarray:
+    # nearest rank, unlike np.percentile it doesn't interpolate, so unsettled trials (inf) stay inf
+    ordered = np.sort(values)
+    ranks = np.ceil(np.asarray(percentiles, dtype=float) / 100 * len(ordered)).astype(int) - 1
+    return ordered[np.clip(ranks, 0, len(ordered) - 1)]
+
+
+def formatPercentiles(name: str, values: np.ndarray, percentiles) -> str:
+    points = percentile(values, percentiles)
+    return name + ' ' + '/'.join('p' + str(p) for p in percentiles) + ': ' + ' / '.join(str(round(v, 4)) for v in points)
+
+
+def report(results: np.ndarray, period: float, plantCoefficient: float, percentiles) -> list:
+    lines = []
+    for column in range(results.shape[1]):
+        trials = results[:, column]
+        kp, ki, kd = (float(trials[name][0]) for name in ('kp', 'ki', 'kd'))
+        loopGain = DELTA_I_COEFFICIENT / plantCoefficient
+        lower, upper = gainMargins(kp, ki, kd, period, loopGain)
+        lines.append('Kp: ' + str(round(kp, 4)) + ', Ki: ' + str(round(ki, 4)) + ', Kd: ' + str(round(kd, 4))
+                     + ', gain margin: x' + str(round(lower, 3)) + ' .. x' + str(round(upper, 3))
+                     + ' (' + str(round(20 * np.log10(upper), 1)) + ' dB)'
+                     + ', phase margin: ' + str(round(phaseMargin(kp, ki, kd, period, loopGain), 1)) + ' deg'
+                     + ', stable: ' + str(round(100 * np.mean(trials['radius'] < 1), 1)) + ' %'
+                     + ', settled: ' + str(round(100 * np.mean(np.isfinite(trials['settling'])), 1)) + ' %')
+        for name in REPORTED:
+            lines.append('    ' + formatPercentiles(name, trials[name], percentiles))
+    return lines
+
+
+def writeResults(path: str, results: np.ndarray):
+    simulation.writeResults(path, results.ravel())
+
+
+def percentileList(value: str) -> list:
+    return [float(v) if '.' in v else int(v) for v in value.split(',') if v != '']
+
+
+def checkSpreads(args):
+    for name in ('strength_spread', 'amplitude_spread', 'period_spread', 'plant_spread'):
+        if not 0 <= getattr(args, name) < 1:
+            print('--' + name.replace('_', '-') + ' has to be in [0, 1)\nExiting...')
+            exit()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--version', action='version', version=ver)
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='verbose output')
+    parser.add_argument('-p', '--proportional', type=float, default=0.5, help='specifys the coefficient for the proportional term')
+    parser.add_argument('-i', '--integral', type=float, default=0.3, help='specifys the coefficient for the integral term')
+    parser.add_argument('-d', '--derivative', type=float, default=0, help='specifys the coefficient for the derivative term')
+    parser.add_argument('--gains', type=gainSet, action='append', default=[], help='additional gain set as "kp:ki:kd". Can be used multiple times')
+    parser.add_argument('-D', '--delay', type=float, default=0.0, help='specifys the period of the control loop in seconds. This is 0 (every noise step) by default')
+    parser.add_argument('-n', '--niveau', type=float, default=1, help='specifys the niveau that the PID controler should aim for')
+    parser.add_argument('--min', type=float, default=-3, help='specifys the minimum output of the PID controller')
+    parser.add_argument('--max', type=float, default=3, help='specifys the maximum output of the PID controller')
+    parser.add_argument('--derivative-filter', type=float, default=None, help='alpha of the exponential moving average that smooths the derivative term')
+    simulation.addPlantArguments(parser)
+    feedforward.addFeedForwardArguments(parser)
+    filters.addFilterArguments(parser)
+
+    trialOptions = parser.add_argument_group('trial options')
+    trialOptions.add_argument('--trials', type=int, default=1000, help='number of trials per gain set. The default is 1000')
+    trialOptions.add_argument('--strength-spread', type=float, default=0.5, help='relative spread of --noise-strength. The default is 0.5')
+    trialOptions.add_argument('--drift-spread', type=float, default=0.005, help='absolute spread of --drift per noise step. The default is 0.005')
+    trialOptions.add_argument('--amplitude-spread', type=float, default=0.5, help='relative spread of --amplitude. The default is 0.5')
+    trialOptions.add_argument('--period-spread', type=float, default=0.5, help='relative spread of --period. The default is 0.5')
+    trialOptions.add_argument('--plant-spread', type=float, default=0.3, help='relative spread of --plant-coefficient, the deltaI coefficient of the machine. The default is 0.3')
+    trialOptions.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes. The default is the number of cpus')
+    trialOptions.add_argument('--chunk', type=int, default=64, help='number of trials simulated together by one worker. The default is 64')
+    trialOptions.add_argument('--percentiles', type=percentileList, default=[5, 50, 95], help='comma separated percentiles of the report. The default is 5,50,95')
+    trialOptions.add_argument('-o', '--output', type=str, default=None, help='writes every trial to this csv file')
+
+    args = parser.parse_args()
+    checkSpreads(args)
+    if args.trials < 1 or args.chunk < 1:
+        print('--trials and --chunk have to be positive\nExiting...')
+        exit()
+
+    seed = args.seed
+    if seed is None:
+        # printed, so the run can be repeated with --seed
+        seed = np.random.SeedSequence().entropy
+    print('Seed: ' + str(seed))
+
+    gains = np.array([(args.proportional, args.integral, args.derivative)] + args.gains, dtype=float)
+    results = run(args, gains, seed)
+    if args.verbose >= 1:
+        print('Simulated ' + str(args.trials) + ' trials of ' + str(len(gains)) + ' gain sets with ' + str(args.steps) + ' steps each')
+
+    dt = simulation.noiseDt(args)
+    period = dt * max(1, int(round(args.delay / dt)))
+    for line in report(results, period, args.plant_coefficient, args.percentiles):
+        print(line)
+    if args.output is not None:
+        writeResults(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
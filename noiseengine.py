@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+"""
+Block based noise generation.
+
+A NoiseEngine sums composable components into a preallocated buffer, a whole block at
+a time, using a seedable NumPy Generator. Every component produces the increment that
+is added to the current value in each step, like randomNoise.generateNoise does:
+    GaussianNoise     strength * N(0, 1) per step (random walk)
+    Drift             constant increment per step
+    SineNoise         follows A * sin(2 pi f t + phase)
+    PinkNoise         follows a 1/f noise signal (Voss-McCartney)
+    StepDisturbance   jumps by the given sizes at the given times
+next() streams single samples out of the buffer and refills it when it is used up.
+
+With channels set, every sample holds one value per channel. Component parameters can
+then be arrays with one entry per channel and the Gaussian noise can be correlated
+between the channels.
+"""
+import numpy as np
+
+NOISE_TYPES = ['normal', 'sin', 'mix', 'pink']
+
+
+def correlationMatrix(channels: int, correlation: float) -> np.ndarray:
+    # the same correlation between every pair of channels
+    return (1 - correlation) * np.eye(channels) + correlation * np.ones((channels, channels))
+
+
+class GaussianNoise:
+    def __init__(self, strength, correlation: np.ndarray = None):
+        self.strength = np.asarray(strength, dtype=float)
+        self.mixing = None
+        if correlation is not None:
+            # symmetric square root, also works for singular matrices (fully correlated channels)
+            w, v = np.linalg.eigh(correlation)
+            self.mixing = v @ np.diag(np.sqrt(np.maximum(w, 0))) @ v.T
+
+    def add(self, rng, start: int, out: np.ndarray, dt: float):
+        samples = rng.standard_normal(out.shape)
+        if self.mixing is not None:
+            samples = samples @ self.mixing
+        out += self.strength * samples
+
+
+class Drift:
+    def __init__(self, rate):
+        self.rate = np.asarray(rate, dtype=float)
+
+    def add(self, rng, start: int, out: np.ndarray, dt: float):
+        out += self.rate
+
+
+class SineNoise:
+    def __init__(self, amplitude, frequency, phase=0.0):
+        self.amplitude = np.asarray(amplitude, dtype=float)
+        self.frequency = np.asarray(frequency, dtype=float)
+        self.phase = np.asarray(phase, dtype=float)
+
+    def add(self, rng, start: int, out: np.ndarray, dt: float):
+        # level at the end of every step minus the level at its beginning
+        t = (start + np.arange(len(out) + 1)) * dt
+        if out.ndim == 2:
+            t = t[:, None]
+        level = self.amplitude * np.sin(2 * np.pi * self.frequency * t + self.phase)
+        out += np.diff(level, axis=0)
+
+
+class PinkNoise:
+    def __init__(self, strength, rows: int = 16):
+        self.strength = np.asarray(strength, dtype=float)
+        self.rows = rows
+        self.state = None
+        self.lastLevel = None
+
+    def add(self, rng, start: int, out: np.ndarray, dt: float):
+        n = len(out)
+        shape = out.shape[1:]
+        if self.state is None:
+            self.state = rng.standard_normal((self.rows,) + shape)
+            self.lastLevel = np.sum(self.state, axis=0) + rng.standard_normal(shape)
+        # row r is redrawn at every sample index k with k % 2^(r + 1) == 2^r
+        level = rng.standard_normal(out.shape)
+        for r in range(self.rows):
+            period = 1 << (r + 1)
+            first = ((1 << r) - start) % period
+            updates = np.arange(first, n, period)
+            values = rng.standard_normal((len(updates),) + shape)
+            counts = np.diff(np.concatenate(([0], updates, [n])))
+            level += np.repeat(np.concatenate((self.state[r][None], values)), counts, axis=0)
+            if len(updates) > 0:
+                self.state[r] = values[-1]
+        out[0] += self.strength * (level[0] - self.lastLevel) / np.sqrt(self.rows + 1)
+        out[1:] += self.strength * np.diff(level, axis=0) / np.sqrt(self.rows + 1)
+        self.lastLevel = level[-1]
+
+
+class StepDisturbance:
+    def __init__(self, steps):
+        # list of (time in seconds, size), with channels the size can hold one entry per channel
+        self.steps = list(steps)
+
+    def add(self, rng, start: int, out: np.ndarray, dt: float):
+        for time, size in self.steps:
+            index = int(round(time / dt)) - start
+            if 0 <= index < len(out):
+                out[index] += size
+
+
+class NoiseEngine:
+    def __init__(self, components, dt: float, blockLen: int = 4096, seed: int = None, channels: int = None):
+        self.components = list(components)
+        self.dt = dt
+        self.channels = channels
+        self.rng = np.random.default_rng(seed)
+        self.buffer = np.empty(self.shape(blockLen))
+        self.values = []
+        self.index = 0
+        self.sample = 0
+
+    def shape(self, n: int) -> tuple:
+        if self.channels is None:
+            return (n,)
+        return (n, self.channels)
+
+    def fill(self, out: np.ndarray):
+        out[:] = 0
+        for component in self.components:
+            component.add(self.rng, self.sample, out, self.dt)
+        self.sample = self.sample + len(out)
+
+    def block(self, n: int) -> np.ndarray:
+        """
+        Returns the next n increments as a new array. Doesn't touch the streaming buffer.
+        """
+        out = np.empty(self.shape(n))
+        self.fill(out)
+        return out
+
+    def next(self):
+        """
+        Returns the next increment, a list with one value per channel if channels is set.
+        """
+        if self.index >= len(self.values):
+            self.fill(self.buffer)
+            # python floats are faster to hand out one by one than numpy scalars
+            self.values = self.buffer.tolist()
+            self.index = 0
+        value = self.values[self.index]
+        self.index = self.index + 1
+        return value
+
+
+def stepSpec(value: str) -> tuple:
+    time, size = value.split(':')
+    return float(time), float(size)
+
+
+def addNoiseArguments(parser):
+    parser.add_argument('--noise-strength', type=float, default=0.5, help='the strength of the noise. The default value is 0.5')
+    parser.add_argument('--drift', type=float, default=0.0, help='the drift of the noise. The default value is 0.0')
+    parser.add_argument('--noise-type', type=str, choices=NOISE_TYPES, default='normal', help='the type of noise that should be generated. The default value is "normal" (a normal distribution). Alternativly, you can use "sin" for noise a sine wave like noise, "mix" for a mixture of both or "pink" for 1/f noise')
+    parser.add_argument('--period', type=float, default=10, help='the period of the sine wave in seconds. The default value is 10')
+    parser.add_argument('--shift', type=float, default=0.0, help='the shift of the sine wave. The default value is 0.0')
+    parser.add_argument('--amplitude', type=float, default=1.0, help='the amplitude of the sine wave. The default value is 1.0')
+    parser.add_argument('--phase', type=float, default=0.0, help='the phase of the sine wave in radians. The default value is 0.0')
+    parser.add_argument('--pink-strength', type=float, default=0.0, help='adds 1/f noise of this strength to any noise type. The default value is 0.0')
+    parser.add_argument('--step', type=stepSpec, action='append', default=[], help='adds a step disturbance as "time:size", time in seconds. Can be used multiple times')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random generator, makes runs reproducible')
+
+
+def componentsFromArgs(args) -> list:
+    components = []
+    if args.noise_type in ('normal', 'mix'):
+        components.append(GaussianNoise(args.noise_strength))
+    if args.noise_type in ('sin', 'mix'):
+        components.append(SineNoise(args.amplitude, 1 / args.period, args.phase))
+    if args.noise_type == 'pink':
+        components.append(PinkNoise(args.noise_strength))
+    if args.pink_strength > 0:
+        components.append(PinkNoise(args.pink_strength))
+    if args.drift != 0:
+        components.append(Drift(args.drift))
+    if len(args.step) > 0:
+        components.append(StepDisturbance(args.step))
+    return components
+
+
+def fromArgs(args, dt: float) -> NoiseEngine:
+    return NoiseEngine(componentsFromArgs(args), dt, seed=args.seed)
+
+
+def channelParameters(channels, name: str, enabled=None) -> np.ndarray:
+    # one entry per channel, zero for channels whose noise type doesn't use the component
+    values = np.array([getattr(channel, name) for channel in channels], dtype=float)
+    if enabled is not None:
+        values = values * np.array([channel.noise_type in enabled for channel in channels])
+    return values
+
+
+def fromChannels(channels, dt: float, correlation: float = 0.0, seed: int = None) -> NoiseEngine:
+    """
+    Builds a multi channel engine. channels is a list of namespaces with the same
+    attributes as the parsed noise arguments, one per channel.
+    """
+    count = len(channels)
+    matrix = None
+    if correlation != 0:
+        matrix = correlationMatrix(count, correlation)
+    components = [
+        GaussianNoise(channelParameters(channels, 'noise_strength', ('normal', 'mix')), correlation=matrix),
+        SineNoise(channelParameters(channels, 'amplitude', ('sin', 'mix')), 1 / channelParameters(channels, 'period'), channelParameters(channels, 'phase')),
+        Drift(channelParameters(channels, 'drift')),
+    ]
+    pink = channelParameters(channels, 'noise_strength', ('pink',)) + channelParameters(channels, 'pink_strength')
+    if np.any(pink > 0):
+        components.append(PinkNoise(pink))
+    # every step only moves the channel it belongs to
+    steps = []
+    for index, channel in enumerate(channels):
+        for time, size in channel.step:
+            sizes = np.zeros(count)
+            sizes[index] = size
+            steps.append((time, sizes))
+    if len(steps) > 0:
+        components.append(StepDisturbance(steps))
+    return NoiseEngine(components, dt, seed=seed, channels=count)
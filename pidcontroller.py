@@ -1,11 +1,20 @@
 #!/usr/bin/python3
 from os import remove
-from epics import caget, caput
-from simple_pid import PID
 import argparse
 from pathlib import Path
-from time import sleep, time
-import matplotlib.pyplot as plt
+from time import time
+import debugchannel
+import scheduler
+import renderer
+import telemetry
+import watchdog
+import control
+import feedforward
+import filters
+import metrics
+import positionsource
+import noiseengine
+from pidengine import VectorPID
 
 ver = "1.1.0"
 author = "Valentin Reichenbach"
@@ -18,8 +27,18 @@ Version: 1.1.0
 License: GPLv3+
 """    
 
-def getCurrentVal(args, debugFile: str) -> float:
-    if args.mode == 'debug':
+DEBUG_COLUMNS = [('time', 'f8'), ('corrected Value', 'f8'), ('current Value', 'f8')]
+CASCADE_COLUMNS = [('time', 'f8'), ('current pos', 'f8'), ('reference', 'f8'), ('readback', 'f8'), ('command', 'f8')]
+NORMAL_COLUMNS = [('time', 'f8'), ('current pos', 'f8'), ('corrected pos', 'f8'), ('current shift', 'f8'), ('current current', 'f8'), ('new current', 'f8')]
+
+def usesDebugEnv(args) -> bool:
+    return args.mode == 'debug' or (args.mode == 'autotune' and args.plant == 'debug')
+
+def getCurrentVal(args, debugFile: str, channel=None) -> float:
+    if usesDebugEnv(args) and channel is not None:
+        # the seqlock never returns a torn or empty value
+        return channel.readValue()
+    elif usesDebugEnv(args):
         # Check if the debug file exists
         try:
             f = open(debugFile, 'r')
@@ -44,184 +63,696 @@ def getCurrentVal(args, debugFile: str) -> float:
         return val
     elif args.mode == 'normal':
         # unused
-        return caget(args.pv)
+        import pvio
+        return pvio.get(args.pv)
     else:
         print('Something went wrong while parsing the arguments\nExiting...')
         exit()
 
 
+def openDebugChannel(args, debugFile: str):
+    if args.channel != 'shm':
+        return None
+    try:
+        return debugchannel.attachChannel(debugFile)
+    except Exception as e:
+        print('The debug channel ' + debugchannel.channelName(debugFile) + ' was not found')
+        print('Exception: ', e)
+        print('Exiting...')
+        exit()
+
+def writeDebugVal(debugFile: str, value: float, channel=None):
+    if channel is not None:
+        channel.write(value)
+    else:
+        f = open(debugFile, 'w')
+        f.write(str(value))
+        f.close()
+
+
 def debugMode(args):
     debugFile = args.file
     args.pv = 'debug'
-    getCurrentVal(args=args, debugFile=debugFile)
 
-    pid = PID(Kp=args.proportional, Kd=args.derivative, Ki=args.integral, setpoint=args.niveau)
+    channel = openDebugChannel(args, debugFile)
+    getCurrentVal(args=args, debugFile=debugFile, channel=channel)
 
-    x = []
-    y1 = []
-    y2 = []
-    y3 = []
+    pid = VectorPID(kp=args.proportional, ki=args.integral, kd=args.derivative, setpoint=args.niveau, outputLimits=(args.min, args.max),
+                    derivativeFilter=args.derivative_filter)
 
-    plt.ion() # plot all graphs in the same window
+    # the PID controller sees the filtered position, the log and the plot the raw one
+    inputFilter = filters.fromArgs(args, args.delay)
 
-    startTime = time()
+    # learns the periodic part of the noise and corrects it ahead of the PID controller
+    compensation = feedforward.fromArgs(args)
 
-    graphLen = 80
+    # the plot runs in its own process and never blocks the loop
+    plot = None
+    if args.visualize == True:
+        plot = renderer.LivePlot('PID-Controller', ['Value', 'Niveau', 'Current Value'], graphLen=80, fps=args.fps)
 
     # log options
+    logger = None
     if args.log == True:
-        logFile = args.log_file
-        header = 'PID-Controller Log File\nPV: ' + str(args.pv) + '\nKp: ' + str(args.proportional) + '\nKi: ' + str(args.integral) + '\nKd: ' + str(args.derivative) + '\nNiveau: ' + str(args.niveau) + '\nDelay: ' + str(args.delay) + '\n\n'
-        with open(logFile, 'w') as l:
-            l.write(header)
-            l.write('time, corrected Value, current Value\n')
-            l.close()
+        # rows are written by a background thread
+        logger = telemetry.fromArgs(args, DEBUG_COLUMNS, telemetry.parameterHeader(args))
+
+    loop = scheduler.fromArgs(args, args.delay)
+
+    # gains, niveau and delay can be changed while the loop is running
+    controls = control.fromArgs(args, pid, loop, logger, inputFilter=inputFilter)
+
+    # timing of every stage of the loop
+    probes, metricsServer = metrics.fromArgs(args, 'debug', ['read', 'pid', 'write', 'log', 'plot', 'control'], loop)
+
+    loop.start()
+    # the time column shares its origin with loop.elapsed(), which stamps the notes
+    startTime = time()
 
     try:
         while True:
-            currentVal = getCurrentVal(args=args, debugFile=debugFile)
+            probes.begin()
+            currentVal = getCurrentVal(args=args, debugFile=debugFile, channel=channel)
             fileVal = currentVal
+            probes.mark('read')
 
             # get new value
-            correctVal = float(pid(currentVal)) + currentVal
+            shift = pid(currentVal if inputFilter is None else inputFilter(currentVal))
+            if compensation is not None:
+                shift = compensation(time() - startTime, currentVal, shift)
+            correctVal = shift + currentVal
+            probes.mark('pid')
 
             # wrtie new value to debug file
-            f = open(debugFile, 'w')
-            f.write(str(correctVal))
-            f.close()
+            writeDebugVal(debugFile, correctVal, channel)
+            probes.mark('write')
+            probes.error(args.niveau - currentVal)
 
             if args.verbose >= 2:
                 print('time: ' + str(time()-startTime) + ', corrected Value: ' + str(correctVal) + ', current Value: ' + str(currentVal) + '')
 
-            if args.log == True:
-                logFile = args.log_file
-                l = open(logFile, 'a')
-                l.write(str(time() - startTime) + ', ' + str(correctVal) + ', ' + str(currentVal) + '\n')
-                l.close()
-            
+            if logger is not None:
+                logger.log(time() - startTime, correctVal, currentVal)
+            probes.mark('log')
             
             # plotting
-            if args.visualize == True:
-
-                x.append(time() - startTime)
-                y1.append(correctVal)
-                y2.append(args.niveau)
-                y3.append(fileVal)
-
-                # makes sure that the graph doesnt grow infinitly
-                if len(x) >= graphLen:
-                    x.pop(0)
-                if len(y1) >= graphLen:
-                    y1.pop(0)
-                if len(y2) >= graphLen:
-                    y2.pop(0)
-                if len(y3) >= graphLen:
-                    y3.pop(0)
-
-                plt.cla() # clear axes
-
-                plt.title('correct: ' + str(correctVal))
-                plt.plot(x, y1, label='Value')
-                plt.plot(x, y2, label='Niveau')
-                plt.plot(x, y3, label='Current Value')
-                plt.legend(loc='upper left')
-
-                plt.pause(0.1)
-
-            sleep(args.delay)
+            if plot is not None:
+                plot.publish(time() - startTime, (correctVal, args.niveau, fileVal), title='correct: ' + str(correctVal))
+            probes.mark('plot')
+
+            # apply parameter changes between two cycles
+            if controls is not None:
+                controls.poll()
+            probes.mark('control')
+
+            # wait for the deadline of the next cycle
+            probes.end(loop.wait())
     except KeyboardInterrupt:
-        print('\nKeyboard interrupt detected\nExiting...')
+        print('\nKeyboard interrupt detected')
+        print(loop.summary())
+        print(probes.summary())
+        if metricsServer is not None:
+            metricsServer.close()
+        if plot is not None:
+            plot.close()
+        if controls is not None:
+            controls.close()
+        if logger is not None:
+            # flushes the remaining rows
+            logger.close()
+        print('Exiting...')
         exit()
 
-def deltaI(deltaX):
-    return -0.021836 * deltaX
+# current change in A per position change
+DELTA_I_COEFFICIENT = -0.021836
 
+def deltaI(deltaX, coefficient=DELTA_I_COEFFICIENT):
+    return coefficient * deltaX
+
+def calibratedCoefficient(args) -> float:
+    # the measured coefficient of randomNoise.py measure replaces the default. It belongs to
+    # the steerer --pv and the BPM of --position-source
+    if args.calibration is None:
+        return DELTA_I_COEFFICIENT
+    import calibration
+    try:
+        cal = calibration.loadCalibration(args.calibration)
+        coefficient = calibration.coefficient(cal, args.pv, args.position_source)
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        print('Could not load the calibration ' + args.calibration + ': ' + str(e) + '\nExiting...')
+        exit()
+    print('Using the deltaI coefficient ' + str(coefficient) + ' from ' + args.calibration)
+    return coefficient
 
 
 def normalMode(args):
-    currentVal = caget(args.pv + ':outCur')
+    # imported here, so the debug mode and the simulator don't need EPICS
+    import pvio
+
+    currentPV = args.pv + pvio.OUT_CUR
+    pvs = pvio.PVGroup([currentPV], verbose=args.verbose)
+    if len(pvs.connect()) > 0 and not args.force:
+        print('Could not connect to ' + currentPV + '\nExiting...')
+        exit()
 
-    pid = PID(Kp=args.proportional, Kd=args.derivative, Ki=args.integral, setpoint=args.niveau)
+    coefficient = calibratedCoefficient(args)
 
-    x = []
-    y1 = []
-    y2 = []
-    y3 = []
+    # the position is only read when a new measurement arrived
+    source = positionsource.fromArgs(args)
 
-    plt.ion() # plot all graphs in the same window
+    pid = VectorPID(kp=args.proportional, ki=args.integral, kd=args.derivative, setpoint=args.niveau, outputLimits=(args.min, args.max),
+                    derivativeFilter=args.derivative_filter)
 
-    startTime = time()
+    # the PID controller sees the filtered position, the log and the plot the raw one
+    inputFilter = filters.fromArgs(args, args.delay)
+
+    # learns the periodic part of the noise and corrects it ahead of the PID controller
+    compensation = feedforward.fromArgs(args)
 
-    graphLen = 80
+    # the plot runs in its own process and never blocks the loop
+    plot = None
+    if args.visualize == True:
+        plot = renderer.LivePlot('PID-Controller', ['Current Position', 'Niveau'], graphLen=80, fps=args.fps)
 
     # log options
+    logger = None
     if args.log == True:
-        logFile = args.log_file
-        header = 'PID-Controller Log File\nPV: ' + str(args.pv) + '\nKp: ' + str(args.proportional) + '\nKi: ' + str(args.integral) + '\nKd: ' + str(args.derivative) + '\nNiveau: ' + str(args.niveau) + '\nDelay: ' + str(args.delay) + '\n\n'
-        with open(logFile, 'w') as l:
-            l.write(header)
-            l.write('time, current pos, corrected pos, current shift, current current, new current')
-            l.close()
+        # rows are written by a background thread
+        logger = telemetry.fromArgs(args, NORMAL_COLUMNS, telemetry.parameterHeader(args))
+
+    loop = scheduler.fromArgs(args, args.delay)
+
+    # gains, niveau and delay can be changed while the loop is running
+    controls = control.fromArgs(args, pid, loop, logger, inputFilter=inputFilter)
+
+    # timing of every stage of the loop
+    probes, metricsServer = metrics.fromArgs(args, args.pv, ['read', 'get', 'pid', 'put', 'log', 'plot', 'control'], loop)
+
+    # stale positions, lost PVs and a stalled loop stop the corrections
+    guard = watchdog.fromArgs(args, lambda: pvs.get(currentPV), lambda value: pvs.put(currentPV, value), pid=pid, loop=loop,
+                              threadInit=pvs.attachThread, logger=logger)
+
+    loop.start()
+    # the time column shares its origin with loop.elapsed(), which stamps the notes
+    startTime = time()
 
     try:
         while True:
-            f = open('position.txt', 'r')
-            current_pos = float(f.read())
-            f.close()
+            probes.begin()
+            guard.beat()
+            if args.delay <= 0:
+                # free running, every new measurement is handled as soon as it arrives
+                sample = source.wait(args.position_timeout)
+            else:
+                sample = source.poll()
+            probes.mark('read')
+
+            # served by the monitor, None if the PV is gone
+            current_current = pvs.get(currentPV)
+            probes.mark('get')
+
+            guard.report('position', not source.stale())
+            guard.report('connection', current_current is not None and pvs.connected(currentPV))
+            if not guard.update() or sample is None:
+                # nothing new to correct for, or a failed check. The PID step is skipped, so the integrator is frozen
+                if compensation is not None and guard.faulted:
+                    # the held or ramped current isn't a shift of the feed-forward, it stops learning until the loop resumes
+                    compensation.pause()
+                if controls is not None:
+                    controls.poll()
+                probes.end(loop.wait())
+                continue
+
+            current_pos = sample[0]
+            probes.error(args.niveau - current_pos)
 
             # get new value
-            corrected_pos = float(pid(current_pos)) + current_pos
-
-            pos_shift = corrected_pos - current_pos
+            pos_shift = pid(current_pos if inputFilter is None else inputFilter(current_pos))
+            if compensation is not None:
+                pos_shift = compensation(time() - startTime, current_pos, pos_shift)
+            corrected_pos = pos_shift + current_pos
 
-            current_shift = deltaI(pos_shift)
+            current_shift = deltaI(pos_shift, coefficient)
+            probes.mark('pid')
 
-            # write new value to pv
-            current_current = caget(args.pv + ':outCur')
-            new_current = current_current - current_shift
-            caput(args.pv + ':outCur', new_current)
-            
+            # write new value to pv, at most --slew-rate away from the current one
+            new_current = guard.apply(current_current, current_current - current_shift)
+            if compensation is not None:
+                # the feed-forward learns from the shift that reached the magnet, not the commanded one
+                compensation.confirm((current_current - new_current) / coefficient)
+            probes.mark('put')
 
             if args.verbose >= 2:
                 print('time: ' + str(time()-startTime) + ', current_pos: ' + str(current_pos) + ', corrected_pos: ' + str(corrected_pos) + ', current_shift: ' + str(current_shift) + ', current_current: ' + str(current_current) + ', new_current: ' + str(new_current) + '')
 
-            if args.log == True:
-                logFile = args.log_file
-                l = open(logFile, 'a')
-                l.write(str(time() - startTime) + ', ' + str(current_pos) + ', ' + str(corrected_pos) + ', ' + str(current_shift) + ', ' + str(current_current) + ', ' + str(new_current) + '\n')
-                l.close()
-            
+            if logger is not None:
+                logger.log(time() - startTime, current_pos, corrected_pos, current_shift, current_current, new_current)
+            probes.mark('log')
             
             # plotting
-            if args.visualize == True:
+            if plot is not None:
+                plot.publish(time() - startTime, (current_pos, args.niveau))
+            probes.mark('plot')
 
-                x.append(time() - startTime)
-                y1.append(current_pos)
-                y2.append(args.niveau)
+            # apply parameter changes between two cycles
+            if controls is not None:
+                controls.poll()
+            probes.mark('control')
 
-                # makes sure that the graph doesnt grow infinitly
-                if len(x) >= graphLen:
-                    x.pop(0)
-                if len(y1) >= graphLen:
-                    y1.pop(0)
-                if len(y2) >= graphLen:
-                    y2.pop(0)
-                if len(y3) >= graphLen:
-                    y3.pop(0)
+            # wait for the deadline of the next cycle
+            probes.end(loop.wait())
+    except KeyboardInterrupt:
+        print('\nKeyboard interrupt detected')
+        print(loop.summary())
+        print(probes.summary())
+        if metricsServer is not None:
+            metricsServer.close()
+        if plot is not None:
+            plot.close()
+        if controls is not None:
+            controls.close()
+        guard.close()
+        print(guard.summary())
+        source.close()
+        if logger is not None:
+            # flushes the remaining rows
+            logger.close()
+        print('Exiting...')
+        exit()
 
-                plt.cla() # clear axes
+def autotuneMode(args):
+    # imported here, autotune uses the simulator which imports this module
+    import autotune
+    import json
 
-                plt.title('PID-Controller')
-                plt.plot(x, y1, label='Current Position')
-                plt.plot(x, y2, label='Niveau')
-                plt.legend(loc='upper left')
+    if args.plant == 'debug':
+        debugFile = args.file
+        channel = openDebugChannel(args, debugFile)
 
-                plt.pause(0.1)
+        def read():
+            return getCurrentVal(args=args, debugFile=debugFile, channel=channel)
 
-            sleep(args.delay)
+        def apply(pos, u):
+            writeDebugVal(debugFile, pos + u, channel)
+    else:
+        import pvio
+        currentPV = args.pv + pvio.OUT_CUR
+        pvs = pvio.PVGroup([currentPV], verbose=args.verbose)
+        if len(pvs.connect()) > 0 and not args.force:
+            print('Could not connect to ' + currentPV + '\nExiting...')
+            exit()
+
+        coefficient = calibratedCoefficient(args)
+        source = positionsource.fromArgs(args)
+
+        def read():
+            # every step of the experiment waits for a new measurement
+            if source.wait(args.position_timeout) is None:
+                print('No new position within ' + str(args.position_timeout) + ' s\nExiting...')
+                exit()
+            return source.value()
+
+        def readCurrent():
+            current = pvs.get(currentPV)
+            if current is None or not pvs.connected(currentPV):
+                print('Lost the connection to ' + currentPV + '\nExiting...')
+                exit()
+            return current
+
+        # the experiment moves the steerer, it is put back afterwards
+        start = readCurrent()
+
+        def apply(pos, u):
+            pvs.put(currentPV, readCurrent() - deltaI(u, coefficient))
+
+    loop = scheduler.fromArgs(args, args.delay)
+    limits = (args.min, args.max)
+
+    try:
+        print('Running relay experiment with amplitude ' + str(args.relay_amplitude) + '...')
+        record = autotune.relayExperiment(read, apply, args.niveau, args.relay_amplitude, loop, cycles=args.cycles, maxSteps=args.max_steps)
+        try:
+            ku, tu = autotune.analyzeRelay(record, args.relay_amplitude)
+        except RuntimeError as e:
+            print('Error: ' + str(e) + '\nTry a larger --relay-amplitude or --max-steps\nExiting...')
+            exit()
+        zn = autotune.zieglerNichols(ku, tu)
+        print('Ku: ' + str(ku) + ', Tu: ' + str(tu) + ' s')
+        print('Ziegler-Nichols: -p ' + str(zn[0]) + ' -i ' + str(zn[1]) + ' -d ' + str(zn[2]))
+
+        plantGain, disturbance, dt = autotune.identifyPlant(record)
+        if args.verbose >= 1:
+            print('plant gain: ' + str(plantGain) + ', step time: ' + str(dt) + ' s')
+        gains, simulated = autotune.refineGains(zn, disturbance, dt, plantGain, args.niveau, start=record['position'][0], outputLimits=limits,
+                                                iterations=args.refine_iterations, verbose=args.verbose)
+        print('Refined: -p ' + str(gains[0]) + ' -i ' + str(gains[1]) + ' -d ' + str(gains[2]))
+
+        performance = {}
+        if args.verify_steps > 0:
+            print('Measuring the loop performance...')
+            performance = autotune.measurePerformance(read, apply, gains, args.niveau, loop, steps=args.verify_steps, outputLimits=limits)
+            for key, value in performance.items():
+                print(key + ': ' + str(value))
     except KeyboardInterrupt:
         print('\nKeyboard interrupt detected\nExiting...')
         exit()
+    finally:
+        if args.plant != 'debug':
+            print('Restoring the starting current ' + str(start) + ' A')
+            pvs.put(currentPV, start)
+
+    if args.output is not None:
+        result = {'proportional': gains[0], 'integral': gains[1], 'derivative': gains[2], 'niveau': args.niveau, 'delay': args.delay,
+                  'ultimate gain': ku, 'ultimate period': tu, 'ziegler nichols': list(zn),
+                  'simulated': {name: float(simulated[name]) for name in ('settling', 'overshoot', 'iae', 'ise', 'effort', 'rms')},
+                  'measured': performance}
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=4)
+        print('Gains written to ' + str(args.output))
+
+
+def gainSet(value: str) -> tuple:
+    kp, ki, kd = (float(v) for v in value.split(':'))
+    return kp, ki, kd
+
+def replayMode(args):
+    import replay
+    import numpy as np
+
+    try:
+        parameters, names, data, changes = replay.loadLog(args.logs)
+        column = replay.measurementColumn(names, args.column)
+    except (OSError, ValueError) as e:
+        print('Could not read ' + ', '.join(args.logs) + ': ' + str(e) + '\nExiting...')
+        exit()
+    measurement = np.ascontiguousarray(data[column], dtype=float)
+    if len(measurement) == 0:
+        print('The log is empty\nExiting...')
+        exit()
+
+    # the recorded output of the controller, if the log has one
+    reference = None
+    corrected = replay.CORRECTED_COLUMNS.get(column)
+    if corrected in data:
+        reference = np.asarray(data[corrected]) - measurement
+
+    if 'time' not in data and args.delay <= 0:
+        print('The log has no time column, the time step has to be given with -D\nExiting...')
+        exit()
+    dt = replay.timeSteps(data, args.delay)
+
+    # channel 0 replays the recorded gains, the others the new ones
+    labels = []
+    sets = []
+    niveaus = []
+    if all(key in parameters for key in ('kp', 'ki', 'kd')):
+        labels.append('recorded')
+        sets.append((parameters['kp'], parameters['ki'], parameters['kd']))
+        niveaus.append(parameters.get('niveau', args.niveau))
+    else:
+        changes = []
+    for gains in [(args.proportional, args.integral, args.derivative)] + args.gains:
+        labels.append('-p ' + str(gains[0]) + ' -i ' + str(gains[1]) + ' -d ' + str(gains[2]))
+        sets.append(gains)
+        niveaus.append(args.niveau)
+    sets = np.array(sets)
+    pid = VectorPID(sets[:, 0], sets[:, 1], sets[:, 2], setpoint=niveaus, outputLimits=(args.min, args.max), derivativeFilter=args.derivative_filter)
+
+    publish = None
+    plot = None
+    if args.visualize == True:
+        plot = renderer.LivePlot('Replay', ['Measurement'] + labels, graphLen=1000, fps=args.fps)
+        times = np.cumsum(dt)
+
+        def publish(k, output):
+            plot.publish(times[k], [measurement[k]] + list(output))
+
+    print('Replaying ' + str(len(measurement)) + ' rows with ' + str(len(labels)) + ' gain sets...')
+    startTime = time()
+    try:
+        outputs = replay.replay(measurement, dt, pid, changes=changes, speed=args.speed, publish=publish)
+    except KeyboardInterrupt:
+        print('\nKeyboard interrupt detected\nExiting...')
+        if plot is not None:
+            plot.close()
+        exit()
+    duration = time() - startTime
+    print('Replayed ' + str(round(float(np.sum(dt)), 1)) + ' s of data in ' + str(round(duration, 2)) + ' s')
+    if plot is not None:
+        plot.close()
+
+    if reference is None:
+        print('The log has no recorded output, only the new outputs are compared')
+    for label, result in zip(labels, replay.compare(reference, outputs)):
+        print(label + ': ' + ', '.join(key + ': ' + str(round(value, 6)) for key, value in result.items()))
+
+    if args.output is not None:
+        columns = [np.cumsum(dt) - dt[0], measurement]
+        names = ['time', column]
+        if reference is not None:
+            columns.append(reference)
+            names.append('recorded output')
+        columns.extend(outputs.T)
+        names.extend(labels)
+        np.savetxt(args.output, np.column_stack(columns), delimiter=', ', header=', '.join(names), comments='')
+        print('Outputs written to ' + str(args.output))
+
+
+def mimoMode(args):
+    import mimo
+    import numpy as np
+
+    try:
+        response = mimo.loadResponse(args.response)
+    except (OSError, ValueError, KeyError) as e:
+        print('Could not load the response matrix ' + str(args.response) + ': ' + str(e) + '\nExiting...')
+        exit()
+    matrix = response['matrix']
+    bpms = response['bpms']
+    steerers = response['steerers']
+    inverse = mimo.cachedInverse(args.response, matrix, modes=args.modes, alpha=args.alpha, cutoff=args.cutoff, verbose=args.verbose)
+    print(str(len(bpms)) + ' BPMs, ' + str(len(steerers)) + ' steerers, ' + str(inverse.kept) + ' modes used')
+    if args.verbose >= 1:
+        print('singular values: ' + ', '.join(str(round(float(s), 6)) for s in inverse.singular))
+
+    # one PID controller per mode
+    pid = VectorPID(kp=args.proportional, ki=args.integral, kd=args.derivative, outputLimits=(args.min, args.max), channels=inverse.kept,
+                    derivativeFilter=args.derivative_filter)
+    niveau = response.get('niveau', args.niveau)
+    controller = mimo.MimoController(inverse, pid, niveau, maxStep=args.max_step)
+
+    target = np.broadcast_to(np.asarray(niveau, dtype=float), (len(bpms),))
+
+    if args.simulate > 0:
+        # the orbit starts on target and drifts with the noise of every BPM
+        dt = args.delay if args.delay > 0 else 0.1
+        noise = noiseengine.fromChannels([args] * len(bpms), dt, seed=args.seed).block(args.simulate)
+        history = mimo.simulate(controller, matrix, noise, start=target, dt=dt)
+        uncorrected = np.cumsum(noise, axis=0) + target
+        print('rms orbit error without correction: ' + str(float(np.sqrt(np.mean((uncorrected - target) ** 2)))))
+        print('rms orbit error with correction: ' + str(float(np.sqrt(np.mean((history - target) ** 2)))))
+        return
+
+    import pvio
+
+    sources = [positionsource.openSource(bpm['source'], maxAge=args.position_timeout) for bpm in bpms]
+    names = [steerer + pvio.OUT_CUR for steerer in steerers]
+    pvs = pvio.PVGroup(names, verbose=args.verbose)
+    missing = pvs.connect()
+    if len(missing) > 0 and not args.force:
+        print('Could not connect to ' + ', '.join(missing) + '\nExiting...')
+        exit()
+
+    logger = None
+    if args.log == True:
+        columns = [('time', 'f8')] + [(bpm['name'], 'f8') for bpm in bpms] + [(name, 'f8') for name in names]
+        logger = telemetry.fromArgs(args, columns, telemetry.parameterHeader(argparse.Namespace(**dict(vars(args), pv=', '.join(steerers)))))
+
+    def readCurrents():
+        # a missing steerer must never turn into NaN on the magnets
+        values = pvs.getMany(names)
+        if any(value is None for value in values):
+            return None
+        return np.array(values, dtype=float)
+
+    positions = np.zeros(len(bpms))
+    stale = False
+    loop = scheduler.fromArgs(args, args.delay)
+    probes, metricsServer = metrics.fromArgs(args, 'mimo', ['read', 'get', 'pid', 'put', 'log'], loop)
+
+    # stale BPMs, lost steerers and a stalled loop stop the corrections, like in the normal mode
+    guard = watchdog.fromArgs(args, readCurrents, lambda values: pvs.putMany(dict(zip(names, np.asarray(values).tolist()))), pid=pid, loop=loop,
+                              threadInit=pvs.attachThread, logger=logger)
+    loop.start()
+    startTime = time()
+
+    try:
+        while True:
+            probes.begin()
+            guard.beat()
+            fresh = [source.poll() is not None for source in sources]
+            probes.mark('read')
+            currents = readCurrents()
+            probes.mark('get')
+
+            staleBpms = [bpm['name'] for bpm, source in zip(bpms, sources) if source.stale()]
+            if len(staleBpms) > 0 and not stale:
+                print('BPM ' + ', '.join(staleBpms) + ' stale, no corrections are applied')
+            stale = len(staleBpms) > 0
+            guard.report('position', not stale)
+            guard.report('connection', currents is not None and all(pvs.connected(name) for name in names))
+            if not guard.update() or not any(fresh):
+                # the orbit is only corrected when it was measured again and all checks pass
+                probes.end(loop.wait())
+                continue
+            for i, source in enumerate(sources):
+                positions[i] = source.value()
+            probes.error(float(np.sqrt(np.mean((positions - target) ** 2))))
+
+            delta = controller.step(positions)
+            probes.mark('pid')
+            # at most --slew-rate away from the current values
+            currents = guard.apply(currents, currents + delta)
+            probes.mark('put')
+
+            if args.verbose >= 2:
+                print('time: ' + str(time() - startTime) + ', positions: ' + str(positions.tolist()) + ', currents: ' + str(currents.tolist()))
+            if logger is not None:
+                logger.log(time() - startTime, *positions.tolist(), *currents.tolist())
+            probes.mark('log')
+
+            probes.end(loop.wait())
+    except KeyboardInterrupt:
+        print('\nKeyboard interrupt detected')
+        print(loop.summary())
+        print(probes.summary())
+        guard.close()
+        print(guard.summary())
+        if metricsServer is not None:
+            metricsServer.close()
+        for source in sources:
+            source.close()
+        if logger is not None:
+            logger.close()
+        print('Exiting...')
+        exit()
+
+
+def cascadeMode(args):
+    """
+    The position loop sets the reference current, the current loop holds the readback on it.
+    Both run in this thread on their own deadlines.
+    """
+    import pvio
+
+    readbackPV = args.pv + args.readback_suffix
+    commandPV = args.pv + args.command_suffix
+    if commandPV == readbackPV:
+        # the current loop would only see the echo of its own writes
+        print('The current loop needs a command PV that differs from the readback ' + readbackPV + '\nExiting...')
+        exit()
+    pvs = pvio.PVGroup([readbackPV, commandPV], verbose=args.verbose)
+    missing = pvs.connect()
+    if len(missing) > 0 and not args.force:
+        print('Could not connect to ' + ', '.join(missing) + '\nExiting...')
+        exit()
+
+    coefficient = calibratedCoefficient(args)
+    source = positionsource.fromArgs(args)
+
+    innerPeriod = 1 / args.inner_rate
+    # without -D the position loop checks for a new sample on every tick of the current loop
+    outerPeriod = args.delay if args.delay > 0 else innerPeriod
+    outer = VectorPID(kp=args.proportional, ki=args.integral, kd=args.derivative, setpoint=args.niveau, outputLimits=(args.min, args.max),
+                      derivativeFilter=args.derivative_filter)
+    inner = VectorPID(kp=args.inner_proportional, ki=args.inner_integral, kd=args.inner_derivative, outputLimits=(-args.inner_limit, args.inner_limit))
+
+    reference = pvs.get(readbackPV)
+    command = pvs.get(commandPV)
+    if reference is None or command is None:
+        print('Could not read ' + readbackPV + ' and ' + commandPV + '\nExiting...')
+        exit()
+    inner.setpoint[:] = reference
+    readback = reference
+    current_pos = float('nan')
+    stale = False
+    correcting = True
+
+    logger = None
+    if args.log == True:
+        logger = telemetry.fromArgs(args, CASCADE_COLUMNS, telemetry.parameterHeader(args))
+
+    loops = scheduler.multiRateFromArgs(args, {'current': innerPeriod, 'position': outerPeriod})
+
+    # every write of the current loop goes through the watchdog. Stale positions, lost PVs and a
+    # stalled loop stop both loops, the command is held or ramped and always slew limited
+    guard = watchdog.fromArgs(args, lambda: pvs.get(commandPV), lambda value: pvs.put(commandPV, value), pid=inner, loop=loops.loops['current'],
+                              threadInit=pvs.attachThread, logger=logger)
+    loops.start()
+    startTime = time()
+
+    try:
+        while True:
+            due = loops.wait()
+            guard.beat()
+
+            sample = None
+            if 'position' in due:
+                # polled during a fault as well, so a stale position can recover
+                sample = source.poll()
+                if source.stale() and not stale:
+                    print('The position is stale, the reference current is held')
+                stale = source.stale()
+
+            if 'current' in due:
+                value = pvs.get(readbackPV)
+                current_command = pvs.get(commandPV)
+                guard.report('position', not stale)
+                guard.report('connection', value is not None and current_command is not None and pvs.connected(readbackPV) and pvs.connected(commandPV))
+                wasCorrecting = correcting
+                correcting = guard.update()
+                if correcting and not wasCorrecting:
+                    # the command may have been ramped away, both loops restart from the readback
+                    reference = value
+                    inner.setpoint[:] = reference
+                    outer.resume()
+                if value is not None:
+                    readback = value
+                if current_command is not None:
+                    command = current_command
+
+            if correcting and sample is not None and not stale:
+                current_pos = sample[0]
+                # the position controller moves the reference of the current loop. Like the normal mode it
+                # starts from the measured current, so a slew limited command doesn't wind the reference up
+                pos_shift = outer(current_pos)
+                reference = readback - deltaI(pos_shift, coefficient)
+                inner.setpoint[:] = reference
+
+            if 'current' in due:
+                if correcting:
+                    # at most --slew-rate away from the last command
+                    target = reference + inner(readback, innerPeriod)
+                    command = guard.apply(command, target)
+                    if command != target:
+                        # back-calculation, the integrator only keeps what reached the supply
+                        inner.integral += command - target
+
+                if args.verbose >= 2:
+                    print('time: ' + str(time() - startTime) + ', current_pos: ' + str(current_pos) + ', reference: ' + str(reference) + ', readback: ' + str(readback) + ', command: ' + str(command))
+                if logger is not None:
+                    logger.log(time() - startTime, current_pos, reference, readback, command)
+    except KeyboardInterrupt:
+        print('\nKeyboard interrupt detected')
+        print(loops.summary())
+        guard.close()
+        print(guard.summary())
+        source.close()
+        if logger is not None:
+            logger.close()
+        print('Exiting...')
+        exit()
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -231,6 +762,7 @@ def main():
     
     # general options
     parentParser.add_argument('--visualize', action='store_true', default=False, help='visualize the changed values live')
+    parentParser.add_argument('--fps', type=float, default=10, help='frame rate of the live visualization. The plot is drawn by a separate process, so this doesn\'t affect the control loop. The default is 10')
     parentParser.add_argument('--version', action='version', version=ver)
     parentParser.add_argument('-v', '--verbose', action='count', default=0, help='verbose output')
     parentParser.add_argument('--force', action='store_true', default=False,
@@ -247,15 +779,19 @@ def main():
     pidControllerOptions.add_argument('-n', '--niveau', type=float, default=1,
                         help='specifys the niveau that the PID controler should aim for')
     pidControllerOptions.add_argument('--min', type=float, default=-3,
-                        help='specifys the minimum value for the PID controller')
+                        help='specifys the minimum output of the PID controller. The integral term is clamped to it as well (anti-windup)')
     pidControllerOptions.add_argument('--max', type=float, default=3,
-                        help='specifys the maximum value for the PID controller')
-    pidControllerOptions.add_argument('-D', '--delay', type=float, default=0.0, help='specifys the delay between the PID controller reading the current value and outputting the new value. This is 0 by default')
+                        help='specifys the maximum output of the PID controller. The integral term is clamped to it as well (anti-windup)')
+    pidControllerOptions.add_argument('--derivative-filter', type=float, default=None,
+                        help='alpha of the exponential moving average that smooths the derivative term, e.g. 0.2. Off by default')
+    pidControllerOptions.add_argument('-D', '--delay', type=float, default=0.0, help='specifys the period of the control loop in seconds. Cycles start on fixed deadlines, so the time spent in a cycle doesn\'t add to it. This is 0 (free running) by default')
+    scheduler.addSchedulerArguments(parentParser)
     
     # logging
     loggingOptions = parentParser.add_argument_group('logging options')
     loggingOptions.add_argument('--log', action='store_true', default=False, help='the program will log the used values if this flag is used. the default file is "log.txt"')
     loggingOptions.add_argument('--log-file', type=Path, default=Path('log.txt'), help='the file used for logging')
+    telemetry.addLoggingArguments(loggingOptions)
     
     # Subcommands
     subparsers = parser.add_subparsers(dest='mode', help='the program can use an epics interface or a debug enviroment controlled by another script')
@@ -264,11 +800,73 @@ def main():
     # normal mode
     pvParser = subparsers.add_parser('normal', help='uses the epics interface', parents=[parentParser])
     pvParser.add_argument('--pv', type=str, default='I1SV02' ,help='the process variable that should be controlled. The default is I1SV02')
+    pvParser.add_argument('--calibration', type=str, default=None, help='calibration file of randomNoise.py measure, replaces the default deltaI coefficient')
+    positionsource.addPositionArguments(pvParser)
+    watchdog.addWatchdogArguments(pvParser)
+    control.addControlArguments(pvParser)
+    feedforward.addFeedForwardArguments(pvParser)
+    filters.addFilterArguments(pvParser)
+    metrics.addMetricsArguments(pvParser)
     
     # debug mode
     debugParser = subparsers.add_parser('debug', help='uses a test enviroment instead of the epics interface', parents=[parentParser])
     debugParser.add_argument('-f', '--file', type=str, default='debugEnv.txt', help='the text file used for simulating the debug enviroment. The default name is "debugEnv.txt"')
+    debugParser.add_argument('--channel', type=str, choices=['file', 'shm'], default='file', help='the transport used for the debug enviroment. "shm" uses a shared memory segment named after the debug file instead of the file itself. Has to match the setting of randomNoise.py. The default is "file"')
+    control.addControlArguments(debugParser)
+    feedforward.addFeedForwardArguments(debugParser)
+    filters.addFilterArguments(debugParser)
+    metrics.addMetricsArguments(debugParser)
+
+    # autotune mode
+    autotuneParser = subparsers.add_parser('autotune', help='derives gains from a relay experiment and refines them in the simulator', parents=[parentParser])
+    autotuneParser.add_argument('--plant', type=str, choices=['debug', 'normal'], default='debug', help='tune against the debug enviroment or the epics interface. The default is "debug"')
+    autotuneParser.add_argument('--pv', type=str, default='I1SV02' ,help='the process variable used with --plant normal. The default is I1SV02')
+    autotuneParser.add_argument('-f', '--file', type=str, default='debugEnv.txt', help='the debug enviroment used with --plant debug. The default name is "debugEnv.txt"')
+    autotuneParser.add_argument('--channel', type=str, choices=['file', 'shm'], default='file', help='the transport used for the debug enviroment. The default is "file"')
+    autotuneParser.add_argument('--calibration', type=str, default=None, help='calibration file of randomNoise.py measure, used with --plant normal')
+    positionsource.addPositionArguments(autotuneParser)
+    autotuneParser.add_argument('--relay-amplitude', type=float, default=0.2, help='output amplitude of the relay experiment. The default is 0.2')
+    autotuneParser.add_argument('--cycles', type=int, default=10, help='number of oscillations used for the analysis. The default is 10')
+    autotuneParser.add_argument('--max-steps', type=int, default=5000, help='maximum number of steps of the relay experiment. The default is 5000')
+    autotuneParser.add_argument('--refine-iterations', type=int, default=50, help='maximum number of optimizer iterations. The default is 50')
+    autotuneParser.add_argument('--verify-steps', type=int, default=200, help='number of steps used to measure the loop performance of the tuned gains, 0 disables it. The default is 200')
+    autotuneParser.add_argument('-o', '--output', type=str, default=None, help='writes the gain set and the performance to this json file')
     
+    # mimo mode
+    mimoParser = subparsers.add_parser('mimo', help='corrects the orbit with several BPMs and steerers using a response matrix', parents=[parentParser])
+    mimoParser.add_argument('response', type=str, help='json file with the BPMs, the steerers and the response matrix, see mimo.py')
+    mimoParser.add_argument('--modes', type=int, default=None, help='number of singular value modes that are corrected. All usable modes by default')
+    mimoParser.add_argument('--alpha', type=float, default=0.0, help='Tikhonov regularization, damps modes with singular values below alpha. The default is 0')
+    mimoParser.add_argument('--cutoff', type=float, default=1e-3, help='modes with singular values below cutoff times the largest are dropped. The default is 0.001')
+    mimoParser.add_argument('--max-step', type=float, default=None, help='largest current change of a steerer per cycle in A. The correction is scaled down as a whole')
+    mimoParser.add_argument('--simulate', type=int, default=0, help='runs this many steps against the response matrix with simulated noise instead of the epics interface')
+    positionsource.addPositionArguments(mimoParser)
+    watchdog.addWatchdogArguments(mimoParser)
+    metrics.addMetricsArguments(mimoParser)
+    noiseengine.addNoiseArguments(mimoParser)
+
+    # cascade mode
+    cascadeParser = subparsers.add_parser('cascade', help='a fast current loop on the readback under the position loop', parents=[parentParser])
+    cascadeParser.add_argument('--pv', type=str, default='I1SV02', help='the steerer that should be controlled. The default is I1SV02')
+    cascadeParser.add_argument('--readback-suffix', type=str, default=':outCur', help='suffix of the current readback PV. The default is ":outCur"')
+    cascadeParser.add_argument('--command-suffix', type=str, default=':setCur', help='suffix of the setpoint PV the current loop writes, it has to differ from the readback. The default is ":setCur"')
+    cascadeParser.add_argument('--inner-rate', type=float, default=100, help='rate of the current loop in Hz. The position loop runs with -D. The default is 100')
+    cascadeParser.add_argument('--inner-proportional', type=float, default=0.5, help='proportional coefficient of the current loop. The default is 0.5')
+    cascadeParser.add_argument('--inner-integral', type=float, default=10, help='integral coefficient of the current loop in 1/s. The default is 10')
+    cascadeParser.add_argument('--inner-derivative', type=float, default=0, help='derivative coefficient of the current loop. The default is 0')
+    cascadeParser.add_argument('--inner-limit', type=float, default=1.0, help='largest correction of the current loop in A. The default is 1.0')
+    cascadeParser.add_argument('--calibration', type=str, default=None, help='calibration file of randomNoise.py measure, replaces the default deltaI coefficient')
+    positionsource.addPositionArguments(cascadeParser)
+    watchdog.addWatchdogArguments(cascadeParser)
+
+    # replay mode
+    replayParser = subparsers.add_parser('replay', help='replays recorded logs through the controller with new gains', parents=[parentParser])
+    replayParser.add_argument('logs', type=str, nargs='+', help='csv or binary log files, the files of a rotated log in order')
+    replayParser.add_argument('--gains', type=gainSet, action='append', default=[], help='additional gain set as "kp:ki:kd". Can be used multiple times')
+    replayParser.add_argument('--speed', type=float, default=0, help='replays at this multiple of the recorded speed. 0 replays as fast as possible, which is the default')
+    replayParser.add_argument('--column', type=str, default=None, help='the column used as the measurement. The default is "current pos" or "current Value"')
+    replayParser.add_argument('-o', '--output', type=str, default=None, help='writes the recorded and replayed outputs to this csv file')
+
     args = parser.parse_args()
 
 
@@ -293,6 +891,14 @@ def main():
         debugMode(args)
     elif args.mode == 'normal':
         normalMode(args)
+    elif args.mode == 'autotune':
+        autotuneMode(args)
+    elif args.mode == 'replay':
+        replayMode(args)
+    elif args.mode == 'mimo':
+        mimoMode(args)
+    elif args.mode == 'cascade':
+        cascadeMode(args)
     else:
         print('Something went wrong while parsing the arguments\nExiting...')
         exit()
@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+"""
+Vectorized PID engine.
+
+Gains, setpoints, output limits and the integrator state of N channels are kept in
+NumPy arrays, one step() updates all channels at once. The behaviour of a single
+channel matches simple_pid.PID: proportional on error, derivative on measurement and
+an integral term that is clamped to the output limits (anti-windup).
+With derivativeFilter set, the derivative term is smoothed by an exponential moving
+average with that alpha, so measurement noise isn't amplified by Kd.
+Calling a single channel controller with a scalar takes a float path with the same state,
+which is several times faster than the array step.
+"""
+from time import monotonic
+import numpy as np
+
+
+def _channelArray(value, channels: int) -> np.ndarray:
+    return np.array(np.broadcast_to(np.asarray(value, dtype=float), (channels,)))
+
+
+class VectorPID:
+    def __init__(self, kp, ki, kd, setpoint=0.0, outputLimits=(None, None), channels: int = None, derivativeFilter: float = None):
+        if channels is None:
+            channels = max(np.size(kp), np.size(ki), np.size(kd), np.size(setpoint))
+        self.channels = channels
+        self.kp = _channelArray(kp, channels)
+        self.ki = _channelArray(ki, channels)
+        self.kd = _channelArray(kd, channels)
+        self.setpoint = _channelArray(setpoint, channels)
+        self.setLimits(*outputLimits)
+        if derivativeFilter is not None and not 0 < derivativeFilter <= 1:
+            raise ValueError('the derivative filter alpha has to be in (0, 1], not ' + str(derivativeFilter))
+        self.derivativeFilter = derivativeFilter
+
+        self.integral = np.zeros(channels)
+        self.lastInput = np.zeros(channels)
+        self.output = np.zeros(channels)
+        self.derivative = np.zeros(channels)
+        self.first = True
+        self.lastTime = monotonic()
+
+        # scratch buffers, so a step doesn't allocate
+        self._error = np.zeros(channels)
+        self._term = np.zeros(channels)
+
+    def setLimits(self, lower=None, upper=None):
+        if lower is None:
+            lower = -np.inf
+        if upper is None:
+            upper = np.inf
+        self.lower = _channelArray(lower, self.channels)
+        self.upper = _channelArray(upper, self.channels)
+
+    def setGains(self, kp=None, ki=None, kd=None):
+        # the integrator keeps the accumulated Ki*error*dt, so changing Ki doesn't make the output jump
+        if kp is not None:
+            self.kp[:] = kp
+        if ki is not None:
+            self.ki[:] = ki
+        if kd is not None:
+            self.kd[:] = kd
+
+    def reset(self):
+        self.integral[:] = 0
+        self.lastInput[:] = 0
+        self.output[:] = 0
+        self.derivative[:] = 0
+        self.first = True
+        self.lastTime = monotonic()
+
+    def resume(self):
+        # after skipped steps the derivative starts anew, the integrator keeps its state
+        self.first = True
+        self.lastTime = monotonic()
+
+    def step(self, measurement, dt=None) -> np.ndarray:
+        """
+        Updates all channels with the measurements and returns the outputs.
+        dt is the time since the last step in seconds (scalar or per channel). If it is
+        None the time is taken from the monotonic clock like simple_pid does.
+        The returned array is reused by the next step.
+        """
+        if dt is None:
+            now = monotonic()
+            dt = now - self.lastTime
+            if dt <= 0:
+                dt = 1e-16
+            self.lastTime = now
+
+        error = self._error
+        term = self._term
+        np.subtract(self.setpoint, measurement, out=error)
+
+        # integral with anti-windup
+        np.multiply(self.ki, error, out=term)
+        term *= dt
+        self.integral += term
+        np.clip(self.integral, self.lower, self.upper, out=self.integral)
+
+        # derivative on measurement, avoids a kick when the setpoint changes
+        if self.first:
+            term[:] = 0
+            self.first = False
+        else:
+            np.subtract(measurement, self.lastInput, out=term)
+            term *= self.kd
+            term /= dt
+            if self.derivativeFilter is not None:
+                self.derivative += self.derivativeFilter * (term - self.derivative)
+                term[:] = self.derivative
+        self.lastInput[:] = measurement
+
+        out = self.output
+        np.multiply(self.kp, error, out=out)
+        out += self.integral
+        out -= term
+        np.clip(out, self.lower, self.upper, out=out)
+        return out
+
+    def scalarStep(self, measurement: float, dt=None) -> float:
+        """
+        step() of a single channel loop with python floats, the NumPy calls of step()
+        cost more than the arithmetic itself. Uses and updates the same state.
+        """
+        if dt is None:
+            now = monotonic()
+            dt = now - self.lastTime
+            if dt <= 0:
+                dt = 1e-16
+            self.lastTime = now
+        measurement = float(measurement)
+        lower = float(self.lower[0])
+        upper = float(self.upper[0])
+        error = float(self.setpoint[0]) - measurement
+
+        # integral with anti-windup
+        integral = float(self.integral[0]) + float(self.ki[0]) * error * dt
+        integral = min(max(integral, lower), upper)
+        self.integral[0] = integral
+
+        # derivative on measurement, avoids a kick when the setpoint changes
+        if self.first:
+            term = 0.0
+            self.first = False
+        else:
+            term = float(self.kd[0]) * (measurement - float(self.lastInput[0])) / dt
+            if self.derivativeFilter is not None:
+                derivative = float(self.derivative[0])
+                term = derivative + self.derivativeFilter * (term - derivative)
+                self.derivative[0] = term
+        self.lastInput[0] = measurement
+
+        out = min(max(float(self.kp[0]) * error + integral - term, lower), upper)
+        self.output[0] = out
+        return out
+
+    def __call__(self, measurement, dt=None):
+        # scalar convenience for single channel loops
+        # np.ndim alone costs more than the scalar step, floats are checked first
+        if self.channels == 1 and (isinstance(measurement, float) or np.ndim(measurement) == 0):
+            return self.scalarStep(measurement, dt)
+        return self.step(measurement, dt)
@@ -1,60 +1,64 @@
 #!/usr/bin/python3
-from epics import caget
-import matplotlib.pyplot as plt
+import telemetry
+import renderer
+import scheduler
 import argparse
 from time import time, asctime
 
-def main(args):
-    x = []
-    y1 = []
-    y2 = []
+def plotNoise(args):
+    # imported here, so --help works without EPICS
+    import pvio
 
-    plt.ion()
+    # with --no-delete old data is kept at a coarser resolution instead of growing without bound
+    archive = None
+    if args.no_delete:
+        archive = [(args.graph_len, 10), (args.graph_len, 100)]
+    plot = renderer.LivePlot("Noise", [args.pv1, args.pv2], graphLen=args.graph_len, fps=10,
+                             xlabel="Time (s)", ylabel="Current (A)", archive=archive)
+
+    pv_names = [args.pv1 + pvio.OUT_CUR, args.pv2 + pvio.OUT_CUR]
+    pvs = pvio.PVGroup(pv_names)
+    pvs.connect()
 
-    graph_len = args.graph_len
     start_time = time()
 
+    logger = None
     if not args.no_log:
-        f = open(args.log_file, "w")
-        f.write("Time\t\t\t\tPV1: " + args.pv1 + "\t\tPV2: " + args.pv2 + "\n")
+        columns = [("Time", "U24"), ("PV1: " + args.pv1, "f8"), ("PV2: " + args.pv2, "f8")]
+        logger = telemetry.TelemetryLogger(args.log_file, columns, fmt=args.log_format, delimiter="\t\t",
+                                           columnLine="Time\t\t\t\tPV1: " + args.pv1 + "\t\tPV2: " + args.pv2)
+
+    loop = scheduler.LoopScheduler(args.delay)
+    loop.start()
     try:
         while True:
-            x.append(time() - start_time)
-            y1_val = caget(args.pv1 + ":outCur")
-            y2_val = caget(args.pv2 + ":outCur")
-            y1.append(y1_val)
-            y2.append(y2_val)
-            if not args.no_delete and len(x) > graph_len:
-                x.pop(0)
-                y1.pop(0)
-                y2.pop(0)
-
-            if not args.no_log:
-                f.write(asctime() + "\t" + str(y1_val) + "\t\t" + str(y2_val) + "\n")
-
-            plt.cla()
-
-            plt.title("Noise")
-            plt.plot(x, y1, label=args.pv1)
-            plt.plot(x, y2, label=args.pv2)
-            plt.xlabel("Time (s)")
-            plt.ylabel("Current (A)")
-            plt.legend()
-            plt.pause(0.1)
+            y1_val, y2_val = pvs.getMany(pv_names)
+            plot.publish(time() - start_time, (y1_val, y2_val))
+
+            if logger is not None:
+                logger.log(asctime(), y1_val, y2_val)
+
+            loop.wait()
     except KeyboardInterrupt:
+        plot.close()
+        if logger is not None:
+            logger.close()
         print("Exiting")
 
-if __name__ == '__main__':
-    
+def main():
     parser = argparse.ArgumentParser(description='Plot noise from EPICS')
     parser.add_argument('pv1', type=str, help='PV name 1')
     parser.add_argument('pv2', type=str, help='PV name 2')
     parser.add_argument('--graph_len', type=int, default=1000, help='Length of graph (default: 1000)')
-    parser.add_argument('--no-delete', action='store_true', help='Do not delete old data')
+    parser.add_argument('--no-delete', action='store_true', help='Do not delete old data, it is kept at a lower resolution')
+    parser.add_argument('--delay', type=float, default=0.1, help='Sampling period in seconds (default: 0.1)')
     parser.add_argument('--no-log', action='store_true', help='Do not log data')
     parser.add_argument('--log-file', type=str, default='plot_noise_log.txt', help='Log file name (default: plot_noise_log.txt)')
+    parser.add_argument('--log-format', type=str, choices=['csv', 'bin'], default='csv', help='csv writes the text log, bin writes binary records (default: csv)')
+    args = parser.parse_args()
 
+    plotNoise(args)
 
-    args = parser.parse_args()
 
-    main(args)
+if __name__ == '__main__':
+    main()
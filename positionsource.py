@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+"""
+Sources of the beam position for the normal mode.
+
+Every source returns samples (value, sequence, timestamp) and only when a new one has
+arrived, so the controller doesn't correct twice for the same measurement. The sequence
+number shows missed samples, the timestamp how old a sample is. The timestamps are
+seconds since the epoch, except for the shared memory source which uses the monotonic
+clock of the host like debugchannel.py.
+
+    file:position.txt   the file is only read when its mtime, size or inode changed.
+                        writePosition replaces it atomically with "value sequence timestamp",
+                        a file holding just the value (written by older tools) works as well
+    epics:PVNAME        monitor of a PV, e.g. of the BPM IOC
+    shm:position        the shared memory segment of debugchannel.py named after "position"
+
+Run as a script it writes positions to a source or watches one:
+    python3 positionsource.py write file:position.txt 1.05
+    python3 positionsource.py watch file:position.txt
+"""
+import argparse
+import os
+import tempfile
+from pathlib import Path
+from time import monotonic, sleep, time
+import debugchannel
+
+# how often the sources without a notification mechanism are checked while waiting
+WAIT_STEP = 0.0005
+
+
+class PositionSource:
+    """
+    Common part of the sources. Subclasses implement fetch(), which returns the latest
+    sample or None if there is no new one.
+    """
+    clock = staticmethod(time)
+
+    def __init__(self, maxAge: float = None):
+        self.maxAge = maxAge
+        self.sample = None
+        self.samples = 0
+        self.missed = 0
+        self.errors = 0
+
+    def poll(self):
+        """
+        Returns the new sample, or None if there is no new one since the last call.
+        """
+        sample = self.fetch()
+        if sample is None:
+            return None
+        if self.sample is not None:
+            if sample[1] <= self.sample[1]:
+                # the same sample again, or a restarted writer that has to catch up
+                if sample[1] < self.sample[1] and sample[2] > self.sample[2]:
+                    self.sample = sample
+                    self.samples = self.samples + 1
+                    return sample
+                return None
+            self.missed = self.missed + sample[1] - self.sample[1] - 1
+        self.sample = sample
+        self.samples = self.samples + 1
+        return sample
+
+    def wait(self, timeout: float):
+        """
+        Waits until a new sample arrives and returns it, None after timeout seconds.
+        """
+        deadline = monotonic() + timeout
+        while True:
+            sample = self.poll()
+            if sample is not None or monotonic() >= deadline:
+                return sample
+            sleep(WAIT_STEP)
+
+    def value(self) -> float:
+        if self.sample is None:
+            return None
+        return self.sample[0]
+
+    def age(self) -> float:
+        if self.sample is None:
+            return float('inf')
+        return self.clock() - self.sample[2]
+
+    def stale(self) -> bool:
+        return self.maxAge is not None and self.age() > self.maxAge
+
+    def close(self):
+        pass
+
+
+def parseSample(text: str, stamp):
+    """
+    Parses "value sequence timestamp". A bare value gets the given (sequence, timestamp).
+    """
+    fields = text.split()
+    if len(fields) == 1:
+        return float(fields[0]), stamp[0], stamp[1]
+    if len(fields) != 3:
+        raise ValueError('expected "value sequence timestamp", got "' + text.strip() + '"')
+    return float(fields[0]), int(fields[1]), float(fields[2])
+
+
+class FileSource(PositionSource):
+    def __init__(self, path, maxAge: float = None):
+        super().__init__(maxAge)
+        self.path = Path(path)
+        self.stamp = None
+
+    def fetch(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stamp == self.stamp:
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                text = f.read()
+            # a bare value follows the last sample
+            sequence = 1
+            if self.sample is not None:
+                sequence = self.sample[1] + 1
+            sample = parseSample(text, (sequence, stat.st_mtime_ns / 1e9))
+        except (OSError, ValueError):
+            # caught in the middle of a non atomic write, the stamp is kept so it is read again
+            self.errors = self.errors + 1
+            return None
+        self.stamp = stamp
+        return sample
+
+
+class EpicsSource(PositionSource):
+    def __init__(self, pv: str, maxAge: float = None, timeout: float = 1.0):
+        super().__init__(maxAge)
+        import pvio
+        self.pv = pv
+        self.group = pvio.PVGroup([pv], timeout=timeout)
+        self.group.connect()
+
+    def fetch(self):
+        updates = self.group.updates[self.pv]
+        if updates == 0:
+            return None
+        timestamp = self.group.timestamps[self.pv]
+        if timestamp is None:
+            timestamp = time()
+        return float(self.group.values[self.pv]), updates, timestamp
+
+    def close(self):
+        self.group.close()
+
+
+class ShmSource(PositionSource):
+    clock = staticmethod(monotonic)
+
+    def __init__(self, name: str, maxAge: float = None):
+        super().__init__(maxAge)
+        self.channel = debugchannel.attachChannel(name)
+
+    def fetch(self):
+        return self.channel.read()
+
+    def close(self):
+        self.channel.close()
+
+
+def splitSpec(spec: str):
+    kind, found, target = spec.partition(':')
+    if not found:
+        # a bare path is a file
+        return 'file', spec
+    if kind not in ('file', 'epics', 'shm'):
+        raise ValueError('unknown position source ' + kind + ', use file:, epics: or shm:')
+    return kind, target
+
+
+def openSource(spec: str, maxAge: float = None) -> PositionSource:
+    kind, target = splitSpec(spec)
+    if kind == 'file':
+        return FileSource(target, maxAge)
+    elif kind == 'epics':
+        return EpicsSource(target, maxAge)
+    return ShmSource(target, maxAge)
+
+
+def writePosition(path, value: float, sequence: int, timestamp: float = None):
+    """
+    Replaces the file atomically, a reader sees either the old or the new sample.
+    """
+    if timestamp is None:
+        timestamp = time()
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.' + path.name + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(repr(float(value)) + ' ' + str(sequence) + ' ' + repr(timestamp) + '\n')
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class PositionWriter:
+    def __init__(self, spec: str):
+        self.kind, self.target = splitSpec(spec)
+        self.sequence = 0
+        self.channel = None
+        self.group = None
+        if self.kind == 'epics':
+            import pvio
+            self.group = pvio.PVGroup([self.target])
+            self.group.connect()
+
+    def write(self, value: float):
+        self.sequence = self.sequence + 1
+        if self.kind == 'file':
+            writePosition(self.target, value, self.sequence)
+        elif self.kind == 'shm' and self.channel is None:
+            # the segment is created with the first sample, so readers never see a placeholder
+            self.channel = debugchannel.createChannel(self.target, initial=value)
+        elif self.kind == 'shm':
+            self.channel.write(value)
+        else:
+            self.group.put(self.target, value)
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+        if self.group is not None:
+            self.group.close()
+
+
+def addPositionArguments(parser):
+    group = parser.add_argument_group('position options')
+    group.add_argument('--position-source', type=str, default='file:position.txt', help='where the beam position is read from: file:PATH, epics:PV or shm:NAME. The default is "file:position.txt"')
+    group.add_argument('--position-timeout', type=float, default=1.0, help='a position older than this many seconds is stale and no correction is applied. The default is 1.0')
+    return group
+
+
+def fromArgs(args) -> PositionSource:
+    try:
+        return openSource(args.position_source, maxAge=args.position_timeout)
+    except Exception as e:
+        print('Could not open the position source ' + args.position_source + ': ' + str(e) + '\nExiting...')
+        exit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes positions to a position source or watches one')
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.required = True
+    writeParser = subparsers.add_parser('write', help='writes one value, or a ramp with --count')
+    writeParser.add_argument('source', type=str, help='file:PATH, epics:PV or shm:NAME')
+    writeParser.add_argument('value', type=float, help='the position')
+    writeParser.add_argument('--count', type=int, default=1, help='number of samples, the value rises by --step per sample')
+    writeParser.add_argument('--step', type=float, default=0.0, help='change of the value per sample')
+    writeParser.add_argument('--delay', type=float, default=0.1, help='seconds between two samples. The default is 0.1')
+    watchParser = subparsers.add_parser('watch', help='prints every new sample with its age')
+    watchParser.add_argument('source', type=str, help='file:PATH, epics:PV or shm:NAME')
+    args = parser.parse_args()
+
+    try:
+        if args.mode == 'write':
+            writer = PositionWriter(args.source)
+            for i in range(args.count):
+                writer.write(args.value + i * args.step)
+                if i < args.count - 1:
+                    sleep(args.delay)
+            if writer.kind == 'shm':
+                # the segment disappears with its creator
+                input('Press enter to remove the segment')
+            writer.close()
+        else:
+            source = openSource(args.source)
+            while True:
+                sample = source.wait(1.0)
+                if sample is not None:
+                    print('value: ' + str(sample[0]) + ', sequence: ' + str(sample[1]) + ', age: ' + str(round(source.age() * 1e3, 3)) + ' ms, missed: ' + str(source.missed))
+    except KeyboardInterrupt:
+        print('\nExiting...')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+"""
+Persistent, non-blocking channel access for the PID-Controller scripts.
+
+Every PV is connected once as an epics.PV with a monitor. Reads are served from the
+latest monitored value, puts are issued with wait=False and several gets or puts can
+be sent together with a single flush of the CA send buffer.
+
+For tests without beamline hardware start the stand-in IOC from testioc.db:
+    softIoc -m P=I1SV02 -d testioc.db
+and measure the loop latency with:
+    python3 pvio.py I1SV02:outCur
+"""
+import argparse
+from time import perf_counter, sleep
+import epics
+
+OUT_CUR = ':outCur'
+
+
+class PVGroup:
+    def __init__(self, names=(), timeout: float = 1.0, verbose: int = 0):
+        self.timeout = timeout
+        self.verbose = verbose
+        self.pvs = {}
+        self.values = {}
+        self.updates = {}
+        self.timestamps = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name: str):
+        if name in self.pvs:
+            return self.pvs[name]
+        self.values[name] = None
+        self.updates[name] = 0
+        self.timestamps[name] = None
+        pv = epics.PV(name, auto_monitor=True, callback=self.onChange, connection_timeout=self.timeout)
+        self.pvs[name] = pv
+        return pv
+
+    def onChange(self, pvname=None, value=None, **kws):
+        self.values[pvname] = value
+        self.updates[pvname] = self.updates[pvname] + 1
+        # time the IOC processed the record, seconds since the epoch
+        self.timestamps[pvname] = kws.get('timestamp')
+
+    def connect(self, timeout: float = None) -> list:
+        """
+        Waits until all PVs are connected. Returns the names of the PVs that didn't connect.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        missing = []
+        for name, pv in self.pvs.items():
+            if not pv.wait_for_connection(timeout=timeout):
+                missing.append(name)
+        if self.verbose >= 1 and len(missing) > 0:
+            print('Could not connect to: ' + ', '.join(missing))
+        return missing
+
+    def connected(self, name: str) -> bool:
+        return self.pvs[name].connected
+
+    def attachThread(self):
+        # other threads have to join the CA context of the thread that created the PVs
+        epics.ca.use_initial_context()
+
+    def get(self, name: str):
+        if name not in self.pvs:
+            self.add(name)
+        value = self.values[name]
+        if value is None:
+            # no monitor update yet, fall back to a blocking read once
+            value = self.pvs[name].get(timeout=self.timeout, use_monitor=False)
+            if value is not None:
+                self.values[name] = value
+        return value
+
+    def getMany(self, names) -> list:
+        for name in names:
+            if name not in self.pvs:
+                self.add(name)
+        missing = [name for name in names if self.values[name] is None]
+        if len(missing) > 0:
+            # request all missing values at once and wait for them together
+            for name in missing:
+                epics.ca.get(self.pvs[name].chid, wait=False)
+            epics.ca.poll()
+            for name in missing:
+                value = epics.ca.get_complete(self.pvs[name].chid, timeout=self.timeout)
+                if value is not None:
+                    self.values[name] = value
+        return [self.values[name] for name in names]
+
+    def put(self, name: str, value, flush: bool = True):
+        if name not in self.pvs:
+            self.add(name)
+        pv = self.pvs[name]
+        epics.ca.put(pv.chid, value, wait=False)
+        # write through, so the next read doesn't see the value from before the put
+        self.values[name] = value
+        if flush:
+            epics.ca.flush_io()
+
+    def putMany(self, values: dict):
+        for name, value in values.items():
+            self.put(name, value, flush=False)
+        epics.ca.flush_io()
+
+    def close(self):
+        for pv in self.pvs.values():
+            pv.clear_callbacks()
+            pv.disconnect()
+        self.pvs = {}
+        self.values = {}
+        self.updates = {}
+        self.timestamps = {}
+
+
+_defaultGroup = None
+
+def defaultGroup() -> PVGroup:
+    # process wide group, so every caller reuses the same channels
+    global _defaultGroup
+    if _defaultGroup is None:
+        _defaultGroup = PVGroup()
+    return _defaultGroup
+
+def get(name: str):
+    return defaultGroup().get(name)
+
+def put(name: str, value):
+    defaultGroup().put(name, value)
+
+
+def measureLatency(group: PVGroup, name: str, count: int = 1000, timeout: float = 1.0) -> list:
+    """
+    Puts alternating values and measures the time until the monitor delivers them back.
+    Returns the round trip times in seconds.
+    """
+    base = group.get(name)
+    if base is None:
+        base = 0.0
+    latencies = []
+    for i in range(count):
+        value = base + (i % 2) * 1e-3
+        before = group.updates[name]
+        start = perf_counter()
+        group.put(name, value)
+        while group.updates[name] == before and perf_counter() - start < timeout:
+            epics.ca.poll(evt=1.e-5)
+        latencies.append(perf_counter() - start)
+    group.put(name, base)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the put to monitor round trip of a PV, e.g. served by "softIoc -m P=I1SV02 -d testioc.db"')
+    parser.add_argument('pv', type=str, help='the PV used for the measurement, e.g. I1SV02:outCur')
+    parser.add_argument('-n', '--count', type=int, default=1000, help='number of round trips. The default is 1000')
+    args = parser.parse_args()
+
+    group = PVGroup([args.pv])
+    if len(group.connect()) > 0:
+        print('Could not connect to ' + args.pv + '\nExiting...')
+        exit(1)
+    sleep(0.1)
+    latencies = sorted(measureLatency(group, args.pv, args.count))
+    print('round trips: ' + str(len(latencies)))
+    print('median: ' + str(latencies[len(latencies) // 2] * 1e3) + ' ms')
+    print('p99: ' + str(latencies[int(len(latencies) * 0.99)] * 1e3) + ' ms')
+    print('max: ' + str(latencies[-1] * 1e3) + ' ms')
+    group.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,15 @@
 #!/usr/bin/python3
 import argparse
+import json
 from os import remove
 from pathlib import Path
-import time
 import numpy as np
-from epics import caput, caget
 import subprocess
+from time import monotonic, sleep
+import debugchannel
+import scheduler
+import noiseengine
+import metrics
 
 ver = "1.4.0"
 author = "Valentin Reichenbach"
@@ -20,7 +24,13 @@ Version: 1.4.0
 License: GPLv3+
 """
 
-def writeToDebugFile(debugFile: str, content, args):
+def writeToDebugFile(debugFile: str, content, args, channel=None):
+    if channel is not None:
+        channel.write(content)
+        if args.verbose >= 1:
+            print('Written '+ str(content) + ' to ' + debugchannel.channelName(debugFile) + '')
+        return
+
     content = str(content)
 
     f = open(debugFile, 'w')
@@ -29,7 +39,10 @@ def writeToDebugFile(debugFile: str, content, args):
         print('Written '+ content + ' to ' + str(debugFile) + '')
     f.close()
 
-def getFromDebugFile(debugFile: str, lastVal: float, args) -> float:
+def getFromDebugFile(debugFile: str, lastVal: float, args, channel=None) -> float:
+    if channel is not None:
+        return channel.readValue()
+
     f = open(debugFile, 'r')
     content = f.read()
     f.close()
@@ -53,7 +66,6 @@ def readSinFile(verbose: int):
     return content
 
 def generateNoise(i, y, count, no_delete: bool, file: str, noise_type: str, noise_strength: float, drift: float, period: float, fileVal: float, verbose: int) -> float:
-    time_start = time.time()
     if noise_type == 'normal':
         # draws a random value from normal (Gaussian) distribution bewteen -1 and 1
         noise = noise_strength * np.random.normal(0,1,1)[0] + drift
@@ -67,9 +79,7 @@ def generateNoise(i, y, count, no_delete: bool, file: str, noise_type: str, nois
         i = i + 1
         if i >= count:
             i = 0
-        # sleep 
-        while time.time() - time_start < period/count:
-            pass
+        # the sine steps are paced by the loop period
         noise = diff + fileVal
     elif noise_type == 'mix':
         # draws a random value from a mixture of a normal distribution and a sine wave bewteen -1 and 1
@@ -82,6 +92,19 @@ def generateNoise(i, y, count, no_delete: bool, file: str, noise_type: str, nois
         return 0
     return noise , i
 
+def loopPeriod(args) -> float:
+    # without a delay a sine would run as fast as the loop, use 100 steps per period like the sine table
+    if args.delay <= 0 and args.noise_type in ('sin', 'mix'):
+        return args.period / 100
+    return args.delay
+
+def noiseDt(args) -> float:
+    # time step the noise engine uses for the sine and the step disturbances
+    period = loopPeriod(args)
+    if period <= 0:
+        return args.period / 100
+    return period
+
 def debugMode(args):
     # check if debug file already exists
     try:
@@ -95,28 +118,36 @@ def debugMode(args):
     debugFile = Path(args.file)
     # convert to str for python 3.5
     debugFile = str(debugFile)
-    writeToDebugFile(debugFile=debugFile, content=1, args=args)
+    channel = None
+    if args.channel == 'shm':
+        channel = debugchannel.createChannel(debugFile, initial=1.0)
+        if args.verbose >= 1:
+            print('Created shared memory channel ' + debugchannel.channelName(debugFile))
+    else:
+        writeToDebugFile(debugFile=debugFile, content=1, args=args)
 
     # set the last value to the niveau
     lastVal= 1.0
-    i = 0
 
-    count = 100
-    x = 2 * np.pi * np.arange(count) / count
-    y = args.amplitude * np.sin(x) + args.shift
+    # noise is generated in blocks and streamed sample by sample
+    noiseSource = noiseengine.fromArgs(args, noiseDt(args))
+
+    loop = scheduler.fromArgs(args, loopPeriod(args))
+
+    # timing of every stage of the loop
+    probes, metricsServer = metrics.fromArgs(args, 'noise', ['read', 'noise', 'write'], loop)
+
+    loop.start()
 
     try:
         while True:
+            probes.begin()
             # Writes a random value to the debugfile
-            fileVal = getFromDebugFile(debugFile=debugFile, lastVal=lastVal, args=args)
+            fileVal = getFromDebugFile(debugFile=debugFile, lastVal=lastVal, args=args, channel=channel)
             fileVal = float(fileVal)
-            noise , i = generateNoise(i, y, count, no_delete=args.no_delete, file=args.file, noise_type=args.noise_type, noise_strength=args.noise_strength, drift=args.drift, period=args.period, fileVal=fileVal, verbose=args.verbose)
-
-            # if the noise gets read incorrectly, use the last value
-            if noise == '':
-                if args.verbose >= 2:
-                    print('Error while reading noise. Using 0')
-                noise = 0
+            probes.mark('read')
+            noise = fileVal + noiseSource.next()
+            probes.mark('noise')
 
             # conversion to float because python threw an error otherwise
             if args.verbose >= 3:
@@ -125,65 +156,194 @@ def debugMode(args):
                 print('lastVal: ' + str(lastVal))
 
             # write the new value to the debug file
-            writeToDebugFile(debugFile=debugFile, content=noise, args=args)
+            writeToDebugFile(debugFile=debugFile, content=noise, args=args, channel=channel)
+            probes.mark('write')
             if args.verbose >= 3:
                 print('')
 
             # update the last value
             lastVal = noise
 
-            # wait for the next iteration
-            time.sleep(args.delay)
+            # wait for the deadline of the next iteration
+            probes.end(loop.wait())
     except KeyboardInterrupt:
-        print('\nKeyboard interrupt detected\nExiting...')
+        print('\nKeyboard interrupt detected')
+        print(loop.summary())
+        print(probes.summary())
+        print('Exiting...')
         return 
-
+    finally:
+        if channel is not None:
+            channel.close()
+        if metricsServer is not None:
+            metricsServer.close()
+
+
+def loadChannels(args) -> list:
+    """
+    Returns one namespace of noise options per PV. Entries of the pv file override the
+    command line options for their PV, e.g.
+        [{"pv": "I1SV02", "noise_strength": 0.2}, {"pv": "I1SH02", "noise_type": "sin", "phase": 1.57}]
+    """
+    entries = [{'pv': pv} for pv in args.pv]
+    if args.pv_file is not None:
+        with open(args.pv_file, 'r') as f:
+            entries = json.load(f)
+
+    channels = []
+    for entry in entries:
+        channel = argparse.Namespace(**vars(args))
+        for key, value in entry.items():
+            setattr(channel, key.replace('-', '_'), value)
+        channel.step = [tuple(step) for step in channel.step]
+        channels.append(channel)
+    return channels
 
 def normalMode(args):
     print('Starting in Normal Mode...')
 
-    # get first value
-    lastVal= caget(args.pv + ":outCur")
-    i = 0
+    # imported here, so the debug mode and the simulator don't need EPICS
+    import pvio
+
+    channels = loadChannels(args)
+    names = [channel.pv + pvio.OUT_CUR for channel in channels]
+    pvs = pvio.PVGroup(names, verbose=args.verbose)
+    missing = pvs.connect()
+    if len(missing) > 0 and not args.force:
+        print('Could not connect to ' + ', '.join(missing) + '\nExiting...')
+        return
+
+    # get first values
+    lastVals = [0.0 if val is None else val for val in pvs.getMany(names)]
 
-    count = 100
-    x = 2 * np.pi * np.arange(count) / count
-    y = args.amplitude * np.sin(x) + args.shift
+    # noise for all channels is generated in blocks and streamed sample by sample
+    noiseSource = noiseengine.fromChannels(channels, noiseDt(args), correlation=args.correlation, seed=args.seed)
+    if args.verbose >= 1:
+        print('Driving ' + str(len(names)) + ' PVs: ' + ', '.join(names))
+
+    loop = scheduler.fromArgs(args, loopPeriod(args))
+
+    # timing of every stage of the loop
+    probes, metricsServer = metrics.fromArgs(args, 'noise', ['get', 'noise', 'put'], loop)
+
+    loop.start()
 
     try:
         while True:
-            # get value from other script
-            currentVal = caget(args.pv + ":outCur")
+            probes.begin()
+            # get values from other script, served from the monitors
+            currentVals = pvs.getMany(names)
+            probes.mark('get')
 
-            noise , i = generateNoise(i, y, count, False, "debugEnv.txt", noise_type=args.noise_type, noise_strength=args.noise_strength, drift=args.drift, period=args.period, fileVal=lastVal, verbose=args.verbose)
+            noise = noiseSource.next()
+            newVals = [lastVal + n for lastVal, n in zip(lastVals, noise)]
+            probes.mark('noise')
 
-            # if the noise gets read incorrectly, use the last value
-            if noise == '':
-                if args.verbose >= 2:
-                    print('Error while reading noise. Using 0')
-                noise = 0
+            # write new values to all pvs at once
+            pvs.putMany(dict(zip(names, newVals)))
+            probes.mark('put')
 
-            # write new value to pv
-            newVal = noise
-            caput(args.pv + ":outCur", newVal)
-
-            # update the last value
-            lastVal = noise
+            # update the last values
+            lastVals = newVals
 
             if args.verbose >= 1:
-                print('Old value: ' + str(currentVal))
-                print('Noise: ' + str(noise))
-                print('New value: ' + str(newVal))
+                for name, currentVal, n, newVal in zip(names, currentVals, noise, newVals):
+                    print(name + ': old value: ' + str(currentVal) + ', noise: ' + str(n) + ', new value: ' + str(newVal))
                 print('')
 
-            # wait for the next iteration
-            time.sleep(args.delay)
+            # wait for the deadline of the next iteration
+            probes.end(loop.wait())
     except KeyboardInterrupt:
-        print('\nKeyboard interrupt detected\nExiting...')
+        print('\nKeyboard interrupt detected')
+        print(loop.summary())
+        print(probes.summary())
+        print('Exiting...')
         return 
+    finally:
+        if metricsServer is not None:
+            metricsServer.close()
+
+def measureMode(args):
+    import calibration
+
+    if args.mock:
+        # a simulated machine, every steerer acts most on its own BPM
+        from pidcontroller import DELTA_I_COEFFICIENT
+        matrix = calibration.mockMatrix(len(args.bpm), len(args.pv), -1 / DELTA_I_COEFFICIENT)
+        pvs = calibration.MockPlant(matrix, args.pv, noise=args.mock_noise, drift=args.mock_drift, seed=args.seed)
+        sources = pvs.sources()
+        names = list(args.pv)
+    else:
+        # imported here, so the debug mode and the simulator don't need EPICS
+        import pvio
+        import positionsource
+
+        names = [pv + pvio.OUT_CUR for pv in args.pv]
+        pvs = pvio.PVGroup(names, verbose=args.verbose)
+        missing = pvs.connect()
+        if len(missing) > 0:
+            print('Could not connect to ' + ', '.join(missing) + '\nExiting...')
+            return
+        sources = [positionsource.openSource(spec) for spec in args.bpm]
+
+    start = np.array(pvs.getMany(names), dtype=float)
+    currents = []
+    positions = []
+    times = []
+
+    def record(setting):
+        # the same put path as the normal mode
+        pvs.putMany(dict(zip(names, setting.tolist())))
+        sleep(args.settle)
+        samples = np.empty((args.samples, len(sources)))
+        for k in range(args.samples):
+            for i, source in enumerate(sources):
+                if source.wait(args.timeout) is None:
+                    raise RuntimeError('no new position from ' + args.bpm[i] + ' within ' + str(args.timeout) + ' s')
+                samples[k, i] = source.value()
+        currents.append(setting.copy())
+        positions.append(samples.mean(axis=0))
+        times.append(monotonic())
+        if args.verbose >= 1:
+            print('currents: ' + str(setting.tolist()) + ', positions: ' + str(positions[-1].tolist()))
+
+    print('Measuring the response of ' + str(len(sources)) + ' BPMs to ' + str(len(names)) + ' steerers...')
+    try:
+        for _ in range(args.repeat):
+            record(start)
+            for j in range(len(names)):
+                for sign in (1, -1):
+                    setting = start.copy()
+                    setting[j] = setting[j] + sign * args.amplitude
+                    record(setting)
+        record(start)
+    except (KeyboardInterrupt, RuntimeError) as e:
+        print('\nMeasurement aborted: ' + str(e))
+        return
+    finally:
+        # the steerers always go back to where they were
+        pvs.putMany(dict(zip(names, start.tolist())))
+        for source in sources:
+            source.close()
 
-def cleanup(no_delete: bool, file: str, noise_type: str, mode: str):
-    if no_delete == False and mode == 'debug':
+    try:
+        matrix, offset, drift, residual = calibration.fitResponse(currents, positions, times)
+    except ValueError as e:
+        print('Could not fit the response: ' + str(e))
+        return
+    for bpm, row, rms in zip(args.bpm, matrix, residual):
+        print(bpm + ': ' + ', '.join(str(value) for value in row) + ' per A, residual: ' + str(rms))
+    bpms = [{'name': 'BPM' + str(i + 1), 'source': spec} for i, spec in enumerate(args.bpm)]
+    calibration.saveCalibration(args.output, bpms, list(args.pv), matrix, offset, drift, residual,
+                                amplitude=args.amplitude, samples=args.samples, repeat=args.repeat, points=len(currents), mock=args.mock)
+    if len(args.pv) == 1:
+        print('deltaI coefficient: ' + str(-1 / matrix[0, 0]))
+    if args.mock:
+        print('largest error of the fit: ' + str(float(np.max(np.abs(matrix - pvs.matrix)))))
+    print('Calibration written to ' + args.output)
+
+def cleanup(no_delete: bool, file: str, noise_type: str, mode: str, channel: str = 'file'):
+    if no_delete == False and mode == 'debug' and channel == 'file':
         try:
             remove(file)
         except Exception as e:
@@ -212,15 +372,12 @@ def main():
     parentParser = argparse.ArgumentParser('The parent parser', add_help=False)
 
     # general options
-    parentParser.add_argument('-d','--delay', type=float, default=0.05, help='delay between each write in miliseconds. The default value is 0.05')
+    parentParser.add_argument('-d','--delay', type=float, default=0.05, help='period between each write in seconds. Writes start on fixed deadlines. The default value is 0.05')
     parentParser.add_argument('-v', '--verbose', action='count', default=0, help='verbose output')
     parentParser.add_argument('--version', action='version', version=ver)
-    parentParser.add_argument('--noise-strength', type=float, default=0.5, help='the strength of the noise. The default value is 0.5')
-    parentParser.add_argument('--drift', type=float, default=0.0, help='the drift of the noise. The default value is 0.0')
-    parentParser.add_argument('--noise-type', type=str, default='normal', help='the type of noise that should be generated. The default value is "normal" (a normal distribution). Alternativly, you can use "sin" for noise a sine wave like noise, or "mix for a bixture of both"')
-    parentParser.add_argument("--period", type=float, default=10, help="the period of the sine wave in seconds. The default value is 10")
-    parentParser.add_argument('--shift', type=float, default=0.0, help='the shift of the sine wave. The default value is 0.0')
-    parentParser.add_argument('--amplitude', type=float, default=1.0, help='the amplitude of the sine wave. The default value is 1.0')
+    noiseengine.addNoiseArguments(parentParser)
+    scheduler.addSchedulerArguments(parentParser)
+    metrics.addMetricsArguments(parentParser)
 
     # subcommands
     subparsers = parser.add_subparsers(dest='mode', help='the program can use an epics interface or create a debug enviroment for another script')
@@ -228,7 +385,9 @@ def main():
 
     # normal mode
     pvParser = subparsers.add_parser('normal', help='uses the epics interface', parents=[parentParser])
-    pvParser.add_argument('--pv', type=str, default='I1SV02' ,help='the process variable that should be controlled. The default is I1SV02')
+    pvParser.add_argument('--pv', type=str, nargs='+', default=['I1SV02'] ,help='the process variables that should be controlled. The default is I1SV02')
+    pvParser.add_argument('--pv-file', type=str, default=None, help='json file with a list of PVs and their noise options, replaces --pv. See loadChannels for the format')
+    pvParser.add_argument('--correlation', type=float, default=0.0, help='correlation of the gaussian noise between all PVs. The default is 0.0')
     pvParser.add_argument('--force', action='store_true', default=False,
                         help='forces the pv connect check to pass. This is should only be used for development and testing purposes')
 
@@ -236,9 +395,31 @@ def main():
     debugParser = subparsers.add_parser('debug', help='controls a test enviroment instead of the epics interface', parents=[parentParser])
     debugParser.add_argument('-f', '--file', type=str, default='debugEnv.txt', help='simulates a debug enviroment for a controller script using a file called "debugEnv.txt"')
     debugParser.add_argument('--no-delete', action='store_true', default=False, help='doesn\'t delete the debug env file after running the program')
-
+    debugParser.add_argument('--channel', type=str, choices=['file', 'shm'], default='file', help='the transport used for the debug enviroment. "shm" creates a shared memory segment named after the debug file instead of writing the file. The default is "file"')
+
+
+    # response measurement
+    measureParser = subparsers.add_parser('measure', help='measures the position response to the steerers and writes a calibration file')
+    measureParser.add_argument('--pv', type=str, nargs='+', default=['I1SV02'], help='the steerers that are changed one after the other. The default is I1SV02')
+    measureParser.add_argument('--bpm', type=str, nargs='+', default=['file:position.txt'], help='the position sources, see positionsource.py. The default is file:position.txt')
+    measureParser.add_argument('--amplitude', type=float, default=0.1, help='current change of a steerer in A. The default is 0.1')
+    measureParser.add_argument('--settle', type=float, default=1.0, help='seconds to wait after a change before the positions are sampled. The default is 1.0')
+    measureParser.add_argument('--samples', type=int, default=10, help='number of positions averaged per setting. The default is 10')
+    measureParser.add_argument('--repeat', type=int, default=3, help='number of times every steerer is changed. The default is 3')
+    measureParser.add_argument('--timeout', type=float, default=5.0, help='seconds to wait for a new position. The default is 5.0')
+    measureParser.add_argument('-o', '--output', type=str, default='calibration.json', help='the calibration file. The default is "calibration.json"')
+    measureParser.add_argument('--mock', action='store_true', default=False, help='measures a simulated machine instead of the epics interface')
+    measureParser.add_argument('--mock-noise', type=float, default=0.01, help='position noise of the simulated machine. The default is 0.01')
+    measureParser.add_argument('--mock-drift', type=float, default=0.0, help='position drift of the simulated machine per second. The default is 0.0')
+    measureParser.add_argument('--seed', type=int, default=None, help='seed of the simulated noise')
+    measureParser.add_argument('-v', '--verbose', action='count', default=0, help='verbose output')
 
     args = parser.parse_args()
+    if args.mode == 'measure':
+        # doesn't start any noise, nothing to clean up
+        measureMode(args)
+        return
+
     try:
         args.file = str(args.file)
     except:
@@ -272,11 +453,12 @@ def main():
         # script crashes otherwise
         args.no_delete = False
         args.file = 'debugEnv.txt'
+        args.channel = 'file'
     else:
         print('Something went wrong while parsing the arguments\nExiting...')
 
     # cleanup
-    cleanup(no_delete=args.no_delete, file=args.file, noise_type=args.noise_type, mode=args.mode)
+    cleanup(no_delete=args.no_delete, file=args.file, noise_type=args.noise_type, mode=args.mode, channel=args.channel)
 
     
 if __name__ == '__main__':
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+"""
+Live plotting in a separate process.
+
+The control loop publishes samples into a bounded queue without ever blocking. If the
+renderer falls behind, new samples are dropped instead of slowing down the loop.
+The renderer process draws at its own frame rate, keeps one Line2D per series and
+only updates their data. The axes are redrawn completely only when the data leaves
+the current limits, every other frame is blitted.
+The history is kept in a RingBuffer. With an archive, older samples are kept at a lower
+resolution and long histories are min/max decimated to maxPoints before drawing.
+"""
+import queue
+from time import monotonic, sleep
+
+QUEUE_LEN = 10000
+
+
+class LivePlot:
+    def __init__(self, title: str, labels, graphLen: int = 80, fps: float = 10, xlabel: str = None, ylabel: str = None, archive=None, maxPoints: int = 2000):
+        # multiprocessing is only loaded when a plot is opened
+        import multiprocessing
+
+        self.dropped = 0
+        context = multiprocessing.get_context('spawn')
+        self.queue = context.Queue(maxsize=QUEUE_LEN)
+        self.process = context.Process(target=renderLoop, args=(self.queue, title, list(labels), graphLen, fps, xlabel, ylabel, archive, maxPoints), daemon=True)
+        self.process.start()
+
+    def publish(self, x: float, values, title: str = None):
+        try:
+            self.queue.put_nowait((x, tuple(values), title))
+        except queue.Full:
+            self.dropped = self.dropped + 1
+
+    def close(self):
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+        # samples the renderer didn't take anymore must not keep the loop process from exiting
+        self.queue.cancel_join_thread()
+        self.queue.close()
+
+
+def expandLimits(low: float, high: float, dataLow: float, dataHigh: float, leading: bool):
+    """
+    Returns new limits if the data doesn't fit into (low, high), None otherwise.
+    With leading set the data grows to the right and the new limits leave room for it.
+    """
+    if dataLow >= low and dataHigh <= high:
+        return None
+    span = dataHigh - dataLow
+    if span <= 0:
+        span = 1.0
+    if leading:
+        return dataLow, dataHigh + 0.25 * span
+    return dataLow - 0.1 * span, dataHigh + 0.1 * span
+
+
+def renderLoop(samples, title: str, labels, graphLen: int, fps: float, xlabel: str, ylabel: str, archive, maxPoints: int):
+    import matplotlib.pyplot as plt
+    import numpy as np
+    from ringbuffer import RingBuffer
+
+    fig, ax = plt.subplots()
+    titleArtist = ax.set_title(title, animated=True)
+    lines = [ax.plot([], [], label=label, animated=True)[0] for label in labels]
+    ax.legend(loc='upper left')
+    if xlabel is not None:
+        ax.set_xlabel(xlabel)
+    if ylabel is not None:
+        ax.set_ylabel(ylabel)
+    plt.show(block=False)
+
+    # column 0 is x, one column per label
+    history = RingBuffer(graphLen, 1 + len(labels), archive=archive)
+    row = [0.0] * (1 + len(labels))
+
+    fig.canvas.draw()
+    background = fig.canvas.copy_from_bbox(fig.bbox)
+    frame = 1 / fps
+    running = True
+
+    while running and plt.fignum_exists(fig.number):
+        frameStart = monotonic()
+        changed = False
+        try:
+            while True:
+                sample = samples.get_nowait()
+                if sample is None:
+                    running = False
+                    break
+                row[0] = sample[0]
+                row[1:] = sample[1]
+                history.append(row)
+                if sample[2] is not None:
+                    titleArtist.set_text(sample[2])
+                changed = True
+        except queue.Empty:
+            pass
+
+        if changed and len(history) > 0:
+            data = history.decimated(maxPoints, history.history())
+            for i, line in enumerate(lines):
+                line.set_data(data[:, 0], data[:, i + 1])
+
+            low, high = ax.get_xlim()
+            xlim = expandLimits(low, high, data[0, 0], data[-1, 0], leading=True)
+            # samples without a value (a PV that hasn't answered yet) are NaN and don't move the limits
+            values = data[:, 1:]
+            values = values[np.isfinite(values)]
+            ylim = None
+            if len(values) > 0:
+                low, high = ax.get_ylim()
+                ylim = expandLimits(low, high, values.min(), values.max(), leading=False)
+            if xlim is not None or ylim is not None:
+                # full redraw, only needed when the limits change
+                if xlim is not None:
+                    ax.set_xlim(*xlim)
+                if ylim is not None:
+                    ax.set_ylim(*ylim)
+                fig.canvas.draw()
+                background = fig.canvas.copy_from_bbox(fig.bbox)
+
+            fig.canvas.restore_region(background)
+            ax.draw_artist(titleArtist)
+            for line in lines:
+                ax.draw_artist(line)
+            fig.canvas.blit(fig.bbox)
+
+        fig.canvas.flush_events()
+        remaining = frame - (monotonic() - frameStart)
+        if remaining > 0:
+            sleep(remaining)
+
+    plt.close(fig)
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+"""
+Replays recorded logs through the PID controller.
+
+The measurements of a log (csv or binary, see telemetry.py) are streamed back through
+VectorPID as fast as possible or paced at a multiple of the recorded speed. All gain
+sets are replayed at once, one channel each, so comparing many gain sets costs about
+as much as a single one. The first channel uses the gains from the log header and the
+parameter changes noted in the log, which shows how closely the replay reproduces the
+recorded output. The others are compared against the recorded output.
+Binary logs are memory mapped, only the replayed columns are read.
+"""
+from time import monotonic, sleep
+import numpy as np
+import telemetry
+
+# the measured value and the controller output as logged by pidcontroller.py
+MEASUREMENT_COLUMNS = ('current pos', 'current Value')
+CORRECTED_COLUMNS = {'current pos': 'corrected pos', 'current Value': 'corrected Value'}
+HEADER_KEYS = {'Kp': 'kp', 'Ki': 'ki', 'Kd': 'kd', 'Niveau': 'niveau', 'Delay': 'delay'}
+
+
+def parseHeader(text: str) -> dict:
+    """
+    Returns the parameters of a header written by telemetry.parameterHeader.
+    """
+    parameters = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(': ')
+        if key in HEADER_KEYS:
+            try:
+                parameters[HEADER_KEYS[key]] = float(value)
+            except ValueError:
+                pass
+        elif key == 'PV':
+            parameters['pv'] = value
+    return parameters
+
+
+def parseNote(text: str):
+    """
+    Returns (time, changes) of a note written by control.py, None for other notes.
+    The time is the time since the start of the loop, like the time column of the log.
+    """
+    head, found, tail = text.partition(', set ')
+    if not found:
+        return None
+    noteTime = None
+    for part in head.split(', '):
+        key, _, value = part.partition(': ')
+        if key == 'time':
+            noteTime = float(value)
+    if noteTime is None:
+        return None
+    changes = {}
+    for part in tail.split(', '):
+        key, _, value = part.partition(': ')
+        changes[key] = float(value)
+    return noteTime, changes
+
+
+def readCsv(path: str, columns=None):
+    """
+    Reads a csv log of pidcontroller.py or plotnoise.py. Returns (header, names, data, notes),
+    data maps the column names to arrays. Only the given columns are read, all numeric
+    ones if columns is None.
+    """
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+
+    start = 0
+    header = ''
+    if len(lines) > 0 and lines[0] == 'PID-Controller Log File':
+        # the header ends with an empty line
+        start = lines.index('') + 1
+        header = '\n'.join(lines[:start])
+    columnLine = lines[start]
+    # plotnoise.py separates the columns with two tabs
+    tabs = '\t' in columnLine
+    if tabs:
+        names = [name for name in columnLine.split('\t') if name != '']
+        rows = [line.replace('\t\t', '\t') for line in lines[start + 1:]]
+        delimiter = '\t'
+    else:
+        names = [name.strip() for name in columnLine.split(',')]
+        rows = lines[start + 1:]
+        delimiter = ','
+
+    notes = [line[2:] for line in rows if line.startswith('# ')]
+    if columns is None:
+        first = next((line for line in rows if not line.startswith('#')), '')
+        columns = []
+        for name, value in zip(names, first.split(delimiter)):
+            try:
+                float(value)
+                columns.append(name)
+            except ValueError:
+                pass
+    indices = [names.index(name) for name in columns]
+    values = np.loadtxt(rows, delimiter=delimiter, comments='#', usecols=indices, ndmin=2)
+    data = {name: values[:, i] for i, name in enumerate(columns)}
+    return header, names, data, notes
+
+
+def readBinary(path: str, columns=None):
+    meta, records = telemetry.readTelemetry(path)
+    names = list(meta['columns'])
+    if columns is None:
+        columns = [name for name in names if records.dtype[name].kind == 'f']
+    # views into the memory map, nothing is read before it is used
+    data = {name: records[name] for name in columns}
+    notes = []
+    try:
+        with open(str(path) + '.notes', 'r') as f:
+            notes = f.read().splitlines()
+    except FileNotFoundError:
+        pass
+    return meta['header'], names, data, notes
+
+
+def isBinary(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(telemetry.MAGIC)) == telemetry.MAGIC
+
+
+def loadLog(paths, columns=None):
+    """
+    Loads one log or the consecutive files of a rotated log. Returns (parameters, names, data, changes),
+    changes is a list of (row, changes) of the parameter changes noted in the log.
+    """
+    header = ''
+    names = None
+    parts = []
+    notes = []
+    for path in paths:
+        if isBinary(path):
+            fileHeader, fileNames, data, fileNotes = readBinary(path, columns)
+        else:
+            fileHeader, fileNames, data, fileNotes = readCsv(path, columns)
+        if names is None:
+            header = fileHeader
+            names = fileNames
+            columns = list(data)
+        notes.extend(change for change in map(parseNote, fileNotes) if change is not None)
+        parts.append(data)
+
+    if len(parts) == 1:
+        data = parts[0]
+    else:
+        data = {name: np.concatenate([part[name] for part in parts]) for name in columns}
+    return parseHeader(header), names, data, noteRows(notes, data)
+
+
+def noteRows(notes, data: dict) -> list:
+    """
+    Returns a list of (row, changes) for the (time, changes) of the notes. Not every cycle
+    logs a row, so the rows are found by time. A change was made after the last row
+    logged before it and applies from the next row on.
+    """
+    if len(notes) == 0:
+        return []
+    if 'time' not in data:
+        raise ValueError('the parameter changes of the log can only be replayed with its time column')
+    rows = np.searchsorted(data['time'], [noteTime for noteTime, _ in notes], side='right')
+    return [(int(row), changes) for row, (_, changes) in zip(rows, notes)]
+
+
+def measurementColumn(names, column: str = None) -> str:
+    if column is not None:
+        if column not in names:
+            raise ValueError('the log has no column ' + column + ', only ' + ', '.join(names))
+        return column
+    for name in MEASUREMENT_COLUMNS:
+        if name in names:
+            return name
+    raise ValueError('no measurement column found, choose one of ' + ', '.join(names))
+
+
+def replay(measurement: np.ndarray, dt: np.ndarray, pid, changes=None, speed: float = 0.0, publish=None, publishEvery: int = 1) -> np.ndarray:
+    """
+    Steps pid through the measurements and returns its outputs, one column per channel.
+    dt is the time step of every row. changes is a list of (row, changes) applied to
+    channel 0. With speed > 0 the rows are paced at speed times the recorded rate.
+    publish(row, output) is called every publishEvery rows, e.g. for a live plot.
+    """
+    rows = len(measurement)
+    outputs = np.empty((rows, pid.channels))
+    pending = sorted(changes or [], key=lambda change: change[0])
+    nextChange = 0
+    if speed > 0:
+        elapsed = np.cumsum(dt) / speed
+        start = monotonic()
+
+    for k in range(rows):
+        while nextChange < len(pending) and pending[nextChange][0] <= k:
+            applyChanges(pid, pending[nextChange][1])
+            nextChange = nextChange + 1
+        if speed > 0:
+            remaining = start + elapsed[k] - monotonic()
+            if remaining > 0:
+                sleep(remaining)
+        outputs[k] = pid.step(measurement[k], dt[k])
+        if publish is not None and k % publishEvery == 0:
+            publish(k, outputs[k])
+    return outputs
+
+
+def applyChanges(pid, changes: dict):
+    if 'kp' in changes:
+        pid.kp[0] = changes['kp']
+    if 'ki' in changes:
+        pid.ki[0] = changes['ki']
+    if 'kd' in changes:
+        pid.kd[0] = changes['kd']
+    if 'niveau' in changes:
+        pid.setpoint[0] = changes['niveau']
+
+
+def timeSteps(data: dict, delay: float) -> np.ndarray:
+    """
+    The time step of every row, from the time column if there is one.
+    """
+    rows = len(next(iter(data.values())))
+    if 'time' in data and rows > 1:
+        dt = np.empty(rows)
+        dt[1:] = np.diff(data['time'])
+        dt[0] = dt[1]
+        # the controller never sees a zero time step
+        np.maximum(dt, 1e-16, out=dt)
+        return dt
+    return np.full(rows, delay)
+
+
+def compare(reference: np.ndarray, outputs: np.ndarray) -> list:
+    """
+    Returns a dict of statistics per output column, compared to the reference output if it isn't None.
+    """
+    results = []
+    for i in range(outputs.shape[1]):
+        output = outputs[:, i]
+        result = {'output rms': float(np.sqrt(np.mean(output ** 2))), 'effort': float(np.sum(np.abs(np.diff(output))))}
+        if reference is not None:
+            difference = output - reference
+            result['rms difference'] = float(np.sqrt(np.mean(difference ** 2)))
+            result['max difference'] = float(np.max(np.abs(difference)))
+        results.append(result)
+    return results
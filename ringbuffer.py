@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+"""
+Fixed capacity, NumPy backed ring buffer for plot history.
+
+Every row is written twice, at its index and at index + capacity. The rows in order
+from oldest to newest are therefore always one contiguous slice of the storage and
+view() returns them without copying. Appending costs the same whatever the capacity.
+
+In archive mode the rows that fall out of the buffer are not lost: every `factor`
+evicted rows are reduced to their first and last x and the min/max of the other
+columns, and stored in a coarser ring buffer, which can have an archive of its own.
+This keeps hours of history in constant memory.
+"""
+import numpy as np
+
+
+class RingBuffer:
+    def __init__(self, capacity: int, columns: int = 1, archive=None):
+        """
+        archive is a list of (capacity, factor) tuples, one per archive level.
+        """
+        self.capacity = capacity
+        self.columns = columns
+        self.data = np.zeros((2 * capacity, columns))
+        self.end = 0
+        self.count = 0
+
+        self.archive = None
+        if archive:
+            archiveCapacity, self.factor = archive[0]
+            self.archive = RingBuffer(archiveCapacity, columns, archive=archive[1:])
+            self.pending = 0
+            self.first = np.zeros(columns)
+            self.low = np.zeros(columns)
+            self.high = np.zeros(columns)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, row):
+        if self.count == self.capacity and self.archive is not None:
+            self.evict(self.data[self.end])
+        self.data[self.end] = row
+        self.data[self.end + self.capacity] = row
+        self.end = self.end + 1
+        if self.end == self.capacity:
+            self.end = 0
+        if self.count < self.capacity:
+            self.count = self.count + 1
+
+    def evict(self, row: np.ndarray):
+        if self.pending == 0:
+            self.first[:] = row
+            self.low[:] = row
+            self.high[:] = row
+        else:
+            np.minimum(self.low, row, out=self.low)
+            np.maximum(self.high, row, out=self.high)
+        self.pending = self.pending + 1
+        if self.pending == self.factor:
+            # column 0 is x, keep where the bucket starts and ends
+            self.low[0] = self.first[0]
+            self.high[0] = row[0]
+            self.archive.append(self.low)
+            self.archive.append(self.high)
+            self.pending = 0
+
+    def view(self) -> np.ndarray:
+        """
+        Rows from oldest to newest, without copying. Only valid until the next append.
+        """
+        start = self.end - self.count
+        if start < 0:
+            start = start + self.capacity
+        return self.data[start:start + self.count]
+
+    def history(self) -> np.ndarray:
+        """
+        The archived rows followed by the current ones (a copy).
+        """
+        if self.archive is None:
+            return self.view()
+        return np.concatenate((self.archive.history(), self.view()))
+
+    def decimated(self, maxPoints: int, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Reduces the rows to at most maxPoints by keeping the first and last x and the
+        min/max of the other columns of equally sized buckets, so peaks stay visible.
+        """
+        if rows is None:
+            rows = self.view()
+        buckets = maxPoints // 2
+        if len(rows) <= maxPoints or buckets == 0:
+            return rows
+        size = -(-len(rows) // buckets)
+        usable = (len(rows) // size) * size
+        grouped = rows[len(rows) - usable:].reshape(-1, size, self.columns)
+        out = np.empty((2 * len(grouped), self.columns))
+        out[0::2] = grouped.min(axis=1)
+        out[1::2] = grouped.max(axis=1)
+        out[0::2, 0] = grouped[:, 0, 0]
+        out[1::2, 0] = grouped[:, -1, 0]
+        return out
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pidengine import VectorPID
+from pidcontroller import deltaI
+import positionsource
+
+ver = "1.0.0"
+author = "Valentin Reichenbach"
+description = """
+Runs many PID loops concurrently in one process.
+The loops are listed in a json config file, each with its own PV, position source, gains, niveau and rate:
+    {"loops": [{"name": "I1SV02", "pv": "I1SV02", "position": "file:position.txt", "position_timeout": 1.0,
+                "kp": 0.5, "ki": 0.3, "kd": 0, "niveau": 1, "rate": 10, "min": -3, "max": 3}]}
+The position is a source of positionsource.py (file:PATH, epics:PV or shm:NAME). A loop only corrects
+when there is a new position that isn't stale.
+Blocking reads run in a thread pool, PV values come from the monitors of a shared pvio.PVGroup.
+A failing loop is retried and stopped after --max-failures consecutive errors, the other loops keep running.
+With --control the loops can be started, stopped and retuned through a UNIX socket that takes one
+json command per line:
+    {"cmd": "status"}
+    {"cmd": "stop", "loop": "I1SV02"}
+    {"cmd": "start", "loop": "I1SV02"}
+    {"cmd": "gains", "loop": "I1SV02", "kp": 0.4, "ki": 0.2, "kd": 0, "niveau": 1.1}
+"""
+epilog = """
+Author: Valentin Reichenbach
+Version: 1.0.0
+License: GPLv3+
+"""
+
+LOOP_DEFAULTS = {'position': 'file:position.txt', 'position_timeout': 1.0, 'kp': 0.5, 'ki': 0.3, 'kd': 0.0, 'niveau': 1.0, 'rate': 10.0, 'min': -3.0, 'max': 3.0}
+
+
+class ControlLoop:
+    def __init__(self, config: dict, pvs, pool, maxFailures: int = 5, verbose: int = 0):
+        import pvio
+        settings = dict(LOOP_DEFAULTS, **config)
+        self.name = settings.get('name', settings['pv'])
+        self.pv = settings['pv'] + pvio.OUT_CUR
+        self.position = positionsource.openSource(settings['position'], maxAge=settings['position_timeout'])
+        self.period = 1 / settings['rate']
+        self.pid = VectorPID(settings['kp'], settings['ki'], settings['kd'], setpoint=settings['niveau'], outputLimits=(settings['min'], settings['max']))
+        self.pvs = pvs
+        self.pool = pool
+        self.maxFailures = maxFailures
+        self.verbose = verbose
+
+        self.task = None
+        self.state = 'stopped'
+        self.error = None
+        self.cycles = 0
+        self.overruns = 0
+        self.failures = 0
+        self.lastPosition = None
+
+    def readCurrent(self):
+        # a disconnected PV keeps its last monitor value, it must not be corrected against
+        if not self.pvs.connected(self.pv):
+            raise RuntimeError(self.pv + ' is disconnected')
+        current = self.pvs.get(self.pv)
+        if current is None:
+            raise RuntimeError('no value for ' + self.pv)
+        return current
+
+    async def step(self, loop):
+        sample = await loop.run_in_executor(self.pool, self.position.poll)
+        if sample is None or self.position.stale():
+            # nothing new to correct for, the integrator is left alone
+            return
+        pos = sample[0]
+        # the PID only steps when its output can be written. a PV without a monitor value falls
+        # back to a blocking read, that must not hold up the other loops
+        current = await loop.run_in_executor(self.pool, self.readCurrent)
+        u = self.pid(pos)
+        self.pvs.put(self.pv, current - deltaI(u))
+        self.lastPosition = pos
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.state = 'running'
+        deadline = loop.time()
+        try:
+            while True:
+                try:
+                    await self.step(loop)
+                    self.failures = 0
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # only this loop is affected
+                    self.failures = self.failures + 1
+                    self.error = str(e)
+                    if self.verbose >= 1:
+                        print(self.name + ': ' + str(e))
+                    if self.failures >= self.maxFailures:
+                        self.state = 'failed'
+                        print(self.name + ': stopped after ' + str(self.failures) + ' consecutive errors')
+                        return
+                self.cycles = self.cycles + 1
+
+                deadline = deadline + self.period
+                now = loop.time()
+                if now > deadline:
+                    self.overruns = self.overruns + 1
+                    deadline = now
+                await asyncio.sleep(deadline - now)
+        except asyncio.CancelledError:
+            self.state = 'stopped'
+
+    def close(self):
+        self.position.close()
+
+    def start(self):
+        if self.task is not None and not self.task.done():
+            return
+        self.failures = 0
+        self.error = None
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def setGains(self, kp=None, ki=None, kd=None, niveau=None):
+        # between two cycles, the integrator state is kept
+        self.pid.setGains(kp, ki, kd)
+        if niveau is not None:
+            self.pid.setpoint[:] = niveau
+
+    def status(self) -> dict:
+        return {'state': self.state, 'cycles': self.cycles, 'overruns': self.overruns, 'failures': self.failures, 'error': self.error,
+                'position': self.lastPosition, 'kp': float(self.pid.kp[0]), 'ki': float(self.pid.ki[0]), 'kd': float(self.pid.kd[0]),
+                'niveau': float(self.pid.setpoint[0])}
+
+
+class Runtime:
+    def __init__(self, config: dict, maxFailures: int = 5, verbose: int = 0):
+        # imported here, so --help works without EPICS
+        import pvio
+        self.verbose = verbose
+        self.pvs = pvio.PVGroup(verbose=verbose)
+        # the workers read PVs, they join the CA context of the PVs
+        self.pool = ThreadPoolExecutor(max_workers=config.get('threads', 4), initializer=self.pvs.attachThread)
+        self.loops = {}
+        for loopConfig in config['loops']:
+            controlLoop = ControlLoop(loopConfig, self.pvs, self.pool, maxFailures=maxFailures, verbose=verbose)
+            self.loops[controlLoop.name] = controlLoop
+            self.pvs.add(controlLoop.pv)
+
+    def start(self, name: str = None):
+        for controlLoop in self.select(name):
+            controlLoop.start()
+
+    def stop(self, name: str = None):
+        for controlLoop in self.select(name):
+            controlLoop.stop()
+
+    def setGains(self, name: str, **gains):
+        self.loops[name].setGains(**gains)
+
+    def select(self, name: str = None) -> list:
+        if name is None:
+            return list(self.loops.values())
+        return [self.loops[name]]
+
+    def status(self) -> dict:
+        return {name: controlLoop.status() for name, controlLoop in self.loops.items()}
+
+    def command(self, request: dict) -> dict:
+        cmd = request.get('cmd')
+        name = request.get('loop')
+        if name is not None and name not in self.loops:
+            return {'error': 'unknown loop ' + str(name)}
+        if cmd == 'status':
+            return self.status()
+        elif cmd == 'start':
+            self.start(name)
+        elif cmd == 'stop':
+            self.stop(name)
+        elif cmd == 'gains':
+            if name is None:
+                return {'error': 'gains needs a loop'}
+            self.setGains(name, kp=request.get('kp'), ki=request.get('ki'), kd=request.get('kd'), niveau=request.get('niveau'))
+        else:
+            return {'error': 'unknown command ' + str(cmd)}
+        return {'ok': True}
+
+    async def serveClient(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                reply = self.command(json.loads(line))
+            except Exception as e:
+                reply = {'error': str(e)}
+            writer.write(json.dumps(reply).encode() + b'\n')
+            await writer.drain()
+        writer.close()
+
+    async def run(self, controlSocket: str = None):
+        missing = self.pvs.connect()
+        if len(missing) > 0:
+            print('Could not connect to ' + ', '.join(missing))
+        self.start()
+        server = None
+        if controlSocket is not None:
+            if os.path.exists(controlSocket):
+                # left over from a previous run
+                os.remove(controlSocket)
+            server = await asyncio.start_unix_server(self.serveClient, path=controlSocket)
+        try:
+            while True:
+                await asyncio.sleep(1)
+        finally:
+            self.stop()
+            if server is not None:
+                server.close()
+                os.remove(controlSocket)
+            self.pool.shutdown(wait=False)
+            for controlLoop in self.loops.values():
+                controlLoop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', type=str, help='json file listing the loops')
+    parser.add_argument('--control', type=str, default=None, help='UNIX socket for start, stop, status and gain commands')
+    parser.add_argument('--max-failures', type=int, default=5, help='a loop is stopped after this many consecutive errors. The default is 5')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='verbose output')
+    parser.add_argument('--version', action='version', version=ver)
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+
+    runtime = Runtime(config, maxFailures=args.max_failures, verbose=args.verbose)
+    try:
+        asyncio.run(runtime.run(args.control))
+    except KeyboardInterrupt:
+        print('\nKeyboard interrupt detected')
+        for name, status in runtime.status().items():
+            print(name + ': ' + status['state'] + ', cycles: ' + str(status['cycles']) + ', overruns: ' + str(status['overruns']))
+        print('Exiting...')
+
+
+if __name__ == '__main__':
+    main()
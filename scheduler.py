@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+"""
+Fixed rate loop scheduling for the controller and noise loops.
+
+Cycles are released on absolute deadlines of a monotonic clock, so the period doesn't
+drift with the time spent on I/O and computation. Waiting sleeps until shortly before
+the deadline and spins for the rest, which keeps the wakeup jitter low without pinning
+a core for the whole period.
+MultiRateScheduler runs several loops with their own periods in one thread, e.g. a fast
+inner and a slow outer loop of a cascade.
+"""
+import os
+from time import monotonic, sleep
+
+HISTORY_LEN = 4096
+
+
+def sleepUntil(deadline: float, spin: float):
+    remaining = deadline - monotonic() - spin
+    if remaining > 0:
+        sleep(remaining)
+    while monotonic() < deadline:
+        pass
+
+
+class LoopScheduler:
+    def __init__(self, period: float, spin: float = 0.0005):
+        self.period = period
+        self.spin = spin
+        self.deadline = None
+        self.startTime = None
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitterSum = 0.0
+        self.jitterMax = 0.0
+        # jitter of the last cycles in seconds, index cycles % HISTORY_LEN
+        self.jitter = [0.0] * HISTORY_LEN
+
+    def start(self):
+        self.startTime = monotonic()
+        self.deadline = self.startTime + self.period
+
+    def setPeriod(self, period: float):
+        # the next deadline is one new period after now, the cycle counters are kept
+        self.period = period
+        if self.deadline is not None:
+            self.deadline = monotonic() + period
+
+    def wait(self) -> float:
+        """
+        Waits for the deadline of the next cycle. Returns the jitter of the wakeup.
+        """
+        if self.deadline is None:
+            self.start()
+        if self.period <= 0:
+            # free running
+            self.cycles = self.cycles + 1
+            return 0.0
+
+        now = monotonic()
+        if now > self.deadline:
+            # the cycle took longer than its period. Realign to the deadline grid and
+            # start the next cycle right away
+            self.overruns = self.overruns + 1
+            missed = int((now - self.deadline) // self.period)
+            self.skipped = self.skipped + missed
+            late = now - self.deadline - missed * self.period
+            self.deadline = self.deadline + (missed + 1) * self.period
+            self.record(late)
+            return late
+
+        sleepUntil(self.deadline, self.spin)
+        late = monotonic() - self.deadline
+        self.deadline = self.deadline + self.period
+        self.record(late)
+        return late
+
+    def record(self, late: float):
+        self.jitter[self.cycles % HISTORY_LEN] = late
+        self.cycles = self.cycles + 1
+        self.jitterSum = self.jitterSum + late
+        if late > self.jitterMax:
+            self.jitterMax = late
+
+    def elapsed(self) -> float:
+        if self.startTime is None:
+            return 0.0
+        return monotonic() - self.startTime
+
+    def rate(self) -> float:
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0.0
+        return self.cycles / elapsed
+
+    def summary(self) -> str:
+        if self.cycles > 0:
+            meanJitter = self.jitterSum / self.cycles
+        else:
+            meanJitter = 0.0
+        return ('cycles: ' + str(self.cycles) + ', rate: ' + str(round(self.rate(), 2)) + ' Hz, overruns: ' + str(self.overruns)
+                + ', skipped: ' + str(self.skipped) + ', mean jitter: ' + str(round(meanJitter * 1e6, 1))
+                + ' us, max jitter: ' + str(round(self.jitterMax * 1e6, 1)) + ' us')
+
+
+class MultiRateScheduler:
+    def __init__(self, periods: dict, spin: float = 0.0005):
+        """
+        periods maps the name of every loop to its period in seconds. Each loop keeps
+        its own LoopScheduler with deadlines and statistics.
+        """
+        for name, period in periods.items():
+            if period <= 0:
+                raise ValueError('the period of ' + name + ' has to be positive')
+        self.spin = spin
+        self.loops = {name: LoopScheduler(period, spin) for name, period in periods.items()}
+        self.started = False
+
+    def start(self):
+        # all loops share the first tick
+        now = monotonic()
+        for loop in self.loops.values():
+            loop.startTime = now
+            loop.deadline = now + loop.period
+        self.started = True
+
+    def setPeriod(self, name: str, period: float):
+        self.loops[name].setPeriod(period)
+
+    def wait(self) -> list:
+        """
+        Waits for the earliest deadline and returns the names of all loops that are due,
+        in the order they were given.
+        """
+        if not self.started:
+            self.start()
+        sleepUntil(min(loop.deadline for loop in self.loops.values()), self.spin)
+        now = monotonic()
+        due = []
+        for name, loop in self.loops.items():
+            if now < loop.deadline:
+                continue
+            late = now - loop.deadline
+            if late >= loop.period:
+                # the other loops kept this one busy for whole periods. Like a single
+                # loop it is realigned to its deadline grid instead of catching up
+                missed = int(late // loop.period)
+                loop.overruns = loop.overruns + 1
+                loop.skipped = loop.skipped + missed
+                late = late - missed * loop.period
+                loop.deadline = loop.deadline + missed * loop.period
+            loop.deadline = loop.deadline + loop.period
+            loop.record(late)
+            due.append(name)
+        return due
+
+    def summary(self) -> str:
+        return '\n'.join(name + ': ' + loop.summary() for name, loop in self.loops.items())
+
+
+def configureRealtime(cpus=None, fifo: int = None, verbose: int = 0):
+    """
+    Pins the process to the given cpus and switches to SCHED_FIFO with the given priority.
+    Both are optional and only applied where the OS permits it.
+    """
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+            if verbose >= 1:
+                print('Pinned to cpu ' + ', '.join(str(c) for c in cpus))
+        except (AttributeError, OSError) as e:
+            print('Could not set the cpu affinity: ' + str(e))
+    if fifo is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(fifo))
+            if verbose >= 1:
+                print('Using SCHED_FIFO with priority ' + str(fifo))
+        except (AttributeError, OSError) as e:
+            print('Could not switch to SCHED_FIFO: ' + str(e))
+
+
+def cpuList(value: str) -> list:
+    return [int(c) for c in value.split(',') if c != '']
+
+
+def addSchedulerArguments(parser):
+    group = parser.add_argument_group('scheduler options')
+    group.add_argument('--spin', type=float, default=0.0005, help='the time in seconds before each deadline that is busy waited instead of slept. The default is 0.0005')
+    group.add_argument('--cpu', type=cpuList, default=None, help='comma separated list of cpus the process is pinned to')
+    group.add_argument('--fifo', type=int, default=None, help='run with SCHED_FIFO and the given priority if the OS permits it')
+    return group
+
+
+def fromArgs(args, period: float) -> LoopScheduler:
+    configureRealtime(cpus=args.cpu, fifo=args.fifo, verbose=args.verbose)
+    return LoopScheduler(period, spin=args.spin)
+
+
+def multiRateFromArgs(args, periods: dict) -> MultiRateScheduler:
+    configureRealtime(cpus=args.cpu, fifo=args.fifo, verbose=args.verbose)
+    return MultiRateScheduler(periods, spin=args.spin)
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+import argparse
+import itertools
+from types import SimpleNamespace
+import numpy as np
+import feedforward
+import filters
+import noiseengine
+from pidengine import VectorPID
+from pidcontroller import DELTA_I_COEFFICIENT, deltaI
+import randomNoise
+
+ver = "1.0.0"
+author = "Valentin Reichenbach"
+description = """
+Offline closed loop simulation of the PID-Controller.
+Couples the PID step with a plant model in a single process and runs faster than real time.
+The plant follows the debug enviroment: every noise step adds the noise of randomNoise.py to the position,
+every controller step changes the steerer current by deltaI and the position moves by the current change
+divided by the plant coefficient.
+"run" simulates one gain set, "sweep" evaluates a grid of (Kp, Ki, Kd, delay) combinations.
+"""
+epilog = """
+Author: Valentin Reichenbach
+Version: 1.0.0
+License: GPLv3+
+"""
+
+RESULT_DTYPE = np.dtype([('kp', 'f8'), ('ki', 'f8'), ('kd', 'f8'), ('delay', 'f8'), ('settling', 'f8'),
+                         ('overshoot', 'f8'), ('iae', 'f8'), ('ise', 'f8'), ('effort', 'f8'), ('rms', 'f8')])
+
+
+def noiseDt(args) -> float:
+    # time between two noise steps of randomNoise.py, the base step of the simulation
+    return randomNoise.noiseDt(SimpleNamespace(noise_type=args.noise_type, delay=args.noise_delay, period=args.period))
+
+
+def noiseSequence(args, steps: int) -> np.ndarray:
+    """
+    Pre-generates the noise increments that randomNoise.py would add to the debug enviroment.
+    """
+    return noiseengine.fromArgs(args, noiseDt(args)).block(steps)
+
+
+def simulate(kp, ki, kd, noise: np.ndarray, dt: float, niveau: float = 1.0, start: float = 0.0, controlEvery: int = 1,
+             outputLimits=(-3, 3), plantCoefficient=DELTA_I_COEFFICIENT, band: float = 0.05, feedForward: dict = None,
+             filterSpecs=(), derivativeFilter: float = None) -> np.ndarray:
+    """
+    Simulates the closed loop for all gain sets at once. kp, ki, kd and plantCoefficient
+    may be arrays with one entry per gain set. noise holds the increment of every noise
+    step, the controller runs every controlEvery noise steps. feedForward holds the
+    settings of feedforward.create, every gain set gets its own estimator. filterSpecs are
+    the --filter specs applied to the measured position, at the rate of the controller.
+    Returns the per gain set metrics as RESULT_DTYPE records. All error metrics use the
+    position the controller measures, before the correction of the same step, rms only at
+    the controller steps.
+    """
+    pid = VectorPID(kp, ki, kd, setpoint=niveau, outputLimits=outputLimits, derivativeFilter=derivativeFilter)
+    n = pid.channels
+    inputFilter = filters.create(filterSpecs, 1 / (dt * controlEvery), n)
+    compensation = None
+    if feedForward is not None:
+        compensation = feedforward.create(channels=n, outputLimits=outputLimits, **feedForward)
+    plantCoefficient = np.broadcast_to(np.asarray(plantCoefficient, dtype=float), (n,))
+    pos = np.full(n, float(start))
+    error = np.empty(n)
+    iae = np.zeros(n)
+    ise = np.zeros(n)
+    effort = np.zeros(n)
+    measured = np.zeros(n)
+    samples = 0
+    overshoot = np.zeros(n)
+    lastOutside = np.full(n, -1)
+    direction = np.sign(niveau - start)
+    if direction == 0:
+        direction = 1.0
+
+    for k in range(len(noise)):
+        pos += noise[k]
+        # the metrics see the position the controller measures, before its correction
+        np.subtract(niveau, pos, out=error)
+        iae += np.abs(error) * dt
+        ise += error * error * dt
+        np.maximum(overshoot, -direction * error, out=overshoot)
+        lastOutside[np.abs(error) > band] = k
+
+        if k % controlEvery == 0:
+            measured += error * error
+            samples = samples + 1
+            reading = pos if inputFilter is None else inputFilter.step(pos)
+            u = pid.step(reading, dt * controlEvery)
+            if compensation is not None:
+                u = compensation.step(k * dt, pos, u)
+            # the controller changes the current by deltaI, the plant answers with its own coefficient
+            currentShift = deltaI(u)
+            pos += currentShift / plantCoefficient
+            effort += np.abs(currentShift)
+
+    results = np.zeros(n, dtype=RESULT_DTYPE)
+    results['kp'] = pid.kp
+    results['ki'] = pid.ki
+    results['kd'] = pid.kd
+    results['delay'] = dt * controlEvery
+    settled = lastOutside < len(noise) - 1
+    results['settling'] = np.where(settled, (lastOutside + 1) * dt, np.inf)
+    results['overshoot'] = overshoot
+    results['iae'] = iae
+    results['ise'] = ise
+    results['effort'] = effort
+    results['rms'] = np.sqrt(measured / max(samples, 1))
+    return results
+
+
+def _simulateChunk(job):
+    kp, ki, kd, noise, dt, options = job
+    return simulate(kp, ki, kd, noise, dt, **options)
+
+
+def sweep(kps, kis, kds, delays, noise: np.ndarray, dt: float, workers: int = 1, chunkLen: int = 2048, **options) -> np.ndarray:
+    """
+    Evaluates every (Kp, Ki, Kd, delay) combination on the same noise realization.
+    Gain sets with the same delay are simulated together, large grids are split into
+    chunks that run across a process pool.
+    """
+    jobs = []
+    for delay in delays:
+        controlEvery = max(1, int(round(delay / dt)))
+        grid = np.array(list(itertools.product(kps, kis, kds)), dtype=float)
+        for first in range(0, len(grid), chunkLen):
+            chunk = grid[first:first + chunkLen]
+            jobOptions = dict(options, controlEvery=controlEvery)
+            jobs.append((chunk[:, 0], chunk[:, 1], chunk[:, 2], noise, dt, jobOptions))
+
+    if workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_simulateChunk, jobs))
+    else:
+        results = [_simulateChunk(job) for job in jobs]
+    return np.concatenate(results)
+
+
+def valueList(value: str) -> list:
+    """
+    Parses "start:stop:num" (linspace) or a comma separated list.
+    """
+    if ':' in value:
+        start, stop, num = value.split(':')
+        return list(np.linspace(float(start), float(stop), int(num)))
+    return [float(v) for v in value.split(',') if v != '']
+
+
+def formatResult(result) -> str:
+    return ('Kp: ' + str(round(result['kp'], 4)) + ', Ki: ' + str(round(result['ki'], 4)) + ', Kd: ' + str(round(result['kd'], 4))
+            + ', delay: ' + str(round(result['delay'], 4)) + ', settling: ' + str(round(result['settling'], 3)) + ' s'
+            + ', overshoot: ' + str(round(result['overshoot'], 4)) + ', IAE: ' + str(round(result['iae'], 4))
+            + ', ISE: ' + str(round(result['ise'], 4)) + ', effort: ' + str(round(result['effort'], 4)) + ' A'
+            + ', RMS: ' + str(round(result['rms'], 4)))
+
+
+def writeResults(path: str, results: np.ndarray):
+    with open(path, 'w') as f:
+        f.write(', '.join(results.dtype.names) + '\n')
+        for result in results:
+            f.write(', '.join(str(v) for v in result) + '\n')
+
+
+def simulationOptions(args) -> dict:
+    return {'niveau': args.niveau, 'start': args.start, 'outputLimits': (args.min, args.max),
+            'plantCoefficient': args.plant_coefficient, 'band': args.band, 'feedForward': feedforward.settingsFromArgs(args),
+            'filterSpecs': args.filter, 'derivativeFilter': args.derivative_filter}
+
+
+def runMode(args):
+    dt = noiseDt(args)
+    noise = noiseSequence(args, args.steps)
+    controlEvery = max(1, int(round(args.delay / dt)))
+    results = simulate(args.proportional, args.integral, args.derivative, noise, dt, controlEvery=controlEvery, **simulationOptions(args))
+    print(formatResult(results[0]))
+
+
+def sweepMode(args):
+    dt = noiseDt(args)
+    noise = noiseSequence(args, args.steps)
+    results = sweep(args.kp, args.ki, args.kd, args.delays, noise, dt, workers=args.workers, **simulationOptions(args))
+    results = results[np.argsort(results[args.sort], kind='stable')]
+    if args.verbose >= 1:
+        print('Simulated ' + str(len(results)) + ' gain sets with ' + str(args.steps) + ' steps each')
+    for result in results[:args.top]:
+        print(formatResult(result))
+    if args.output is not None:
+        writeResults(args.output, results)
+
+
+def addPlantArguments(parser):
+    plantOptions = parser.add_argument_group('plant and noise options')
+    plantOptions.add_argument('--steps', type=int, default=2000, help='number of noise steps to simulate. The default is 2000')
+    plantOptions.add_argument('--start', type=float, default=0.0, help='start position of the plant. The default is 0')
+    plantOptions.add_argument('--band', type=float, default=0.05, help='the position counts as settled within this distance to the niveau. The default is 0.05')
+    plantOptions.add_argument('--plant-coefficient', type=float, default=DELTA_I_COEFFICIENT, help='current change per position change of the simulated plant. The controller always uses ' + str(DELTA_I_COEFFICIENT))
+    noiseengine.addNoiseArguments(plantOptions)
+    plantOptions.add_argument('--noise-delay', type=float, default=0.05, help='period of randomNoise.py, the base step of the simulation. The default value is 0.05')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parentParser = argparse.ArgumentParser('The parent parser', add_help=False)
+    parentParser.add_argument('--version', action='version', version=ver)
+    parentParser.add_argument('-v', '--verbose', action='count', default=0, help='verbose output')
+    parentParser.add_argument('-n', '--niveau', type=float, default=1, help='specifys the niveau that the PID controler should aim for')
+    parentParser.add_argument('--min', type=float, default=-3, help='specifys the minimum output of the PID controller')
+    parentParser.add_argument('--max', type=float, default=3, help='specifys the maximum output of the PID controller')
+    addPlantArguments(parentParser)
+    parentParser.add_argument('--derivative-filter', type=float, default=None, help='alpha of the exponential moving average that smooths the derivative term')
+    feedforward.addFeedForwardArguments(parentParser)
+    filters.addFilterArguments(parentParser)
+
+    subparsers = parser.add_subparsers(dest='mode', help='simulate a single gain set or sweep a grid of gain sets')
+    subparsers.required = True
+
+    runParser = subparsers.add_parser('run', help='simulates a single gain set', parents=[parentParser])
+    runParser.add_argument('-p', '--proportional', type=float, default=0.5, help='specifys the coefficient for the proportional term')
+    runParser.add_argument('-i', '--integral', type=float, default=0.3, help='specifys the coefficient for the integral term')
+    runParser.add_argument('-d', '--derivative', type=float, default=0, help='specifys the coefficient for the derivative term')
+    runParser.add_argument('-D', '--delay', type=float, default=0.0, help='specifys the period of the control loop in seconds. This is 0 (every noise step) by default')
+
+    sweepParser = subparsers.add_parser('sweep', help='evaluates every combination of the given gains and delays', parents=[parentParser])
+    sweepParser.add_argument('--kp', type=valueList, default=valueList('0:2:21'), help='Kp values as "start:stop:num" or comma separated list. The default is 0:2:21')
+    sweepParser.add_argument('--ki', type=valueList, default=valueList('0:1:11'), help='Ki values. The default is 0:1:11')
+    sweepParser.add_argument('--kd', type=valueList, default=valueList('0'), help='Kd values. The default is 0')
+    sweepParser.add_argument('--delays', type=valueList, default=valueList('0'), help='controller periods in seconds. The default is 0')
+    sweepParser.add_argument('--workers', type=int, default=1, help='number of worker processes. The default is 1')
+    sweepParser.add_argument('--sort', type=str, choices=['iae', 'ise', 'settling', 'overshoot', 'effort', 'rms'], default='iae', help='metric used for ranking. The default is iae')
+    sweepParser.add_argument('--top', type=int, default=10, help='number of printed results. The default is 10')
+    sweepParser.add_argument('-o', '--output', type=str, default=None, help='writes all results to this csv file')
+
+    args = parser.parse_args()
+
+    if args.mode == 'run':
+        runMode(args)
+    elif args.mode == 'sweep':
+        sweepMode(args)
+    else:
+        print('Something went wrong while parsing the arguments\nExiting...')
+
+
+if __name__ == '__main__':
+    main()
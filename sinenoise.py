@@ -15,7 +15,7 @@ Version: 1.0.0
 License: GPLv3+
 """    
 
-if __name__ == "__main__":
+def main():
     parser = argparse.ArgumentParser(description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("-f", "--frequency", help="Frequency of the sine wave in Hz. Default is 50", type=int, default=50)
     parser.add_argument("-o", "--output", help="Output file. Default is sin.txt", default=Path("sin.txt"))
@@ -62,3 +62,7 @@ if __name__ == "__main__":
         print("Exiting...")
         f.close()
         exit(0)
+
+
+if __name__ == "__main__":
+    main()
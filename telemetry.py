@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+"""
+Buffered telemetry logging.
+
+Rows are appended to a deque that a background thread drains and writes once per flush
+interval, so the control loop never waits for the file system or wakes the thread. Two formats are supported:
+    csv   the text format the scripts always wrote (parameter header, column line, rows)
+    bin   a magic line, a JSON line with the parameter header and the record dtype,
+          followed by raw NumPy records. readTelemetry() loads it, optionally memory mapped
+Files can be rotated after a size or a time. Rotated files get a running number
+(log.txt, log.1.txt, log.2.txt, ...) and repeat the header.
+"""
+from collections import deque
+import json
+import threading
+from pathlib import Path
+from time import monotonic, time
+import numpy as np
+
+MAGIC = b'PIDLOG1\n'
+
+
+class _Note(str):
+    pass
+
+
+def parameterHeader(args) -> str:
+    return ('PID-Controller Log File\nPV: ' + str(args.pv) + '\nKp: ' + str(args.proportional) + '\nKi: ' + str(args.integral)
+            + '\nKd: ' + str(args.derivative) + '\nNiveau: ' + str(args.niveau) + '\nDelay: ' + str(args.delay) + '\n\n')
+
+
+def rotatedPath(path: Path, index: int) -> Path:
+    if index == 0:
+        return path
+    return path.with_name(path.stem + '.' + str(index) + path.suffix)
+
+
+class TelemetryLogger:
+    def __init__(self, path, columns, header: str = '', fmt: str = 'csv', rotateBytes: int = None, rotateSeconds: float = None,
+                 flushInterval: float = 0.5, chunkLen: int = 4096, delimiter: str = ', ', columnLine: str = None):
+        """
+        columns is a list of (name, dtype) tuples, e.g. [('time', 'f8'), ('current Value', 'f8')].
+        """
+        if fmt not in ('csv', 'bin'):
+            raise ValueError('unknown log format: ' + str(fmt))
+        self.path = Path(path)
+        self.columns = list(columns)
+        self.dtype = np.dtype(self.columns)
+        self.header = header
+        self.fmt = fmt
+        self.rotateBytes = rotateBytes
+        self.rotateSeconds = rotateSeconds
+        self.flushInterval = flushInterval
+        self.chunkLen = chunkLen
+        self.delimiter = delimiter
+        if columnLine is None:
+            columnLine = delimiter.join(name for name, _ in self.columns)
+        self.columnLine = columnLine
+
+        self.index = 0
+        self.file = None
+        self.written = 0
+        self.opened = 0.0
+        self.rows = 0
+        # rows and notes in the order they were logged. append and popleft of a deque are
+        # thread safe, logging a row takes no lock
+        self.pending = deque()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.openFile()
+        self.thread = threading.Thread(target=self.run, name='telemetry', daemon=True)
+        self.thread.start()
+
+    def log(self, *values):
+        self.pending.append(values)
+        if len(self.pending) >= self.chunkLen:
+            # only a long flush interval with a fast loop wakes the thread early
+            self.wake.set()
+
+    def note(self, text: str):
+        # free text events, e.g. parameter changes
+        self.pending.append(_Note(text))
+
+    def close(self):
+        self.stopped = True
+        self.wake.set()
+        self.thread.join()
+
+    def currentPath(self) -> Path:
+        return rotatedPath(self.path, self.index)
+
+    def openFile(self):
+        path = self.currentPath()
+        if self.fmt == 'csv':
+            self.file = open(path, 'w')
+            self.file.write(self.header)
+            self.file.write(self.columnLine + '\n')
+        else:
+            self.file = open(path, 'wb')
+            meta = {'header': self.header, 'columns': [name for name, _ in self.columns], 'dtype': self.dtype.descr, 'created': time()}
+            self.file.write(MAGIC)
+            self.file.write(json.dumps(meta).encode() + b'\n')
+        self.file.flush()
+        self.written = 0
+        self.opened = monotonic()
+
+    def writeNote(self, text: str):
+        if self.fmt == 'csv':
+            self.file.write('# ' + text + '\n')
+        else:
+            # binary records can't hold free text, notes go next to the file
+            with open(str(self.currentPath()) + '.notes', 'a') as n:
+                n.write(text + '\n')
+
+    def writeChunk(self, rows):
+        if self.fmt == 'csv':
+            text = ''.join(self.delimiter.join(str(v) for v in row) + '\n' for row in rows)
+            self.file.write(text)
+            self.written = self.written + len(text)
+        else:
+            data = np.array(rows, dtype=self.dtype)
+            data.tofile(self.file)
+            self.written = self.written + data.nbytes
+        self.rows = self.rows + len(rows)
+
+    def rotate(self):
+        if self.rotateBytes is not None and self.written >= self.rotateBytes:
+            pass
+        elif self.rotateSeconds is not None and monotonic() - self.opened >= self.rotateSeconds:
+            pass
+        else:
+            return
+        self.file.close()
+        self.index = self.index + 1
+        self.openFile()
+
+    def run(self):
+        running = True
+        while running:
+            self.wake.wait(self.flushInterval)
+            self.wake.clear()
+            running = not self.stopped
+            rows = []
+            for _ in range(len(self.pending)):
+                item = self.pending.popleft()
+                if isinstance(item, _Note):
+                    if len(rows) > 0:
+                        self.writeChunk(rows)
+                        rows = []
+                    self.writeNote(item)
+                else:
+                    rows.append(item)
+            if len(rows) > 0:
+                self.writeChunk(rows)
+            self.file.flush()
+            self.rotate()
+        self.file.close()
+
+
+def readTelemetry(path, mmap: bool = True):
+    """
+    Reads a binary log file. Returns (meta, records), records is a structured array.
+    """
+    with open(path, 'rb') as f:
+        if f.readline() != MAGIC:
+            raise ValueError(str(path) + ' is not a binary log file')
+        meta = json.loads(f.readline().decode())
+        offset = f.tell()
+    dtype = np.dtype([tuple(field) for field in meta['dtype']])
+    if mmap:
+        size = Path(path).stat().st_size - offset
+        if size < dtype.itemsize:
+            return meta, np.zeros(0, dtype=dtype)
+        return meta, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(size // dtype.itemsize,))
+    return meta, np.fromfile(path, dtype=dtype, offset=offset)
+
+
+def addLoggingArguments(group):
+    group.add_argument('--log-format', type=str, choices=['csv', 'bin'], default='csv', help='"csv" writes the text log, "bin" writes compact binary records. The default is "csv"')
+    group.add_argument('--log-rotate-size', type=float, default=None, help='start a new log file after this many megabytes')
+    group.add_argument('--log-rotate-time', type=float, default=None, help='start a new log file after this many seconds')
+
+
+def fromArgs(args, columns, header: str) -> TelemetryLogger:
+    rotateBytes = None
+    if args.log_rotate_size is not None:
+        rotateBytes = int(args.log_rotate_size * 1e6)
+    return TelemetryLogger(args.log_file, columns, header=header, fmt=args.log_format, rotateBytes=rotateBytes, rotateSeconds=args.log_rotate_time)
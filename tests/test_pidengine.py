@@ -0,0 +1,82 @@
+"""
+Pins VectorPID to simple_pid.PID, which the controller used before. The expected outputs
+were recorded with simple_pid 2.0.1: PID(0.8, 2.0, 0.05, setpoint=1.0, sample_time=None,
+output_limits=(-1, 1)) called with dt=0.1, its last input cleared before step 20 like
+VectorPID.resume() does.
+"""
+import pytest
+from pidengine import VectorPID
+
+MEASUREMENTS = [0.804, 0.752, 1.251, 1.449, 0.956, 0.955, 0.768, 0.812, 0.33, 0.403, 0.473, 0.946, 1.041, 1.194, 0.746, 1.422, 0.847,
+                1.178, 1.079, 0.815, 0.618, 0.416, 0.53, 0.497, 0.942, 0.393, 0.392, 0.124, 0.357, -0.278]
+EXPECTED = [0.196, 0.3132, -0.4117, -0.5094, 0.2393, 0.0031, 0.2921, 0.179, 0.9616, 0.7451, 0.796, 0.2269, 0.3317, 0.1415, 0.8512, -0.336,
+            0.7801, 0.0267, 0.3051, 0.6358, 0.7378, 1, 0.962, 1, 0.5791, 1, 1, 1, 1, 1]
+RESUME = 20
+DT = 0.1
+
+
+def newPid(**kwargs):
+    return VectorPID(0.8, 2.0, 0.05, setpoint=1.0, outputLimits=(-1, 1), **kwargs)
+
+
+def run(step, pid):
+    outputs = []
+    for k, measurement in enumerate(MEASUREMENTS):
+        if k == RESUME:
+            pid.resume()
+        outputs.append(float(step(pid, measurement)))
+    return outputs
+
+
+@pytest.mark.parametrize('step', [
+    lambda pid, m: pid.step(m, DT)[0],
+    lambda pid, m: pid.scalarStep(m, DT),
+    lambda pid, m: pid(m, DT),
+], ids=['step', 'scalarStep', 'call'])
+def test_matches_simple_pid(step):
+    assert run(step, newPid()) == pytest.approx(EXPECTED, abs=1e-9)
+
+
+def test_clamps_output_and_integral():
+    pid = newPid()
+    for _ in range(50):
+        assert pid(-5.0, DT) == 1
+    # the integrator stops at the limit, so the output leaves it as soon as the error changes sign
+    assert pid.integral[0] == 1
+    assert pid(5.0, DT) == -1
+
+
+def test_scalar_path_shares_the_state():
+    mixed = newPid()
+    alone = newPid()
+    for k, measurement in enumerate(MEASUREMENTS):
+        if k % 2 == 0:
+            out = mixed.scalarStep(measurement, DT)
+        else:
+            out = float(mixed.step(measurement, DT)[0])
+        assert out == pytest.approx(alone.scalarStep(measurement, DT), abs=1e-12)
+
+
+def test_derivative_filter():
+    alpha = 0.3
+    pids = [newPid(derivativeFilter=alpha), newPid(derivativeFilter=alpha)]
+    # reference: the simple_pid terms with the derivative smoothed by an EMA that restarts at 0
+    integral = 0.0
+    derivative = 0.0
+    last = None
+    for k, measurement in enumerate(MEASUREMENTS):
+        if k == RESUME:
+            for pid in pids:
+                pid.resume()
+            last = None
+        error = 1.0 - measurement
+        integral = min(max(integral + 2.0 * error * DT, -1), 1)
+        if last is not None:
+            derivative = derivative + alpha * (0.05 * (measurement - last) / DT - derivative)
+            term = derivative
+        else:
+            term = 0.0
+        last = measurement
+        expected = min(max(0.8 * error + integral - term, -1), 1)
+        assert float(pids[0].step(measurement, DT)[0]) == pytest.approx(expected, abs=1e-12)
+        assert pids[1].scalarStep(measurement, DT) == pytest.approx(expected, abs=1e-12)
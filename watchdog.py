@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+"""
+Watchdog of the control loop.
+
+Every cycle the loop reports the state of its inputs and update() decides whether it may
+correct. The checks are
+    position    the position source delivers fresh samples (--position-timeout)
+    connection  the current PVs are connected and return a value
+    deadline    the loop didn't miss --max-misses deadlines in a row
+    stall       the loop didn't stop beating for --stall-timeout seconds, checked by a
+                monitor thread so a loop hanging in I/O is noticed as well
+While a check fails the loop skips the PID step, which freezes the integrator, and the
+current is held or ramped to --safe-current. After --recover-cycles good cycles in a row
+the loop resumes on its own. Every current change, also in normal operation, is limited
+to --slew-rate A/s. The actuator value can be a float or an array with one current per steerer.
+"""
+import threading
+from time import monotonic
+import numpy as np
+
+CHECKS = ('position', 'connection', 'deadline', 'stall')
+FAULT_ACTIONS = ['hold', 'ramp']
+
+# a put after a long pause may move the current by at most this many seconds of slew
+MAX_SLEW_INTERVAL = 1.0
+
+
+class Watchdog:
+    def __init__(self, get, put, pid=None, loop=None, action: str = 'hold', safeValue: float = None, slewRate: float = None,
+                 maxMisses: int = None, recoverCycles: int = 3, stallTimeout: float = None, threadInit=None, logger=None):
+        """
+        get() reads and put(value) writes the actuator. threadInit is called once by the
+        monitor thread before it touches the actuator, e.g. to attach to the CA context.
+        """
+        if action == 'ramp' and safeValue is None:
+            raise ValueError('ramping needs a safe value')
+        self.get = get
+        self.put = put
+        self.pid = pid
+        self.loop = loop
+        self.action = action
+        self.safeValue = safeValue
+        self.slewRate = slewRate
+        self.maxMisses = maxMisses
+        self.recoverCycles = recoverCycles
+        self.stallTimeout = stallTimeout
+        self.threadInit = threadInit
+        self.logger = logger
+        self.failing = set()
+        self.active = set()
+        self.counts = dict.fromkeys(CHECKS, 0)
+        self.faulted = False
+        self.good = 0
+        self.misses = 0
+        self.overruns = 0
+        self.lastPut = monotonic()
+        self.lastBeat = monotonic()
+        self.startTime = monotonic()
+        self.stalled = False
+        self.stalling = False
+        # the loop and the monitor thread both move the actuator
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        if stallTimeout is not None:
+            self.thread = threading.Thread(target=self.monitor, name='watchdog', daemon=True)
+            self.thread.start()
+
+    def beat(self):
+        self.lastBeat = monotonic()
+
+    def report(self, check: str, ok: bool):
+        if ok:
+            self.failing.discard(check)
+        elif check not in self.failing:
+            self.failing.add(check)
+            self.counts[check] = self.counts[check] + 1
+
+    def update(self) -> bool:
+        """
+        Evaluates the checks of this cycle. Returns True if the loop may correct.
+        """
+        if self.loop is not None and self.maxMisses is not None:
+            if self.loop.overruns > self.overruns:
+                self.misses = self.misses + 1
+            else:
+                self.misses = 0
+            self.overruns = self.loop.overruns
+            self.report('deadline', self.misses < self.maxMisses)
+        failing = set(self.failing)
+        if self.stalled:
+            # a stall is over once the loop runs again, it counts as one bad cycle
+            self.stalled = False
+            failing.add('stall')
+
+        if len(failing) > 0:
+            if not self.faulted or failing != self.active:
+                self.event('fault ' + ', '.join(sorted(failing)) + ', ' + ('ramping to ' + str(self.safeValue) if self.action == 'ramp' else 'holding the current'))
+            self.faulted = True
+            self.active = failing
+            self.good = 0
+            self.safe()
+            return False
+        if self.faulted:
+            self.good = self.good + 1
+            if self.good < self.recoverCycles:
+                self.safe()
+                return False
+            self.faulted = False
+            self.active = set()
+            if self.pid is not None:
+                self.pid.resume()
+            self.event('all checks pass, resuming')
+        return True
+
+    def limit(self, current: float, target: float) -> float:
+        if self.slewRate is None:
+            return target
+        step = self.slewRate * min(monotonic() - self.lastPut, MAX_SLEW_INTERVAL)
+        if np.ndim(current) > 0:
+            return np.clip(target, current - step, current + step)
+        return min(max(target, current - step), current + step)
+
+    def apply(self, current: float, target: float) -> float:
+        """
+        Moves the actuator from current towards target within the slew limit. Returns the written value.
+        """
+        with self.lock:
+            value = self.limit(current, target)
+            self.put(value)
+            self.lastPut = monotonic()
+        return value
+
+    def safe(self, blocking: bool = True):
+        # hold does nothing, the current stays where it is
+        if self.action != 'ramp':
+            return
+        if not self.lock.acquire(blocking=blocking):
+            return
+        try:
+            current = self.get()
+            if current is None or np.all(current == self.safeValue):
+                return
+            self.put(self.limit(current, self.safeValue))
+            self.lastPut = monotonic()
+        except Exception as e:
+            print('Watchdog: could not move to the safe value: ' + str(e))
+        finally:
+            self.lock.release()
+
+    def monitor(self):
+        if self.threadInit is not None:
+            self.threadInit()
+        while not self.stopped.wait(self.stallTimeout / 4):
+            silent = monotonic() - self.lastBeat
+            if silent > self.stallTimeout:
+                if not self.stalling:
+                    self.stalling = True
+                    self.stalled = True
+                    self.counts['stall'] = self.counts['stall'] + 1
+                    self.event('the loop stalled for ' + str(round(silent, 3)) + ' s')
+                # the loop may hang while it holds the lock, the thread never waits for it
+                self.safe(blocking=False)
+            else:
+                self.stalling = False
+
+    def elapsed(self) -> float:
+        # the time since the start of the loop, like the time column of the log and the notes of control.py
+        if self.loop is not None:
+            return self.loop.elapsed()
+        return monotonic() - self.startTime
+
+    def event(self, text: str):
+        print('Watchdog: ' + text)
+        if self.logger is not None:
+            cycle = ''
+            if self.loop is not None:
+                cycle = ', cycle: ' + str(self.loop.cycles)
+            self.logger.note('time: ' + str(self.elapsed()) + cycle + ', watchdog: ' + text)
+
+    def summary(self) -> str:
+        return 'watchdog faults: ' + ', '.join(check + ': ' + str(self.counts[check]) for check in CHECKS)
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+
+
+def addWatchdogArguments(parser):
+    group = parser.add_argument_group('watchdog options')
+    group.add_argument('--fault-action', type=str, choices=FAULT_ACTIONS, default='hold', help='what happens to the current while a check fails: "hold" keeps it, "ramp" moves it to --safe-current. The default is "hold"')
+    group.add_argument('--safe-current', type=float, default=None, help='the current in A that "ramp" moves to')
+    group.add_argument('--slew-rate', type=float, default=None, help='largest current change in A per second, applies to every put. Unlimited by default')
+    group.add_argument('--max-misses', type=int, default=None, help='number of missed deadlines in a row that count as a fault. Not checked by default')
+    group.add_argument('--recover-cycles', type=int, default=3, help='number of good cycles in a row before the loop corrects again. The default is 3')
+    group.add_argument('--stall-timeout', type=float, default=None, help='seconds without a finished cycle after which the loop counts as stalled. Not checked by default')
+    return group
+
+
+def fromArgs(args, get, put, pid=None, loop=None, threadInit=None, logger=None) -> Watchdog:
+    try:
+        return Watchdog(get, put, pid=pid, loop=loop, action=args.fault_action, safeValue=args.safe_current, slewRate=args.slew_rate,
+                        maxMisses=args.max_misses, recoverCycles=args.recover_cycles, stallTimeout=args.stall_timeout,
+                        threadInit=threadInit, logger=logger)
+    except ValueError as e:
+        print('Invalid watchdog options: ' + str(e) + ', use --safe-current\nExiting...')
+        exit()